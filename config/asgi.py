@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# Start the face search workers with the server rather than on the first webcam search
+from travel.face_search import get_search_pool  # noqa: E402
+
+get_search_pool().warm_up()
@@ -52,6 +52,8 @@ SITE_ID = 1
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # Per-view timing/SQL metrics; removes itself unless REQUEST_METRICS_ENABLED
+    'travel.metrics.RequestMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -93,6 +95,14 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Face job workers write concurrently; wait for the lock instead of failing
+        'OPTIONS': {
+            'timeout': 20,
+        },
+        # On disk, so tests can share it with worker processes
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -145,6 +155,57 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 AUTH_USER_MODEL = 'travel.CustomUser'
 
+# Background face processing (python manage.py process_face_jobs)
+FACE_JOB_WORKERS = 2
+FACE_JOB_MAX_ATTEMPTS = 3
+FACE_JOB_STALE_SECONDS = 600
+
+# Longest side (px) of the frame HOG runs on; boxes are mapped back to full resolution.
+# None runs detection on the native image.
+FACE_DETECTION_MAX_SIDE = 1600
+
+# Face quality gate, checked before a detected face is encoded. Faces lower than
+# FACE_MIN_HEIGHT px, blurrier than FACE_MIN_SHARPNESS (Laplacian variance, 0 = off) or
+# turned further than FACE_MAX_YAW (0 frontal .. ~1 profile, None = off) are skipped.
+FACE_MIN_HEIGHT = 40
+FACE_MIN_SHARPNESS = 30.0
+FACE_MAX_YAW = 0.8
+
+# Face distance thresholds: same person / merge suggestion / webcam search
+FACE_MATCH_STRICT_DISTANCE = 0.45
+FACE_MATCH_MAYBE_DISTANCE = 0.65
+FACE_SEARCH_DISTANCE = 0.55
+
+# Webcam search (search_photos_by_face_async): worker processes doing detection/encoding,
+# searches allowed in flight (running + queued) before answering 503, per-search timeout
+# in seconds, and the Retry-After sent with a 503.
+FACE_SEARCH_WORKERS = 2
+FACE_SEARCH_MAX_PENDING = 8
+FACE_SEARCH_TIMEOUT = 10
+FACE_SEARCH_RETRY_AFTER = 5
+
+# Per-trip memory-mappable encoding files (set to None to always read from the database)
+FACE_SEGMENT_ROOT = BASE_DIR / 'face_segments'
+# Number of trips whose face index is kept in memory for webcam search
+FACE_INDEX_CACHE_SIZE = 32
+
+# Budget forecast: span (days) of the weighted daily average, and trips kept in memory
+FORECAST_EWMA_SPAN = 3
+FORECAST_CACHE_SIZE = 256
+
+# Rendered trip pages, tabs and PDFs (travel/trip_cache.py) go to the default cache
+# (per-process memory unless CACHES says otherwise). Keys include Trip.version, so
+# entries never go stale, they only expire.
+TRIP_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Request metrics (travel/metrics.py), scraped from /metrics by staff users or with
+# "Authorization: Bearer <REQUEST_METRICS_TOKEN>". Requests running more than
+# REQUEST_METRICS_QUERY_BUDGET SQL queries are logged as warnings (None = never).
+REQUEST_METRICS_ENABLED = os.environ.get('REQUEST_METRICS_ENABLED') == '1'
+REQUEST_METRICS_TOKEN = os.environ.get('REQUEST_METRICS_TOKEN')
+REQUEST_METRICS_QUERY_BUDGET = 50
+REQUEST_METRICS_SLOW_STATEMENTS = 5
+
 # 1. After logging in, redirect the user to the dashboard
 LOGIN_REDIRECT_URL = 'dashboard'
 
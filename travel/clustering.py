@@ -0,0 +1,310 @@
+# travel/clustering.py
+import random
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.db.models import Count, Q
+
+from .encodings import ENCODING_DTYPE, decode_encoding, encode_encoding
+from .face_index import MAYBE_MATCH_DISTANCE, STRICT_MATCH_DISTANCE, bump_face_version, trip_face_lock
+from .models import FaceGroup, FaceMergeSuggestion, PhotoFaceRelation
+
+DEFAULT_NAME = "Unknown Person"
+
+
+def neighbor_lists(matrix, threshold, block_size=2048):
+    """
+    For every row, the indices and distances of all other rows within `threshold`.
+
+    Distances are computed block by block as |a|^2 + |b|^2 - 2ab, so memory stays at
+    block_size x N floats however large the trip is.
+    """
+    matrix = np.asarray(matrix, dtype=ENCODING_DTYPE)
+    n = len(matrix)
+    squared = np.einsum('ij,ij->i', matrix, matrix)
+    neighbors = []
+
+    for start in range(0, n, block_size):
+        block = matrix[start:start + block_size]
+        dist = squared[start:start + block_size, None] + squared[None, :] - 2.0 * (block @ matrix.T)
+        np.maximum(dist, 0, out=dist)
+        np.sqrt(dist, out=dist)
+
+        for offset, row in enumerate(dist):
+            row[start + offset] = np.inf  # no self edges
+            idx = np.flatnonzero(row <= threshold)
+            neighbors.append((idx, row[idx]))
+
+    return neighbors
+
+
+def chinese_whispers(neighbors, iterations=20, seed=0):
+    """
+    Graph clustering: every node repeatedly adopts the label with the highest total
+    edge weight among its neighbors (weight = 1 - distance). Runs until labels are
+    stable or `iterations` is reached. Returns one label per node.
+    """
+    n = len(neighbors)
+    labels = np.arange(n)
+    order = list(range(n))
+    rng = random.Random(seed)
+
+    for _ in range(iterations):
+        rng.shuffle(order)
+        changed = False
+        for node in order:
+            idx, dist = neighbors[node]
+            if not len(idx):
+                continue
+            scores = defaultdict(float)
+            for label, weight in zip(labels[idx].tolist(), (1.0 - dist).tolist()):
+                scores[label] += weight
+            # Ties go to the smaller label so results don't depend on dict order
+            best = max(scores.items(), key=lambda item: (item[1], -item[0]))[0]
+            if best != labels[node]:
+                labels[node] = best
+                changed = True
+        if not changed:
+            break
+
+    # Renumber to 0..k-1
+    _, labels = np.unique(labels, return_inverse=True)
+    return labels
+
+
+def _assign_groups(cluster_members, old_group_of, groups_by_id):
+    """
+    Maps clusters onto existing FaceGroups by overlap. Named groups win over
+    "Unknown Person" ones, and every old group is reused by at most one cluster.
+    Returns {cluster: group_id or None}.
+    """
+    candidates = []
+    for cluster, members in cluster_members.items():
+        for group_id, overlap in Counter(old_group_of[m] for m in members).items():
+            is_named = groups_by_id[group_id].name != DEFAULT_NAME
+            candidates.append((is_named, overlap, -group_id, cluster, group_id))
+    candidates.sort(reverse=True)
+
+    assigned = {}
+    used_groups = set()
+    for _, _, _, cluster, group_id in candidates:
+        if cluster in assigned or group_id in used_groups:
+            continue
+        assigned[cluster] = group_id
+        used_groups.add(group_id)
+    return {cluster: assigned.get(cluster) for cluster in cluster_members}
+
+
+def recluster_trip(trip, threshold=STRICT_MATCH_DISTANCE, maybe=MAYBE_MATCH_DISTANCE,
+                   iterations=20, block_size=2048, seed=0, dry_run=False):
+    """
+    Re-clusters every stored face encoding of a trip and rewrites its FaceGroups,
+    PhotoFaceRelations and merge suggestions in one transaction.
+
+    Faces saved before per-face encodings existed keep their current group.
+    Returns a dict of statistics.
+    """
+    # Reads and writes happen under the trip's face lock, so a worker assigning faces can't
+    # commit in between and have its groups rewritten from stale rows
+    with trip_face_lock(trip.id):
+        rows = list(
+            PhotoFaceRelation.objects.filter(face_group__trip=trip, encoding__isnull=False)
+            .values_list('id', 'face_group_id', 'encoding')
+        )
+        stats = {
+            'faces': len(rows),
+            'without_encoding': PhotoFaceRelation.objects.filter(face_group__trip=trip, encoding__isnull=True).count(),
+            'groups_before': FaceGroup.objects.filter(trip=trip).count(),
+        }
+        if not rows:
+            stats.update(clusters=0, groups_after=stats['groups_before'], suggestions=0)
+            return stats
+
+        relation_ids = [row[0] for row in rows]
+        old_group_of = [row[1] for row in rows]
+        matrix = np.vstack([decode_encoding(row[2]) for row in rows])
+
+        labels = chinese_whispers(neighbor_lists(matrix, threshold, block_size), iterations=iterations, seed=seed)
+        cluster_members = defaultdict(list)
+        for index, label in enumerate(labels.tolist()):
+            cluster_members[label].append(index)
+        stats['clusters'] = len(cluster_members)
+
+        clusters = sorted(cluster_members)
+        centroids = np.vstack([matrix[cluster_members[c]].mean(axis=0) for c in clusters])
+
+        # Clusters whose centroids are close but not close enough become merge suggestions
+        suggestion_pairs = []
+        for a, (idx, dist) in enumerate(neighbor_lists(centroids, maybe, block_size)):
+            for b, d in zip(idx.tolist(), dist.tolist()):
+                if a < b and d > threshold:
+                    suggestion_pairs.append((clusters[a], clusters[b]))
+        stats['suggestions'] = len(suggestion_pairs)
+
+        if dry_run:
+            stats['groups_after'] = None
+            return stats
+
+        groups_by_id = FaceGroup.objects.filter(trip=trip).in_bulk()
+        cluster_group = _assign_groups(cluster_members, old_group_of, groups_by_id)
+        dismissed = set(
+            FaceMergeSuggestion.objects.filter(trip=trip, is_active=False).values_list('group_a_id', 'group_b_id')
+        )
+
+        for position, cluster in enumerate(clusters):
+            members = cluster_members[cluster]
+            centroid = encode_encoding(centroids[position])
+            group_id = cluster_group[cluster]
+
+            if group_id is None:
+                # A split-off person: thumbnail falls back to one of their photos in the template
+                group_id = FaceGroup.objects.create(trip=trip, representative_encoding=centroid).id
+                cluster_group[cluster] = group_id
+            else:
+                FaceGroup.objects.filter(pk=group_id).update(representative_encoding=centroid)
+
+            # Every face keeps its own tag (and encoding), even two of one photo in one cluster
+            member_ids = [relation_ids[m] for m in members]
+            for start in range(0, len(member_ids), block_size):
+                batch = member_ids[start:start + block_size]
+                PhotoFaceRelation.objects.filter(id__in=batch).update(face_group_id=group_id)
+
+        FaceMergeSuggestion.objects.filter(trip=trip).delete()
+        FaceMergeSuggestion.objects.bulk_create([
+            FaceMergeSuggestion(
+                trip=trip,
+                group_a_id=cluster_group[a],
+                group_b_id=cluster_group[b],
+                is_active=(cluster_group[a], cluster_group[b]) not in dismissed
+                and (cluster_group[b], cluster_group[a]) not in dismissed,
+            )
+            for a, b in suggestion_pairs
+        ])
+
+        FaceGroup.objects.filter(trip=trip, tagged_photos__isnull=True).delete()
+        bump_face_version(trip.id)
+
+        stats['groups_after'] = FaceGroup.objects.filter(trip=trip).count()
+    return stats
+
+
+def merge_face_groups(target, source_ids):
+    """
+    Merges the FaceGroups in `source_ids` into `target` with a fixed number of queries,
+    whatever the number of tagged photos:
+    face tags are re-pointed in bulk (every face keeps its tag), pending suggestions
+    are re-targeted at `target`, and its representative encoding becomes the centroid
+    of all merged groups weighted by their number of tags.
+    """
+    source_ids = [group_id for group_id in set(source_ids) if group_id != target.id]
+    if not source_ids:
+        return 0
+    merged_ids = [target.id] + source_ids
+
+    # Under the trip's face lock: no worker assigns faces to these groups while they are merged
+    with trip_face_lock(target.trip_id):
+        groups = FaceGroup.objects.select_for_update().filter(id__in=merged_ids, trip_id=target.trip_id).in_bulk()
+        target = groups[target.id]
+        source_ids = [group_id for group_id in source_ids if group_id in groups]
+        merged_ids = [target.id] + source_ids
+
+        tag_counts = dict(
+            PhotoFaceRelation.objects.filter(face_group_id__in=merged_ids)
+            .values_list('face_group_id').annotate(n=Count('id'))
+        )
+        weights, encodings = [], []
+        for group_id in merged_ids:
+            try:
+                encodings.append(decode_encoding(groups[group_id].representative_encoding))
+            except ValueError:
+                continue
+            weights.append(max(tag_counts.get(group_id, 0), 1))
+
+        moved = PhotoFaceRelation.objects.filter(face_group_id__in=source_ids).update(face_group_id=target.id)
+
+        _retarget_suggestions(target, source_ids)
+
+        if target.name == DEFAULT_NAME:
+            # Keep a name someone already gave one of the merged groups
+            target.name = next(
+                (groups[g].name for g in source_ids if groups[g].name != DEFAULT_NAME), DEFAULT_NAME
+            )
+        if not target.thumbnail:
+            target.thumbnail = next((groups[g].thumbnail for g in source_ids if groups[g].thumbnail), None)
+        if encodings:
+            target.representative_encoding = encode_encoding(np.average(np.vstack(encodings), axis=0, weights=weights))
+        target.save(update_fields=['name', 'thumbnail', 'representative_encoding'])
+
+        FaceGroup.objects.filter(id__in=source_ids).delete()
+        bump_face_version(target.trip_id)
+    return moved
+
+
+def _retarget_suggestions(target, source_ids):
+    """
+    Points the merge suggestions of merged groups at `target`. Pairs inside the merged
+    set disappear; when two suggestions collapse onto the same pair, the pair stays
+    dismissed if either of them was.
+    """
+    merged = set(source_ids) | {target.id}
+    affected = list(
+        FaceMergeSuggestion.objects.filter(Q(group_a_id__in=source_ids) | Q(group_b_id__in=source_ids))
+    )
+    untouched = {
+        frozenset(pair): is_active
+        for *pair, is_active in FaceMergeSuggestion.objects.filter(Q(group_a_id=target.id) | Q(group_b_id=target.id))
+        .exclude(group_a_id__in=source_ids).exclude(group_b_id__in=source_ids)
+        .values_list('group_a_id', 'group_b_id', 'is_active')
+    }
+
+    retargeted = {}
+    for suggestion in affected:
+        a = target.id if suggestion.group_a_id in merged else suggestion.group_a_id
+        b = target.id if suggestion.group_b_id in merged else suggestion.group_b_id
+        if a == b:
+            continue
+        key = frozenset((a, b))
+        if key in untouched:
+            if not suggestion.is_active and untouched[key]:
+                FaceMergeSuggestion.objects.filter(
+                    group_a_id__in=key, group_b_id__in=key
+                ).update(is_active=False)
+                untouched[key] = False
+            continue
+        if key in retargeted:
+            retargeted[key].is_active = retargeted[key].is_active and suggestion.is_active
+            continue
+        retargeted[key] = FaceMergeSuggestion(
+            trip_id=suggestion.trip_id, group_a_id=a, group_b_id=b, is_active=suggestion.is_active
+        )
+
+    FaceMergeSuggestion.objects.filter(id__in=[s.id for s in affected]).delete()
+    FaceMergeSuggestion.objects.bulk_create(retargeted.values())
+
+
+def suggestion_chain(suggestion):
+    """
+    Every group linked to the suggestion's groups through a chain of active suggestions,
+    e.g. A~B and B~C gives {A, B, C}. One query for the whole trip.
+    """
+    links = defaultdict(set)
+    for a, b in FaceMergeSuggestion.objects.filter(trip_id=suggestion.trip_id, is_active=True).values_list(
+        'group_a_id', 'group_b_id'
+    ):
+        links[a].add(b)
+        links[b].add(a)
+
+    seen = {suggestion.group_a_id, suggestion.group_b_id}
+    pending = list(seen)
+    while pending:
+        for neighbor in links[pending.pop()]:
+            if neighbor not in seen:
+                seen.add(neighbor)
+                pending.append(neighbor)
+    return seen
+
+
+def pick_merge_target(group_ids):
+    """Named groups first, then the one with the most tagged photos, then the oldest."""
+    groups = FaceGroup.objects.filter(id__in=group_ids).annotate(photos=Count('tagged_photos__photo', distinct=True))
+    return min(groups, key=lambda g: (g.name == DEFAULT_NAME, -g.photos, g.id))
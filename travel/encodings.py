@@ -0,0 +1,129 @@
+# travel/encodings.py
+"""
+Storage format for 128-d face encodings.
+
+A stored encoding is a 4 byte header (format version, reserved byte, dimension)
+followed by the raw little-endian float32 values, so reading one back is a
+zero-copy `np.frombuffer` instead of unpickling a float64 ndarray.
+
+For whole-trip loads there is also a per-trip segment file: every group id and
+encoding of the trip laid out contiguously so it can be memory-mapped.
+"""
+import os
+import struct
+
+import numpy as np
+
+ENCODING_FORMAT_VERSION = 1
+ENCODING_DIM = 128
+ENCODING_DTYPE = np.dtype('<f4')
+
+_HEADER = struct.Struct('<BBH')
+
+SEGMENT_MAGIC = b'TRIPFACE'
+SEGMENT_VERSION = 1
+_SEGMENT_HEADER = struct.Struct('<8sII')
+
+
+def encode_encoding(encoding):
+    """ndarray (any float dtype) -> versioned float32 bytes for FaceGroup.representative_encoding."""
+    values = np.asarray(encoding, dtype=ENCODING_DTYPE).reshape(-1)
+    return _HEADER.pack(ENCODING_FORMAT_VERSION, 0, values.size) + values.tobytes()
+
+
+def is_encoded(raw):
+    """True if `raw` is in the versioned format (pickles start with 0x80)."""
+    return bool(raw) and raw[0] == ENCODING_FORMAT_VERSION
+
+
+def decode_encoding(raw):
+    """
+    Versioned bytes -> read-only float32 view over the same buffer.
+    Raises ValueError for anything else (e.g. rows not yet converted from pickle).
+    """
+    raw = bytes(raw) if isinstance(raw, memoryview) else raw
+    if not raw or len(raw) < _HEADER.size:
+        raise ValueError("Empty face encoding")
+
+    version, _, dim = _HEADER.unpack_from(raw)
+    if version != ENCODING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face encoding format: {version}")
+    if len(raw) != _HEADER.size + dim * ENCODING_DTYPE.itemsize:
+        raise ValueError("Truncated face encoding")
+    return np.frombuffer(raw, dtype=ENCODING_DTYPE, count=dim, offset=_HEADER.size)
+
+
+_MATRIX_HEADER = struct.Struct('<BBHI')
+
+
+def encode_matrix(matrix):
+    """(N, 128) encodings -> header (version, dimension, count) + float32 rows."""
+    values = np.ascontiguousarray(matrix, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+    return _MATRIX_HEADER.pack(ENCODING_FORMAT_VERSION, 0, ENCODING_DIM, len(values)) + values.tobytes()
+
+
+def decode_matrix(raw):
+    """Inverse of encode_matrix: a read-only (N, 128) float32 view over `raw`."""
+    raw = bytes(raw) if isinstance(raw, memoryview) else raw
+    if not raw or len(raw) < _MATRIX_HEADER.size:
+        raise ValueError("Empty encoding matrix")
+
+    version, _, dim, count = _MATRIX_HEADER.unpack_from(raw)
+    if version != ENCODING_FORMAT_VERSION:
+        raise ValueError(f"Unsupported face encoding format: {version}")
+    if len(raw) != _MATRIX_HEADER.size + count * dim * ENCODING_DTYPE.itemsize:
+        raise ValueError("Truncated encoding matrix")
+    return np.frombuffer(raw, dtype=ENCODING_DTYPE, count=count * dim, offset=_MATRIX_HEADER.size).reshape(count, dim)
+
+
+# --- Per-trip segment files ---
+
+def write_segment(path, group_ids, matrix):
+    """
+    Writes group ids and their encodings as one contiguous file:
+    header | int64 ids (N) | float32 matrix (N, 128).
+    The file is written next to its final name and renamed, so readers never see a partial file.
+    """
+    group_ids = np.ascontiguousarray(group_ids, dtype='<i8')
+    matrix = np.ascontiguousarray(matrix, dtype=ENCODING_DTYPE).reshape(len(group_ids), ENCODING_DIM)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as fh:
+        fh.write(_SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(group_ids)))
+        fh.write(group_ids.tobytes())
+        fh.write(matrix.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_segment(path):
+    """
+    Memory-maps a segment file. Returns (group_ids, matrix) without copying,
+    or None if the file is missing or not a valid segment.
+    """
+    try:
+        with open(path, 'rb') as fh:
+            header = fh.read(_SEGMENT_HEADER.size)
+    except FileNotFoundError:
+        return None
+
+    if len(header) != _SEGMENT_HEADER.size:
+        return None
+    magic, version, count = _SEGMENT_HEADER.unpack(header)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        return None
+
+    expected_size = _SEGMENT_HEADER.size + count * (8 + ENCODING_DIM * ENCODING_DTYPE.itemsize)
+    if os.path.getsize(path) != expected_size:
+        return None
+
+    if count == 0:
+        return np.empty(0, dtype='<i8'), np.empty((0, ENCODING_DIM), dtype=ENCODING_DTYPE)
+
+    group_ids = np.memmap(path, dtype='<i8', mode='r', offset=_SEGMENT_HEADER.size, shape=(count,))
+    matrix = np.memmap(
+        path, dtype=ENCODING_DTYPE, mode='r',
+        offset=_SEGMENT_HEADER.size + count * 8,
+        shape=(count, ENCODING_DIM)
+    )
+    return group_ids, matrix
@@ -0,0 +1,225 @@
+# travel/expense_import.py
+"""
+Bulk import of expenses from CSV files: the app's own format or a bank statement.
+
+The file is parsed row by row as it is read and written in chunks: each chunk is one
+bulk_create plus one rollup update, in its own transaction. Only one chunk is held in
+memory, so a 100k-row file costs the same memory as a 1k-row one. Rows that can't be
+imported are skipped and reported with their line number; a chunk that fails to write
+is rolled back on its own.
+"""
+import csv
+import io
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError
+
+from .models import Expense
+from .rollups import add_expenses
+
+CHUNK_SIZE = 1000
+# Errors kept in the report; past that they are only counted
+MAX_REPORTED_ERRORS = 200
+
+# Accepted header names (compared in lower case) for each field
+COLUMNS = {
+    'date': ('date', 'transaction date', 'txn date', 'value date', 'posting date'),
+    'title': ('title', 'description', 'narration', 'details', 'particulars', 'merchant', 'remarks'),
+    'amount': ('amount', 'debit', 'debit amount', 'withdrawal', 'withdrawal amt', 'withdrawal amount'),
+    'credit': ('credit', 'credit amount', 'deposit', 'deposit amt', 'deposit amount'),
+    'category': ('category',),
+    'paid_by': ('paid_by', 'paid by', 'payer', 'member'),
+}
+REQUIRED_COLUMNS = ('date', 'title', 'amount')
+
+# Day first, like the statements of Indian banks
+DATE_FORMATS = (
+    '%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%d-%m-%y',
+    '%d %b %Y', '%d-%b-%Y', '%d %b %y', '%d-%b-%y', '%d %B %Y',
+)
+
+# Words in the category (or, without one, the title) that point to one of Expense.CATEGORY_CHOICES.
+# Matched as whole words with an optional plural 's' ('bus' must not match "Business"),
+# so other forms of a word are spelled out.
+CATEGORY_KEYWORDS = {
+    'Food': ('food', 'restaurant', 'cafe', 'dining', 'dinner', 'lunch(?:es)?', 'breakfast', 'grocer(?:y|ies)?',
+             'swiggy', 'zomato'),
+    'Travel': ('travel', 'transport', 'flight', 'airline', 'train', 'rail(?:way)?', 'bus(?:es)?', 'taxi', 'cab',
+               'uber', 'ola', 'fuel', 'petrol', 'toll', 'parking'),
+    'Stay': ('stay', 'hotel', 'hostel', 'lodging', 'accommodation', 'airbnb', 'resort', 'homestay'),
+    'Shopping': ('shop(?:ping)?', 'store', 'mall', 'souvenir', 'market', 'amazon', 'flipkart'),
+}
+CATEGORY_PATTERNS = [
+    (category, re.compile(r'\b(?:' + '|'.join(words) + r')s?\b', re.IGNORECASE))
+    for category, words in CATEGORY_KEYWORDS.items()
+]
+CHOICES = {value.lower(): value for value, _ in Expense.CATEGORY_CHOICES}
+
+TITLE_LENGTH = Expense._meta.get_field('title').max_length
+
+
+class RowError(Exception):
+    pass
+
+
+def text_stream(binary_file):
+    """Decodes an uploaded/opened binary file lazily (a BOM from Excel is dropped)."""
+    return io.TextIOWrapper(binary_file, encoding='utf-8-sig', errors='replace', newline='')
+
+
+def map_columns(fieldnames):
+    """{field: header} for the headers of the file; ValueError when a required one is missing."""
+    headers = {(name or '').strip().lower(): name for name in fieldnames or []}
+    columns = {}
+    for field, aliases in COLUMNS.items():
+        for alias in aliases:
+            if alias in headers:
+                columns[field] = headers[alias]
+                break
+    missing = [field for field in REQUIRED_COLUMNS if field not in columns]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+    return columns
+
+
+def parse_category(value, title):
+    value = (value or '').strip()
+    if value.lower() in CHOICES:
+        return CHOICES[value.lower()]
+    for text in (value, title):
+        for category, pattern in CATEGORY_PATTERNS:
+            if text and pattern.search(text):
+                return category
+    return 'Other'
+
+
+def parse_amount(value):
+    text = (value or '').strip()
+    negative = text.startswith('(') and text.endswith(')')
+    text = re.sub(r'(?i)inr|rs\.?|dr|cr|[₹$€£,()\s]', '', text)
+    try:
+        amount = Decimal(text)
+    except InvalidOperation:
+        raise RowError(f"Invalid amount: {value!r}")
+    # Statements show money going out as negative or in brackets; an expense is always positive
+    amount = abs(-amount if negative else amount)
+    if not amount:
+        raise RowError("Amount is zero")
+    try:
+        return Expense._meta.get_field('amount').clean(amount, None)
+    except ValidationError as e:
+        raise RowError(f"Invalid amount {value!r}: {' '.join(e.messages)}")
+
+
+def parse_date(value):
+    text = (value or '').strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    raise RowError(f"Invalid date: {value!r}")
+
+
+def member_lookup(trip):
+    """{lower-case name or contact: member id}; names shared by several members map to None."""
+    lookup = {}
+    for member_id, name, contact in trip.companions.values_list('id', 'name', 'contact'):
+        for key in {(name or '').strip().lower(), (contact or '').strip().lower()} - {''}:
+            if key in lookup and lookup[key] != member_id:
+                lookup[key] = None
+            else:
+                lookup[key] = member_id
+    return lookup
+
+
+def resolve_member(lookup, value):
+    key = (value or '').strip().lower()
+    if not key:
+        return None
+    if key not in lookup:
+        raise RowError(f"Unknown member: {value!r}")
+    if lookup[key] is None:
+        raise RowError(f"Several members are called {value!r}; use their contact instead")
+    return lookup[key]
+
+
+def import_expenses(trip, stream, default_payer=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    Imports the CSV in `stream` (text file or iterable of lines) into `trip`.
+    default_payer (name or contact) is used for rows without a payer.
+    Raises ValueError when the header lacks a required column or the default payer is
+    unknown. Returns a report:
+    {'rows', 'created', 'skipped', 'failed', 'errors': [{'line', 'error'}], 'errors_not_shown'}
+    """
+    reader = csv.DictReader(stream)
+    columns = map_columns(reader.fieldnames)
+    lookup = member_lookup(trip)
+    try:
+        default_payer_id = resolve_member(lookup, default_payer)
+    except RowError as e:
+        raise ValueError(f"Default payer: {e}")
+
+    report = {'rows': 0, 'created': 0, 'skipped': 0, 'failed': 0, 'errors': [], 'errors_not_shown': 0}
+
+    def error(line, message):
+        report['failed'] += 1
+        if len(report['errors']) < MAX_REPORTED_ERRORS:
+            report['errors'].append({'line': line, 'error': message})
+        else:
+            report['errors_not_shown'] += 1
+
+    def flush(chunk):
+        if dry_run:
+            report['created'] += len(chunk)
+            return
+        try:
+            add_expenses(trip.pk, [expense for _, expense in chunk])
+            report['created'] += len(chunk)
+        except DatabaseError as e:
+            for line, _ in chunk:
+                error(line, f"Not saved: {e}")
+
+    def cell(row, field):
+        header = columns.get(field)
+        return row.get(header) if header else None
+
+    chunk = []
+    for row in reader:
+        report['rows'] += 1
+        line = reader.line_num
+        if not any((value or '').strip() for value in row.values() if isinstance(value, str)):
+            report['skipped'] += 1
+            continue
+        if not (cell(row, 'amount') or '').strip() and (cell(row, 'credit') or '').strip():
+            # Money coming in on a bank statement, not an expense
+            report['skipped'] += 1
+            continue
+
+        try:
+            title = (cell(row, 'title') or '').strip()
+            if not title:
+                raise RowError("Title is empty")
+            paid_by_id = resolve_member(lookup, cell(row, 'paid_by')) or default_payer_id
+            expense = Expense(
+                trip_id=trip.pk,
+                title=title[:TITLE_LENGTH],
+                amount=parse_amount(cell(row, 'amount')),
+                date=parse_date(cell(row, 'date')),
+                category=parse_category(cell(row, 'category'), title),
+                paid_by_id=paid_by_id,
+            )
+        except RowError as e:
+            error(line, str(e))
+            continue
+
+        chunk.append((line, expense))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return report
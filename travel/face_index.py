@@ -0,0 +1,264 @@
+# travel/face_index.py
+import glob
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .encodings import ENCODING_DIM, ENCODING_DTYPE, decode_encoding, read_segment, write_segment
+from .models import FaceGroup, PhotoFaceRelation, Trip
+
+# 0.45 is strict - prevents "Lookalike" glitches
+STRICT_MATCH_DISTANCE = getattr(settings, 'FACE_MATCH_STRICT_DISTANCE', 0.45)
+# Anything between strict and 0.65 becomes a merge suggestion
+MAYBE_MATCH_DISTANCE = getattr(settings, 'FACE_MATCH_MAYBE_DISTANCE', 0.65)
+# Webcam search is a little more forgiving than grouping
+SEARCH_MATCH_DISTANCE = getattr(settings, 'FACE_SEARCH_DISTANCE', 0.55)
+
+
+def bump_face_version(trip_id):
+    """
+    Marks the trip's face groups as changed. Call it after (or in the same transaction as)
+    any create, delete, merge or encoding update of a FaceGroup; cached indexes and segment
+    files of older versions are then ignored, and so are rendered trip pages (Trip.version).
+    """
+    Trip.objects.filter(pk=trip_id).update(face_version=F('face_version') + 1, version=F('version') + 1)
+
+
+@contextmanager
+def trip_face_lock(trip_id):
+    """
+    Transaction holding the trip's write lock, for reading the face index and writing
+    group assignments based on it. Workers on other trips are not blocked.
+
+    The lock is a no-op UPDATE of the trip row: a row lock until commit on PostgreSQL/MySQL,
+    the database write lock on SQLite (other writers wait up to the connection timeout).
+    """
+    with transaction.atomic():
+        Trip.objects.filter(pk=trip_id).update(face_version=F('face_version'))
+        yield
+
+
+def _segment_dir():
+    return getattr(settings, 'FACE_SEGMENT_ROOT', None)
+
+
+def _segment_path(trip_id, version):
+    return os.path.join(_segment_dir(), f"trip_{trip_id}_v{version}.seg")
+
+
+def _remove_old_segments(trip_id, keep_path):
+    for path in glob.glob(os.path.join(_segment_dir(), f"trip_{trip_id}_*.seg")):
+        if path != keep_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def discard_segments(trip_id):
+    """
+    Removes every segment file of the trip. Needed when a transaction that bumped its
+    face_version rolls back: segments written for the lost versions would otherwise be
+    read once the counter reaches those numbers again.
+    """
+    if _segment_dir():
+        _remove_old_segments(trip_id, None)
+
+
+class TripFaceIndex:
+    """
+    All representative encodings of one trip as a single (N, 128) float32 matrix,
+    plus the FaceGroup id of every row.
+
+    Load it once per photo, match every face against it with one vectorized
+    distance computation and append to it in place when a new group is created,
+    instead of decoding each FaceGroup for every detected face. The arrays it is
+    built from (e.g. a memory-mapped segment file) are only copied on the first append.
+    """
+
+    def __init__(self, trip_id, encodings=None, group_ids=None, version=None):
+        self.trip_id = trip_id
+        self.version = version
+        if encodings is None:
+            encodings = np.empty((0, ENCODING_DIM), dtype=ENCODING_DTYPE)
+        if group_ids is None:
+            group_ids = np.empty(0, dtype=np.int64)
+
+        self._matrix = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+        self._group_ids = np.asarray(group_ids, dtype=np.int64)
+        self._size = len(self._group_ids)
+
+    @classmethod
+    def load(cls, trip_id, version=None):
+        """
+        Build the index for a trip at its current face_version. With FACE_SEGMENT_ROOT set,
+        the segment file of that version is memory-mapped if present, and written from the
+        database otherwise.
+        """
+        if version is None:
+            version = Trip.objects.filter(pk=trip_id).values_list('face_version', flat=True).first() or 0
+
+        path = None
+        if _segment_dir():
+            path = _segment_path(trip_id, version)
+            segment = read_segment(path)
+            if segment is not None:
+                group_ids, matrix = segment
+                return cls(trip_id, matrix, group_ids, version=version)
+
+        index = cls.from_database(trip_id)
+        index.version = version
+        if path:
+            write_segment(path, index.group_ids, index.matrix)
+            _remove_old_segments(trip_id, path)
+        return index
+
+    @classmethod
+    def from_database(cls, trip_id):
+        """One query; every row is a zero-copy view until the final stack."""
+        rows = FaceGroup.objects.filter(trip_id=trip_id).order_by('id').values_list('id', 'representative_encoding')
+
+        group_ids = []
+        encodings = []
+        for group_id, raw in rows:
+            try:
+                encodings.append(decode_encoding(raw))
+            except ValueError:
+                continue
+            group_ids.append(group_id)
+
+        if not group_ids:
+            return cls(trip_id)
+        return cls(trip_id, np.vstack(encodings), group_ids)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    @property
+    def group_ids(self):
+        return self._group_ids[:self._size]
+
+    def append(self, group_id, encoding):
+        """Add a freshly created FaceGroup without reloading the whole trip."""
+        if self._size == len(self._group_ids):
+            # Grow geometrically so repeated appends stay amortized O(1)
+            capacity = max(16, self._size * 2)
+            matrix = np.empty((capacity, ENCODING_DIM), dtype=ENCODING_DTYPE)
+            matrix[:self._size] = self._matrix[:self._size]
+            group_ids = np.empty(capacity, dtype=np.int64)
+            group_ids[:self._size] = self._group_ids[:self._size]
+            self._matrix, self._group_ids = matrix, group_ids
+
+        self._matrix[self._size] = encoding
+        self._group_ids[self._size] = group_id
+        self._size += 1
+
+    def distances(self, encoding):
+        """Euclidean distance from `encoding` to every row (same as face_recognition.face_distance)."""
+        if not self._size:
+            return np.empty(0, dtype=ENCODING_DTYPE)
+        return np.linalg.norm(self.matrix - np.asarray(encoding, dtype=ENCODING_DTYPE), axis=1)
+
+    def distances_many(self, encodings):
+        """(F, N) distances from several query faces to every row."""
+        queries = np.asarray(encodings, dtype=ENCODING_DTYPE).reshape(-1, ENCODING_DIM)
+        if not self._size:
+            return np.empty((len(queries), 0), dtype=ENCODING_DTYPE)
+        return np.linalg.norm(self.matrix[None, :, :] - queries[:, None, :], axis=2)
+
+    def match(self, encoding, strict=STRICT_MATCH_DISTANCE, maybe=MAYBE_MATCH_DISTANCE):
+        """
+        Returns (strict_ids, maybe_ids), both ordered by distance (closest first).
+        strict_ids are groups within `strict`; maybe_ids are groups in (strict, maybe].
+        """
+        distances = self.distances(encoding)
+        if not len(distances):
+            return [], []
+
+        order = np.argsort(distances, kind='stable')
+        sorted_distances = distances[order]
+        sorted_ids = self.group_ids[order]
+
+        strict_end = np.searchsorted(sorted_distances, strict, side='right')
+        maybe_end = np.searchsorted(sorted_distances, maybe, side='right')
+        return sorted_ids[:strict_end].tolist(), sorted_ids[strict_end:maybe_end].tolist()
+
+
+# --- In-process cache of read-only indexes (face search) ---
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def get_trip_index(trip_id, version):
+    """
+    LRU-cached, read-only TripFaceIndex for `trip_id` at `version` (Trip.face_version).
+    A hit touches neither the database nor the disk. Never append to the returned index.
+    """
+    with _cache_lock:
+        cached = _cache.get(trip_id)
+        if cached is not None and cached.version == version:
+            _cache.move_to_end(trip_id)
+            return cached
+
+    index = TripFaceIndex.load(trip_id, version=version)
+
+    with _cache_lock:
+        _cache[trip_id] = index
+        _cache.move_to_end(trip_id)
+        while len(_cache) > getattr(settings, 'FACE_INDEX_CACHE_SIZE', 32):
+            _cache.popitem(last=False)
+    return index
+
+
+def rank_trip_photos(index, query_encodings, threshold=SEARCH_MATCH_DISTANCE, require_all=False):
+    """
+    Photos showing any (or, with require_all, every) query face, closest first.
+
+    Distances from all query faces to all groups come from one vectorized computation;
+    the photos of every matched group are then resolved with a single query.
+    Returns [{'photo_id', 'distance', 'face_group_ids'}].
+    """
+    distances = index.distances_many(query_encodings)
+    if not distances.size:
+        return []
+
+    hits = distances <= threshold
+    matched_columns = np.flatnonzero(hits.any(axis=0))
+    if not len(matched_columns):
+        return []
+
+    group_ids = index.group_ids[matched_columns].tolist()
+    group_distance = dict(zip(group_ids, distances[:, matched_columns].min(axis=0).tolist()))
+    group_faces = {
+        group_id: frozenset(np.flatnonzero(hits[:, column]).tolist())
+        for group_id, column in zip(group_ids, matched_columns.tolist())
+    }
+
+    photos = {}
+    for photo_id, group_id in PhotoFaceRelation.objects.filter(
+        face_group_id__in=group_ids
+    ).values_list('photo_id', 'face_group_id'):
+        entry = photos.setdefault(photo_id, {'distance': float('inf'), 'groups': set(), 'faces': set()})
+        entry['distance'] = min(entry['distance'], group_distance[group_id])
+        entry['groups'].add(group_id)
+        entry['faces'] |= group_faces[group_id]
+
+    face_count = len(distances)
+    ranked = [
+        {'photo_id': photo_id, 'distance': round(entry['distance'], 4), 'face_group_ids': sorted(entry['groups'])}
+        for photo_id, entry in photos.items()
+        if not require_all or len(entry['faces']) == face_count
+    ]
+    ranked.sort(key=lambda item: (item['distance'], item['photo_id']))
+    return ranked
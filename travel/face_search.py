@@ -0,0 +1,129 @@
+# travel/face_search.py
+"""
+Face detection + encoding for webcam searches, run in a pool of worker processes so
+the dlib work never blocks the web server's threads or event loop.
+
+No Django imports at module level: the pool's worker processes are spawned and only
+need numpy, Pillow and face_recognition.
+"""
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+face_recognition = None
+
+
+class SearchBusy(Exception):
+    """Every worker is busy and the queue is full (or the pool just died)."""
+
+
+def _init_search_worker():
+    # Importing face_recognition loads the dlib models; do it once per worker process
+    global face_recognition
+    import face_recognition as module
+    face_recognition = module
+
+
+def _warm_up():
+    return True
+
+
+def encode_query_image(data, all_faces=False):
+    """
+    Encodings of the faces in an uploaded image (bytes). With all_faces=False only the
+    largest face is used - in a webcam shot that is the person searching.
+    """
+    global face_recognition
+    if face_recognition is None:
+        _init_search_worker()
+
+    # PIL makes sure it's RGB and valid before passing it to face_recognition
+    with Image.open(io.BytesIO(data)) as pil_image:
+        image = np.array(pil_image.convert('RGB'))
+
+    # 'hog' is usually fine for frontal selfies
+    face_locations = face_recognition.face_locations(image, model="hog")
+    if not all_faces and face_locations:
+        face_locations = [max(face_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]))]
+
+    return [np.asarray(encoding, dtype=np.float32) for encoding in face_recognition.face_encodings(image, face_locations)]
+
+
+class SearchPool:
+    """
+    A ProcessPoolExecutor with a cap on searches in flight (running + queued).
+    submit() raises SearchBusy instead of letting the queue grow without bound.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    # Spawned, not forked: the server process may be running threads/an event loop
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_search_worker,
+                )
+            return self._executor
+
+    def warm_up(self):
+        """Starts every worker now, so the first searches don't pay for the dlib import."""
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_warm_up)
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise SearchBusy()
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset(executor)
+            raise SearchBusy()
+
+        # The slot is only free again once the worker is done, even if the request timed out
+        future.add_done_callback(lambda done: self._finished(executor, done))
+        return future
+
+    def _finished(self, executor, future):
+        self._slots.release()
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._reset(executor)
+
+    def _reset(self, broken_executor):
+        # A worker crashed (e.g. out of memory); the next search starts a fresh pool
+        with self._lock:
+            if self._executor is broken_executor:
+                self._executor = None
+        broken_executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_search_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from django.conf import settings
+            _pool = SearchPool(
+                workers=getattr(settings, 'FACE_SEARCH_WORKERS', 2),
+                max_pending=getattr(settings, 'FACE_SEARCH_MAX_PENDING', 8),
+            )
+        return _pool
@@ -0,0 +1,156 @@
+# travel/forecast.py
+"""
+Budget forecast of a trip: spend so far, where it is heading and how much can still
+be spent per day, overall and per category.
+
+The spend series (days x categories) is built from the expense rollups with one
+grouped query and everything after that is NumPy:
+
+- mean: spend so far / days passed (the old "current spending speed")
+- ewma: exponentially weighted average of the daily spend, so the last few days count
+  most. Projection = spend so far + ewma * days remaining
+- trend: least-squares line through the daily spend, summed over the remaining days
+  (never below zero). Needs at least two days of data
+
+Results are cached per trip until its expenses change (Trip.expense_version).
+"""
+import threading
+from collections import OrderedDict
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Sum
+
+from .models import TripExpenseRollup
+
+# Span (in days) of the exponentially weighted average
+EWMA_SPAN = getattr(settings, 'FORECAST_EWMA_SPAN', 3)
+
+
+def spend_series(trip):
+    """
+    (days, categories, matrix): spend per trip day (rows) and category (columns).
+    Expenses dated before/after the trip count on its first/last day.
+    """
+    rows = list(
+        trip.expense_rollups.filter(kind=TripExpenseRollup.EXPENSE).order_by()
+        .values_list('date', 'category').annotate(amount=Sum('total'))
+    )
+    total_days = max((trip.end_date - trip.start_date).days + 1, 1)
+    categories = sorted({category or "Other" for _, category, _ in rows})
+    matrix = np.zeros((total_days, len(categories)))
+    if rows:
+        columns = {category: n for n, category in enumerate(categories)}
+        day_index = np.clip([(day - trip.start_date).days for day, _, _ in rows], 0, total_days - 1)
+        category_index = [columns[category or "Other"] for _, category, _ in rows]
+        np.add.at(matrix, (day_index, category_index), [float(amount) for _, _, amount in rows])
+    return total_days, categories, matrix
+
+
+def _ewma(daily, span):
+    """Exponentially weighted mean of each column, most recent row weighted highest."""
+    alpha = 2 / (span + 1)
+    weights = (1 - alpha) ** np.arange(len(daily))[::-1]
+    return weights @ daily / weights.sum()
+
+
+def _trend(daily, days_remaining):
+    """Spend over the next `days_remaining` days following each column's linear trend."""
+    days_passed = len(daily)
+    if days_passed < 2 or not days_remaining:
+        return None
+    slope, intercept = np.polyfit(np.arange(days_passed), daily, 1)
+    future = np.arange(days_passed, days_passed + days_remaining)[:, None]
+    return np.clip(intercept + slope * future, 0, None).sum(axis=0)
+
+
+def compute_forecast(trip, today=None):
+    today = today or date.today()
+    total_days, categories, matrix = spend_series(trip)
+
+    if today < trip.start_date:
+        days_passed = 0
+    elif today > trip.end_date:
+        days_passed = total_days
+    else:
+        days_passed = (today - trip.start_date).days + 1
+    days_remaining = total_days - days_passed
+
+    spent = matrix.sum(axis=0)
+    daily = matrix[:days_passed]
+    if days_passed:
+        daily_avg = spent / days_passed
+        ewma_projection = spent + _ewma(daily, EWMA_SPAN) * days_remaining
+    else:
+        daily_avg = np.zeros(len(categories))
+        ewma_projection = spent.copy()
+    trend_future = _trend(daily, days_remaining)
+    trend_projection = spent + trend_future if trend_future is not None else ewma_projection
+
+    budget = float(trip.budget)
+    total_spent = spent.sum()
+    # Whatever budget is left is shared among categories in proportion to what they cost so far
+    shares = spent / total_spent if total_spent else np.full(len(categories), 1 / max(len(categories), 1))
+    remaining_budget = budget - total_spent
+    if days_remaining:
+        safe_daily_limit = remaining_budget / days_remaining
+        category_limits = np.clip(remaining_budget * shares, 0, None) / days_remaining
+    else:
+        safe_daily_limit = 0.0
+        category_limits = np.zeros(len(categories))
+
+    projected_total = float(ewma_projection.sum())
+    if budget > 0:
+        # Either projection going over is enough for a warning
+        over = max(projected_total, float(trend_projection.sum())) > budget
+        budget_status = "Likely to Exceed Budget" if over else "On Track"
+    else:
+        budget_status = "No Budget Set"
+
+    return {
+        'days_passed': days_passed,
+        'days_remaining': days_remaining,
+        'daily_avg': float(daily_avg.sum()),
+        'projected_total': projected_total,
+        'trend_total': float(trend_projection.sum()),
+        'safe_daily_limit': safe_daily_limit if budget > 0 else 0.0,
+        'budget_status': budget_status,
+        'categories': [
+            {
+                'category': category,
+                'spent': float(spent[n]),
+                'daily_avg': float(daily_avg[n]),
+                'projected': float(ewma_projection[n]),
+                'trend': float(trend_projection[n]),
+                'safe_daily_limit': float(category_limits[n]) if budget > 0 else 0.0,
+            }
+            for n, category in enumerate(categories)
+        ],
+    }
+
+
+# --- In-process cache, keyed on everything the forecast depends on ---
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def trip_forecast(trip, today=None):
+    """compute_forecast(trip), cached until the trip's expenses, dates or budget change (or the day does)."""
+    today = today or date.today()
+    key = (trip.pk, trip.expense_version, trip.start_date, trip.end_date, trip.budget, today)
+    with _cache_lock:
+        cached = _cache.get(trip.pk)
+        if cached is not None and cached[0] == key:
+            _cache.move_to_end(trip.pk)
+            return cached[1]
+
+    forecast = compute_forecast(trip, today)
+
+    with _cache_lock:
+        _cache[trip.pk] = (key, forecast)
+        _cache.move_to_end(trip.pk)
+        while len(_cache) > getattr(settings, 'FORECAST_CACHE_SIZE', 256):
+            _cache.popitem(last=False)
+    return forecast
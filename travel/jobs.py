@@ -0,0 +1,112 @@
+# travel/jobs.py
+import traceback
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import FaceProcessingJob
+from .renditions import create_photo_renditions
+from .trip_cache import bump_trip_version
+from .utils import process_photo_faces
+
+
+def enqueue_photos(photos):
+    """Queue face processing for freshly uploaded photos (one job per photo)."""
+    jobs = [FaceProcessingJob(photo=photo) for photo in photos]
+    return FaceProcessingJob.objects.bulk_create(jobs)
+
+
+def requeue_photo(photo):
+    """Put an existing photo back in the queue, e.g. after a failed run."""
+    job, _ = FaceProcessingJob.objects.update_or_create(
+        photo=photo,
+        defaults={
+            'status': FaceProcessingJob.PENDING,
+            'last_error': None,
+            'started_at': None,
+            'finished_at': None,
+        }
+    )
+    bump_trip_version(photo.trip_id)
+    return job
+
+
+def pending_job_ids(limit=None):
+    ids = FaceProcessingJob.objects.filter(
+        status=FaceProcessingJob.PENDING
+    ).order_by('created_at').values_list('id', flat=True)
+    return list(ids[:limit] if limit else ids)
+
+
+def requeue_stale_jobs(older_than_seconds):
+    """Jobs left 'running' by a worker that died are handed back to the queue."""
+    cutoff = timezone.now() - timedelta(seconds=older_than_seconds)
+    stale = FaceProcessingJob.objects.filter(
+        status=FaceProcessingJob.RUNNING,
+        started_at__lt=cutoff
+    )
+    trip_ids = set(stale.values_list('photo__trip_id', flat=True))
+    requeued = stale.update(status=FaceProcessingJob.PENDING)
+    for trip_id in trip_ids:
+        bump_trip_version(trip_id)
+    return requeued
+
+
+def claim_job(job_id):
+    """
+    Atomically moves a job from pending to running. The conditional UPDATE works the
+    same on SQLite and server databases, so two workers can never claim the same job.
+    """
+    claimed = FaceProcessingJob.objects.filter(
+        pk=job_id,
+        status=FaceProcessingJob.PENDING
+    ).update(
+        status=FaceProcessingJob.RUNNING,
+        attempts=F('attempts') + 1,
+        started_at=timezone.now(),
+        finished_at=None
+    )
+    if not claimed:
+        return False
+    # The photos tab shows each job's status
+    bump_trip_version(FaceProcessingJob.objects.filter(pk=job_id).values_list('photo__trip_id', flat=True).get())
+    return True
+
+
+def run_job(job_id, max_attempts=3):
+    """
+    Claims and runs one job. Returns the final status, or None if another worker
+    already took it. Failed jobs go back to pending until max_attempts is reached.
+    """
+    if not claim_job(job_id):
+        return None
+
+    job = FaceProcessingJob.objects.select_related('photo').get(pk=job_id)
+
+    # Grid/lightbox renditions are a by-product of ingest; a failure here must not block face grouping
+    try:
+        create_photo_renditions(job.photo)
+    except Exception as e:
+        print(f"Could not create renditions for photo {job.photo_id}: {e}")
+
+    try:
+        process_photo_faces(job.photo_id, raise_errors=True)
+    except Exception:
+        status = FaceProcessingJob.FAILED if job.attempts >= max_attempts else FaceProcessingJob.PENDING
+        FaceProcessingJob.objects.filter(pk=job_id).update(
+            status=status,
+            last_error=traceback.format_exc(),
+            finished_at=timezone.now()
+        )
+        # The photos tab shows each job's status
+        bump_trip_version(job.photo.trip_id)
+        return status
+
+    FaceProcessingJob.objects.filter(pk=job_id).update(
+        status=FaceProcessingJob.DONE,
+        last_error=None,
+        finished_at=timezone.now()
+    )
+    bump_trip_version(job.photo.trip_id)
+    return FaceProcessingJob.DONE
@@ -0,0 +1,101 @@
+# travel/ledger.py
+"""
+Money figures of a trip for the expense splitter and the PDF report.
+
+Everything is summed from the trip's TripExpenseRollup rows (see travel/rollups.py)
+with grouped SQL aggregates, so the work grows with the number of categories, members
+and days, not with the number of expenses. Amounts stay Decimal throughout.
+"""
+from decimal import Decimal
+
+from django.db.models import Sum
+
+from .models import TripExpenseRollup
+from .settlement import from_minor_units, settle, split_evenly, to_minor_units
+
+ZERO = Decimal('0')
+CENT = Decimal('0.01')
+
+
+def _totals_by(queryset, field):
+    """{value of `field`: Sum('total')} in one grouped query."""
+    # Amounts have 2 decimal places; SQLite sums them as floats, so round back to cents
+    return {
+        key: total.quantize(CENT)
+        for key, total in queryset.order_by().values_list(field).annotate(amount=Sum('total'))
+    }
+
+
+class TripLedger:
+    """
+    Per-member paid / received / balance figures of one trip.
+
+    balance > 0: the member is owed money; balance < 0: the member owes money.
+    Settlements count for the payer as money paid and against the payee as money received.
+    """
+
+    def __init__(self, trip):
+        self.trip = trip
+        self.members = list(trip.companions.all())
+
+        self.expense_rollups = trip.expense_rollups.filter(kind=TripExpenseRollup.EXPENSE)
+        settlement_rollups = trip.expense_rollups.filter(kind=TripExpenseRollup.SETTLEMENT)
+
+        self.paid_by_member = _totals_by(self.expense_rollups, 'member')
+        self.payments_made = _totals_by(settlement_rollups, 'member')
+        self.payments_received = _totals_by(settlement_rollups, 'payee')
+
+        # Includes expenses without a payer (paid_by is None)
+        self.total_expense = sum(self.paid_by_member.values(), ZERO)
+        self.share_per_person = self.total_expense / len(self.members) if self.members else ZERO
+
+    def category_totals(self):
+        """{category: total}, with uncategorised expenses counted as "Other"."""
+        totals = {}
+        for category, total in _totals_by(self.expense_rollups, 'category').items():
+            category = category or "Other"
+            totals[category] = totals.get(category, ZERO) + total
+        return totals
+
+    def member_balances(self):
+        balances = []
+        for member in self.members:
+            paid = self.paid_by_member.get(member.pk, ZERO)
+            made = self.payments_made.get(member.pk, ZERO)
+            received = self.payments_received.get(member.pk, ZERO)
+
+            adjusted_paid = paid + made - received
+            balance = adjusted_paid - self.share_per_person
+            balances.append({
+                'member': member,
+                'paid': paid,
+                'payments_made': made,
+                'payments_received': received,
+                'adjusted_paid': adjusted_paid,
+                'balance': balance,
+                'abs_balance': abs(balance),
+            })
+        return balances
+
+    def minor_unit_balances(self):
+        """
+        {member: balance in minor units} for the settlement engine. The total is split
+        into whole-unit shares that add up to it exactly.
+        """
+        shares = split_evenly(to_minor_units(self.total_expense), len(self.members))
+        balances = {}
+        for member, share in zip(self.members, shares):
+            adjusted_paid = (
+                self.paid_by_member.get(member.pk, ZERO)
+                + self.payments_made.get(member.pk, ZERO)
+                - self.payments_received.get(member.pk, ZERO)
+            )
+            balances[member] = to_minor_units(adjusted_paid) - share
+        return balances
+
+    def suggested_settlements(self):
+        """Fewest payments that settle every balance: [{'from', 'to', 'amount'}]."""
+        return [
+            {'from': debtor.name, 'to': creditor.name, 'amount': from_minor_units(amount)}
+            for debtor, creditor, amount in settle(self.minor_unit_balances())
+        ]
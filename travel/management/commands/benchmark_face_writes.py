@@ -0,0 +1,134 @@
+import random
+import statistics
+import time
+import uuid
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from travel.encodings import encode_encoding
+from travel.face_index import bump_face_version
+from travel.models import FaceGroup, FaceMergeSuggestion, PhotoFaceRelation, Trip, TripPhoto
+from travel.utils import write_photo_faces
+
+
+def _make_plan(photos, faces_per_photo, new_ratio, maybe_per_face, seed):
+    """
+    Grouping outcome for every face of every photo, identical for both write paths:
+    ('new', [group numbers to suggest]) or ('match', group number). Only groups from
+    earlier photos are referenced.
+    """
+    rng = random.Random(seed)
+    plan = []
+    groups = 0
+    for _ in range(photos):
+        faces = []
+        for _ in range(faces_per_photo):
+            if groups == 0 or rng.random() < new_ratio:
+                faces.append(('new', rng.sample(range(groups), min(groups, maybe_per_face))))
+            else:
+                faces.append(('match', rng.randrange(groups)))
+        groups += sum(1 for kind, _ in faces if kind == 'new')
+        plan.append(faces)
+    return plan
+
+
+def _write_per_row(photo, faces, group_ids, encoding):
+    """The previous ingest path: one autocommitted statement per row."""
+    for face_number, (kind, ref) in enumerate(faces):
+        if kind == 'new':
+            group = FaceGroup.objects.create(trip_id=photo.trip_id, representative_encoding=encode_encoding(encoding))
+            bump_face_version(photo.trip_id)
+            for number in ref:
+                FaceMergeSuggestion.objects.get_or_create(
+                    trip_id=photo.trip_id, group_a_id=group_ids[number], group_b=group
+                )
+            group_ids.append(group.id)
+            group_id = group.id
+        else:
+            group_id = group_ids[ref]
+        PhotoFaceRelation.objects.create(
+            photo=photo, face_number=face_number, face_group_id=group_id, encoding=encode_encoding(encoding)
+        )
+
+
+def _write_batched(photo, faces, group_ids, encoding):
+    new_groups, assignments, suggestion_pairs = [], [], []
+    for kind, ref in faces:
+        if kind == 'new':
+            new_groups.append(FaceGroup(trip_id=photo.trip_id, representative_encoding=encode_encoding(encoding)))
+            group_id = -len(new_groups)
+            suggestion_pairs.extend((group_ids[number], group_id) for number in ref)
+        else:
+            group_id = group_ids[ref]
+        assignments.append((group_id, encoding))
+    write_photo_faces(photo, new_groups, assignments, suggestion_pairs)
+    group_ids.extend(group.id for group in new_groups)
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the database writes of face ingest per photo: one statement per row in "
+        "autocommit mode versus one transaction with bulk inserts. Runs on throwaway trips "
+        "in the configured database and removes them afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--photos', type=int, default=200)
+        parser.add_argument('--faces', type=int, default=4, help="Faces per photo.")
+        parser.add_argument('--new-ratio', type=float, default=0.3,
+                            help="Share of faces that start a new face group.")
+        parser.add_argument('--maybe', type=int, default=2, help="Merge suggestions per new face group.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        plan = _make_plan(options['photos'], options['faces'], options['new_ratio'], options['maybe'], options['seed'])
+        encoding = np.random.default_rng(options['seed']).random(128)
+
+        user = get_user_model().objects.create(username=f"benchmark-{uuid.uuid4().hex[:12]}")
+        try:
+            results = {}
+            for label, writer in (('per-row', _write_per_row), ('batched', _write_batched)):
+                trip = Trip.objects.create(
+                    user=user, name=f"Benchmark ({label})", destination="-",
+                    start_date='2000-01-01', end_date='2000-01-01'
+                )
+                photos = TripPhoto.objects.bulk_create(
+                    [TripPhoto(trip=trip, image=f"benchmark/{n}.jpg") for n in range(len(plan))]
+                )
+                group_ids = []
+                timings = []
+                queries = [0]
+
+                def count_queries(execute, sql, params, many, context):
+                    queries[0] += 1
+                    return execute(sql, params, many, context)
+
+                with connection.execute_wrapper(count_queries):
+                    for photo, faces in zip(photos, plan):
+                        started = time.perf_counter()
+                        writer(photo, faces, group_ids, encoding)
+                        timings.append(time.perf_counter() - started)
+                results[label] = timings
+                self._report(label, timings, queries[0])
+        finally:
+            # Cascades to the benchmark trips and everything in them
+            user.delete()
+
+        before = statistics.mean(results['per-row'])
+        after = statistics.mean(results['batched'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Mean write time per photo: {before * 1000:.2f} ms -> {after * 1000:.2f} ms "
+            f"({before / after:.1f}x faster)"
+        ))
+
+    def _report(self, label, timings, queries):
+        timings_ms = sorted(t * 1000 for t in timings)
+        p95 = timings_ms[min(len(timings_ms) - 1, int(len(timings_ms) * 0.95))]
+        self.stdout.write(
+            f"{label:8} mean {statistics.mean(timings_ms):7.2f} ms  "
+            f"median {statistics.median(timings_ms):7.2f} ms  p95 {p95:7.2f} ms  "
+            f"{queries / len(timings):.1f} queries/photo"
+        )
@@ -0,0 +1,234 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import uuid
+
+import django
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from PIL import Image
+
+from travel.encodings import ENCODING_DIM, encode_encoding
+from travel.face_index import TripFaceIndex, rank_trip_photos
+from travel.models import FaceGroup, PhotoFaceRelation, Trip, TripPhoto
+from travel.utils import assign_photo_faces, crop_face, face_sharpness, load_detection_frame, load_full_image
+
+# Synthetic test images: name -> (width, height)
+IMAGE_SIZES = {
+    'webcam': (640, 480),
+    'phone': (4032, 3024),
+    'camera': (6000, 4000),
+}
+
+
+def _timed(fn, repeat):
+    """Runs fn `repeat` times; milliseconds per run."""
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        runs.append((time.perf_counter() - started) * 1000)
+    runs.sort()
+    return {
+        'runs': repeat,
+        'mean_ms': round(statistics.mean(runs), 3),
+        'median_ms': round(statistics.median(runs), 3),
+        'p95_ms': round(runs[min(repeat - 1, int(repeat * 0.95))], 3),
+    }
+
+
+def synthetic_encodings(people, per_person, seed=0):
+    """
+    Random 128-d clusters shaped like dlib encodings: people ~1.4 apart,
+    faces of the same person ~0.25 from each other (strict match is 0.45).
+    Returns (centers, faces) with faces grouped per person.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.09, (people, ENCODING_DIM))
+    faces = centers[:, None, :] + rng.normal(0, 0.015, (people, per_person, ENCODING_DIM))
+    return centers.astype(np.float32), faces.astype(np.float32)
+
+
+def synthetic_image(path, width, height, seed=0):
+    """A JPEG with smooth gradients and sensor-like noise, so it decodes like a real photo."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width, y / height, (x + y) / (width + height)], axis=-1) * 200
+    pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype('uint8')
+    Image.fromarray(pixels).save(path, format='JPEG', quality=90)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the face pipeline offline: image decode, detection, encoding, matching and "
+        "database writes, timed separately for trips of growing size. Prints JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--groups', default='10,100,1000,5000',
+                            help="Comma-separated trip sizes (face groups) for matching and writes.")
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per measurement.")
+        parser.add_argument('--photos', type=int, default=20,
+                            help="Photos (3 faces each) written per trip size.")
+        parser.add_argument('--images', help="Directory of JPEGs to use instead of the synthetic images.")
+        parser.add_argument('--output', help="Write the JSON to this file instead of stdout.")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            import face_recognition
+        except ImportError:
+            face_recognition = None
+
+        report = {
+            'meta': {
+                'commit': _git_commit(),
+                'timestamp': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'numpy': np.__version__,
+                'database': connection.vendor,
+                'face_recognition': getattr(face_recognition, '__version__', None) if face_recognition else None,
+                'repeat': options['repeat'],
+            },
+        }
+
+        with tempfile.TemporaryDirectory() as workdir:
+            report['images'] = self._image_stages(face_recognition, workdir, options)
+            # Segment files of the throwaway trips must not end up next to the real ones
+            with override_settings(FACE_SEGMENT_ROOT=os.path.join(workdir, 'segments')):
+                report['trips'] = self._trip_stages(options)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Benchmark written to {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    # --- Per image: decode, detection, quality gate, encoding ---
+
+    def _image_stages(self, face_recognition, workdir, options):
+        if options['images']:
+            paths = {
+                name: os.path.join(options['images'], name)
+                for name in sorted(os.listdir(options['images']))
+                if name.lower().endswith(('.jpg', '.jpeg'))
+            }
+        else:
+            paths = {}
+            for name, (width, height) in IMAGE_SIZES.items():
+                paths[name] = os.path.join(workdir, f"{name}.jpg")
+                synthetic_image(paths[name], width, height, seed=options['seed'])
+
+        repeat = options['repeat']
+        max_side = getattr(settings, 'FACE_DETECTION_MAX_SIDE', None)
+        results = {}
+        for name, path in paths.items():
+            frame, _, _ = load_detection_frame(path, max_side)
+            full_image = load_full_image(path)
+            # A face-sized box in the middle of the photo
+            side = max(80, min(full_image.size) // 6)
+            top, left = (full_image.height - side) // 2, (full_image.width - side) // 2
+            box = (top, left + side, top + side, left)
+            crop, crop_box = crop_face(full_image, box)
+
+            stages = {
+                'size': list(full_image.size),
+                'decode_full': _timed(lambda: load_full_image(path), repeat),
+                'decode_detection_frame': _timed(lambda: load_detection_frame(path, max_side), repeat),
+                'quality_gate_sharpness': _timed(lambda: face_sharpness(crop, crop_box), repeat),
+            }
+            if face_recognition is not None:
+                frame_array = np.ascontiguousarray(np.array(frame, dtype='uint8'))
+                stages['detection'] = _timed(lambda: face_recognition.face_locations(frame_array, model='hog'), repeat)
+                stages['encoding'] = _timed(lambda: face_recognition.face_encodings(crop, [crop_box]), repeat)
+            else:
+                stages['skipped'] = "face_recognition is not installed: no detection/encoding timings"
+            results[name] = stages
+        return results
+
+    # --- Per trip size: index load, matching, search, DB writes ---
+
+    def _trip_stages(self, options):
+        sizes = [int(size) for size in options['groups'].split(',') if size.strip()]
+        repeat = options['repeat']
+        user = get_user_model().objects.create(username=f"benchmark-{uuid.uuid4().hex[:12]}")
+        results = {}
+        try:
+            for size in sizes:
+                centers, faces = synthetic_encodings(size, 4, seed=options['seed'])
+                trip = self._make_trip(user, centers)
+                queries = faces[:, 1]
+                rng = np.random.default_rng(options['seed'])
+
+                def pick_query():
+                    return queries[rng.integers(len(queries))]
+
+                index = TripFaceIndex.load(trip.id)
+                stages = {
+                    'index_from_database': _timed(lambda: TripFaceIndex.from_database(trip.id), repeat),
+                    'index_from_segment': _timed(lambda: TripFaceIndex.load(trip.id), repeat),
+                    'match_one_face': _timed(lambda: index.match(pick_query()), repeat * 5),
+                    'search_ranking': _timed(lambda: rank_trip_photos(index, [pick_query()]), repeat),
+                }
+
+                # Each new photo shows two known people and one newcomer
+                photos = TripPhoto.objects.bulk_create(
+                    [TripPhoto(trip=trip, image=f"benchmark/new_{n}.jpg") for n in range(options['photos'])]
+                )
+                _, newcomers = synthetic_encodings(len(photos), 1, seed=options['seed'] + 1)
+                photo_faces = [
+                    [faces[n % size, 2], faces[(n * 7 + 1) % size, 3], newcomers[n, 0]]
+                    for n in range(len(photos))
+                ]
+                pending = list(zip(photos, photo_faces))
+                stages['assign_and_write_photo'] = _timed(
+                    lambda: assign_photo_faces(*pending.pop()), len(pending)
+                )
+                results[str(size)] = stages
+                self.stderr.write(f"{size} face groups done")
+        finally:
+            # Cascades to the benchmark trips and everything in them
+            user.delete()
+        return results
+
+    def _make_trip(self, user, centers):
+        trip = Trip.objects.create(
+            user=user, name=f"Benchmark ({len(centers)} people)", destination="-",
+            start_date='2000-01-01', end_date='2000-01-01'
+        )
+        groups = FaceGroup.objects.bulk_create(
+            [FaceGroup(trip=trip, representative_encoding=encode_encoding(center)) for center in centers]
+        )
+        # Two tagged photos per person
+        photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=trip, image=f"benchmark/{n}.jpg") for n in range(len(groups) * 2)]
+        )
+        PhotoFaceRelation.objects.bulk_create([
+            PhotoFaceRelation(
+                photo=photo, face_number=0, face_group=groups[n // 2], encoding=encode_encoding(centers[n // 2])
+            )
+            for n, photo in enumerate(photos)
+        ])
+        return trip
@@ -0,0 +1,90 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from travel.settlement import EXACT_LIMIT, exact_transfers, greedy_transfers
+
+
+def random_balances(members, rng, step, max_amount=500000):
+    """
+    Balances in minor units that add up to zero. Real trips are full of round amounts
+    (equal shares, whole-rupee expenses), so values are multiples of `step`.
+    """
+    amounts = [rng.randint(-max_amount // step, max_amount // step) * step for _ in range(members - 1)]
+    amounts.append(-sum(amounts))
+    return {f"member {n}": amount for n, amount in enumerate(amounts)}
+
+
+def list_order_transfers(balances):
+    """The previous splitter: debtors and creditors paired in list order, unsorted."""
+    debtors = [[key, -amount] for key, amount in balances.items() if amount < 0]
+    creditors = [[key, amount] for key, amount in balances.items() if amount > 0]
+    transfers = []
+    d_idx, c_idx = 0, 0
+    while d_idx < len(debtors) and c_idx < len(creditors):
+        amount = min(debtors[d_idx][1], creditors[c_idx][1])
+        transfers.append((debtors[d_idx][0], creditors[c_idx][0], amount))
+        debtors[d_idx][1] -= amount
+        creditors[c_idx][1] -= amount
+        if debtors[d_idx][1] == 0: d_idx += 1
+        if creditors[c_idx][1] == 0: c_idx += 1
+    return transfers
+
+
+def _measure(fn, balances, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        transfers = fn(balances)
+    return {'transfers': len(transfers), 'ms': round((time.perf_counter() - started) * 1000 / repeat, 3)}
+
+
+class Command(BaseCommand):
+    help = "Compares settlement plans (list order, greedy heaps, exact) for groups of growing size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='3,5,8,12,14,50,100,250,500',
+                            help="Comma-separated group sizes (members).")
+        parser.add_argument('--trials', type=int, default=20, help="Random groups per size.")
+        parser.add_argument('--repeat', type=int, default=5, help="Timed runs per group.")
+        parser.add_argument('--exact-limit', type=int, default=EXACT_LIMIT,
+                            help="Largest group the exact search is run for.")
+        parser.add_argument('--step', type=int, default=10000,
+                            help="Balances are multiples of this many minor units (1 = arbitrary amounts).")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help="Print the raw numbers as JSON.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        strategies = [('list_order', list_order_transfers), ('greedy', greedy_transfers), ('exact', exact_transfers)]
+        results = {}
+
+        for size in [int(size) for size in options['sizes'].split(',') if size.strip()]:
+            totals = {}
+            for _ in range(options['trials']):
+                balances = random_balances(size, rng, options['step'])
+                for name, fn in strategies:
+                    if name == 'exact' and size > options['exact_limit']:
+                        continue
+                    measured = _measure(fn, balances, options['repeat'])
+                    entry = totals.setdefault(name, {'transfers': 0, 'ms': 0})
+                    entry['transfers'] += measured['transfers']
+                    entry['ms'] += measured['ms']
+
+            results[size] = {
+                name: {
+                    'avg_transfers': round(entry['transfers'] / options['trials'], 2),
+                    'avg_ms': round(entry['ms'] / options['trials'], 3),
+                }
+                for name, entry in totals.items()
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'members':>8}  {'strategy':<11} {'transfers':>10} {'ms':>10}")
+        for size, strategies_result in results.items():
+            for name, entry in strategies_result.items():
+                self.stdout.write(f"{size:>8}  {name:<11} {entry['avg_transfers']:>10} {entry['avg_ms']:>10}")
@@ -0,0 +1,57 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from travel.expense_import import CHUNK_SIZE, import_expenses, text_stream
+from travel.models import Trip
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports expenses into a trip from a CSV file (own export or bank statement). "
+        "The file is streamed and written in chunks; rows that can't be imported are reported."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('trip', type=int, help="Trip id")
+        parser.add_argument('file', help="CSV file ('-' for stdin)")
+        parser.add_argument('--paid-by', help="Member name or contact for rows without a payer.")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows per bulk insert/transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Only validate the rows, don't save anything.")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        try:
+            trip = Trip.objects.get(pk=options['trip'])
+        except Trip.DoesNotExist:
+            raise CommandError(f"Trip {options['trip']} does not exist")
+
+        try:
+            if options['file'] == '-':
+                report = self._import(trip, text_stream(sys.stdin.buffer), options)
+            else:
+                with open(options['file'], 'rb') as fh:
+                    report = self._import(trip, text_stream(fh), options)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        for entry in report['errors']:
+            self.stdout.write(f"Line {entry['line']}: {entry['error']}")
+        if report['errors_not_shown']:
+            self.stdout.write(f"... and {report['errors_not_shown']} more errors")
+        verb = "Would import" if options['dry_run'] else "Imported"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {report['created']} of {report['rows']} rows "
+            f"({report['skipped']} skipped, {report['failed']} with errors)"
+        ))
+
+    def _import(self, trip, stream, options):
+        return import_expenses(
+            trip, stream, default_payer=options['paid_by'], chunk_size=options['chunk_size'],
+            dry_run=options['dry_run']
+        )
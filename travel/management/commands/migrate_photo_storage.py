@@ -0,0 +1,79 @@
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from travel.models import ImageRendition, PhotoBlob, TripPhoto
+from travel.photo_store import blob_name, hash_file, recount_references
+
+
+class Command(BaseCommand):
+    help = "Moves photos uploaded before content addressing into shared, hash-named files."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        moved = shared = missing = in_trip_duplicates = 0
+        seen = set()
+
+        for photo in TripPhoto.objects.filter(content_hash='').order_by('id').iterator():
+            old_name = photo.image.name
+            if not old_name or not default_storage.exists(old_name):
+                missing += 1
+                self.stdout.write(self.style.WARNING(f"Photo {photo.pk}: file {old_name!r} is missing, skipped."))
+                continue
+
+            with default_storage.open(old_name, 'rb') as fh:
+                digest = hash_file(fh)
+            if (photo.trip_id, digest) in seen or TripPhoto.objects.filter(trip_id=photo.trip_id, content_hash=digest).exists():
+                in_trip_duplicates += 1
+            seen.add((photo.trip_id, digest))
+
+            if dry_run:
+                moved += 1
+                continue
+
+            new_name = blob_name(digest, old_name)
+            with transaction.atomic():
+                blob, created = PhotoBlob.objects.get_or_create(
+                    sha256=digest,
+                    defaults={'name': new_name, 'size': default_storage.size(old_name)}
+                )
+                if not default_storage.exists(blob.name):
+                    with default_storage.open(old_name, 'rb') as fh:
+                        saved_name = default_storage.save(blob.name, fh)
+                    if saved_name != blob.name:
+                        PhotoBlob.objects.filter(pk=blob.pk).update(name=saved_name)
+                        blob.name = saved_name
+                else:
+                    shared += 1
+                PhotoBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+
+                TripPhoto.objects.filter(pk=photo.pk).update(image=blob.name, content_hash=digest)
+
+                # Keep already generated renditions unless the shared file has its own
+                if ImageRendition.objects.filter(source=blob.name).exists():
+                    stale = list(ImageRendition.objects.filter(source=old_name))
+                    for rendition in stale:
+                        rendition.file.delete(save=False)
+                    ImageRendition.objects.filter(source=old_name).delete()
+                else:
+                    ImageRendition.objects.filter(source=old_name).update(source=blob.name)
+
+            if old_name != blob.name:
+                default_storage.delete(old_name)
+            moved += 1
+
+        if not dry_run:
+            fixed = recount_references()
+            if fixed:
+                self.stdout.write(f"Corrected the reference count of {fixed} file(s).")
+
+        self.stdout.write(
+            f"{moved} photo(s) {'would be ' if dry_run else ''}moved, {shared} already stored under another "
+            f"photo, {missing} missing, {in_trip_duplicates} exact duplicate(s) within a trip."
+        )
@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from travel.photo_store import storage_report
+
+
+def _megabytes(value):
+    return f"{value / (1024 * 1024):.1f} MB"
+
+
+class Command(BaseCommand):
+    help = "Reports the storage and face-processing time saved by content-addressed photos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help="Print the raw numbers as JSON.")
+
+    def handle(self, *args, **options):
+        report = storage_report()
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(f"Stored files:             {report['blobs']} ({_megabytes(report['stored_bytes'])})")
+        self.stdout.write(f"Shared by several photos: {_megabytes(report['shared_bytes_saved'])} saved")
+        self.stdout.write(
+            f"Duplicate uploads:        {report['duplicate_uploads']} "
+            f"({_megabytes(report['duplicate_bytes_saved'])} saved)"
+        )
+        self.stdout.write(f"Face processing saved:    {report['cpu_seconds_saved']:.1f} CPU-seconds")
+        self.stdout.write(self.style.SUCCESS(f"Total storage saved:      {_megabytes(report['bytes_saved'])}"))
@@ -0,0 +1,110 @@
+import os
+import time
+from collections import Counter
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django import db
+
+
+def _init_worker():
+    # Spawned workers (Windows) start without Django configured
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    # Never share the parent's database connection with a forked child
+    db.connections.close_all()
+    try:
+        # Pay the dlib model load once per worker instead of once per photo
+        import face_recognition  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _run_job(args):
+    job_id, max_attempts = args
+    from travel.jobs import run_job
+    try:
+        return run_job(job_id, max_attempts=max_attempts)
+    finally:
+        db.connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Drains the face processing queue filled by photo uploads."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'FACE_JOB_WORKERS', 1),
+            help="Number of worker processes (1 = run in this process)."
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=20,
+            help="How many pending jobs to hand out per round."
+        )
+        parser.add_argument(
+            '--max-attempts', type=int, default=getattr(settings, 'FACE_JOB_MAX_ATTEMPTS', 3),
+            help="A job is marked failed after this many attempts."
+        )
+        parser.add_argument(
+            '--stale-after', type=int, default=getattr(settings, 'FACE_JOB_STALE_SECONDS', 600),
+            help="Seconds after which a running job is assumed dead and requeued."
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=2.0,
+            help="Seconds to wait when the queue is empty."
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Exit as soon as the queue is empty instead of polling forever."
+        )
+
+    def handle(self, *args, **options):
+        from travel.jobs import pending_job_ids, requeue_stale_jobs, run_job
+
+        workers = max(1, options['workers'])
+        max_attempts = options['max_attempts']
+        totals = Counter()
+
+        pool = None
+        if workers > 1:
+            db.connections.close_all()
+            pool = Pool(processes=workers, initializer=_init_worker)
+
+        self.stdout.write(f"Face job worker started ({workers} process(es)).")
+        try:
+            while True:
+                requeued = requeue_stale_jobs(options['stale_after'])
+                if requeued:
+                    self.stdout.write(f"Requeued {requeued} stale job(s).")
+
+                job_ids = pending_job_ids(limit=options['batch_size'])
+                if not job_ids:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                started = time.monotonic()
+                if pool:
+                    results = pool.map(_run_job, [(job_id, max_attempts) for job_id in job_ids])
+                else:
+                    results = [run_job(job_id, max_attempts=max_attempts) for job_id in job_ids]
+
+                batch = Counter(status for status in results if status)
+                totals.update(batch)
+                self.stdout.write(
+                    f"Processed {sum(batch.values())} job(s) in {time.monotonic() - started:.1f}s "
+                    f"(done={batch['done']}, retry={batch['pending']}, failed={batch['failed']})"
+                )
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping face job worker.")
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Queue drained: done={totals['done']}, failed={totals['failed']}"
+        ))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from travel.models import Trip
+from travel.rollups import rebuild_trip_rollups, rollup_drift
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the expense rollups of trips from their expenses and settlements. "
+        "Repairs drift left by writes that bypassed travel/rollups.py (admin, bulk updates)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('trips', nargs='*', type=int, help="Trip ids (default: every trip)")
+        parser.add_argument('--check', action='store_true',
+                            help="Only report trips whose rollups drifted; exit with an error if any did.")
+        parser.add_argument('--only-drifted', action='store_true',
+                            help="Rebuild just the trips whose rollups drifted.")
+
+    def handle(self, *args, **options):
+        trips = Trip.objects.order_by('id')
+        if options['trips']:
+            trips = trips.filter(pk__in=options['trips'])
+            missing = set(options['trips']) - set(trips.values_list('id', flat=True))
+            if missing:
+                raise CommandError(f"Unknown trip ids: {', '.join(map(str, sorted(missing)))}")
+
+        drifted = 0
+        rebuilt = 0
+        for trip_id in trips.values_list('id', flat=True):
+            if options['check'] or options['only_drifted']:
+                drift = rollup_drift(trip_id)
+                if not drift:
+                    continue
+                drifted += 1
+                self.stdout.write(f"Trip {trip_id}: {len(drift)} rollup rows out of date")
+                if options['check']:
+                    continue
+
+            rows = rebuild_trip_rollups(trip_id)
+            rebuilt += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f"Trip {trip_id}: {rows} rollup rows")
+
+        if options['check']:
+            if drifted:
+                raise CommandError(f"{drifted} trip(s) have drifted rollups; run rebuild_rollups to repair them")
+            self.stdout.write(self.style.SUCCESS("All rollups are up to date"))
+            return
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rollups of {rebuilt} trip(s)"))
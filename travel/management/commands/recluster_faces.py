@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from travel.clustering import recluster_trip
+from travel.face_index import MAYBE_MATCH_DISTANCE, STRICT_MATCH_DISTANCE
+from travel.models import Trip
+
+
+class Command(BaseCommand):
+    help = "Re-clusters all detected faces of a trip and rewrites its people, tags and merge suggestions."
+
+    def add_arguments(self, parser):
+        parser.add_argument('trip', type=int, help="Trip id")
+        parser.add_argument(
+            '--threshold', type=float, default=STRICT_MATCH_DISTANCE,
+            help="Faces closer than this are linked into the same person."
+        )
+        parser.add_argument(
+            '--maybe', type=float, default=MAYBE_MATCH_DISTANCE,
+            help="People whose centroids are closer than this get a merge suggestion."
+        )
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument(
+            '--block-size', type=int, default=2048,
+            help="Rows per block of the pairwise distance computation."
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would change.")
+
+    def handle(self, *args, **options):
+        try:
+            trip = Trip.objects.get(pk=options['trip'])
+        except Trip.DoesNotExist:
+            raise CommandError(f"Trip {options['trip']} does not exist")
+
+        stats = recluster_trip(
+            trip,
+            threshold=options['threshold'],
+            maybe=options['maybe'],
+            iterations=options['iterations'],
+            block_size=options['block_size'],
+            seed=options['seed'],
+            dry_run=options['dry_run'],
+        )
+
+        if stats['without_encoding']:
+            self.stdout.write(self.style.WARNING(
+                f"{stats['without_encoding']} face(s) have no stored encoding and keep their current person."
+            ))
+        self.stdout.write(
+            f"{stats['faces']} faces -> {stats['clusters']} people, {stats['suggestions']} merge suggestion(s)."
+        )
+        if options['dry_run']:
+            self.stdout.write("Dry run: nothing was changed.")
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Trip '{trip.name}': {stats['groups_before']} -> {stats['groups_after']} face groups."
+            ))
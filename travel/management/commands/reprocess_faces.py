@@ -0,0 +1,177 @@
+import os
+from collections import Counter, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from travel.clustering import DEFAULT_NAME
+from travel.encodings import decode_matrix
+from travel.face_index import (
+    MAYBE_MATCH_DISTANCE, STRICT_MATCH_DISTANCE, TripFaceIndex, bump_face_version, discard_segments,
+    trip_face_lock
+)
+from travel.models import FaceDetectionResult, FaceGroup, PhotoFaceRelation, Trip, TripPhoto
+from travel.renditions import delete_renditions
+from travel.utils import assign_photo_faces, cached_detect_faces, detection_params, face_thumbnail, load_full_image
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-runs face grouping for a trip with other match thresholds. Detection results are "
+        "read from the detection cache, so photos are only decoded again for face thumbnails."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('trip', type=int, help="Trip id")
+        parser.add_argument('--strict', type=float, default=STRICT_MATCH_DISTANCE,
+                            help="Faces closer than this join an existing person.")
+        parser.add_argument('--maybe', type=float, default=MAYBE_MATCH_DISTANCE,
+                            help="New people closer than this to an existing one get a merge suggestion.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Replay grouping in memory from the cache and only report the result.")
+        parser.add_argument('--skip-thumbnails', action='store_true',
+                            help="Don't decode photos to cut thumbnails for the new face groups.")
+
+    def handle(self, *args, **options):
+        try:
+            trip = Trip.objects.get(pk=options['trip'])
+        except Trip.DoesNotExist:
+            raise CommandError(f"Trip {options['trip']} does not exist")
+
+        # Same order as ingest, so the greedy grouping sees faces in the same sequence
+        photos = list(trip.photos.order_by('uploaded_at', 'id'))
+        strict, maybe = options['strict'], options['maybe']
+
+        if options['dry_run']:
+            self._dry_run(trip, photos, strict, maybe)
+            return
+
+        import face_recognition
+
+        # Detection first (from the cache where possible): a photo that can't be read
+        # stops the command before anything of the trip is touched
+        detected = []
+        for photo in photos:
+            if not os.path.exists(photo.image.path):
+                raise CommandError(f"Photo {photo.id}: file not found ({photo.image.path})")
+            boxes, encodings, skipped, _ = cached_detect_faces(face_recognition, photo)
+            detected.append((photo, boxes, encodings, skipped))
+
+        # Regrouping replaces every group of the trip, all or nothing
+        new_faces = []
+        try:
+            with trip_face_lock(trip.id):
+                # Remember which named person was in which photo so the names survive regrouping
+                names_by_photo = defaultdict(list)
+                for photo_id, name in PhotoFaceRelation.objects.filter(face_group__trip=trip).exclude(
+                    face_group__name=DEFAULT_NAME
+                ).values_list('photo_id', 'face_group__name'):
+                    names_by_photo[photo_id].append(name)
+
+                old_groups = list(FaceGroup.objects.filter(trip=trip))
+                # Cascades to the face tags and merge suggestions of the trip
+                FaceGroup.objects.filter(trip=trip).delete()
+                bump_face_version(trip.id)
+
+                for photo, boxes, encodings, skipped in detected:
+                    skipped_faces = {reason: count for reason, count in skipped.items() if count}
+                    if skipped_faces != photo.skipped_faces:
+                        TripPhoto.objects.filter(pk=photo.pk).update(skipped_faces=skipped_faces)
+                    if encodings:
+                        for group, face_number in assign_photo_faces(photo, encodings, strict=strict, maybe=maybe):
+                            new_faces.append((photo, group, boxes[face_number]))
+
+                renamed = self._restore_names(trip, names_by_photo)
+                # The old thumbnails are only needed if this rolls back
+                old_thumbnails = [group.thumbnail for group in old_groups if group.thumbnail]
+                transaction.on_commit(lambda: self._delete_thumbnails(old_thumbnails))
+        except Exception:
+            # Segments written for the rolled-back face versions must not be picked up later
+            discard_segments(trip.id)
+            raise
+
+        if not options['skip_thumbnails']:
+            self._cut_thumbnails(new_faces)
+        groups_before = len(old_groups)
+        groups_after = FaceGroup.objects.filter(trip=trip).count()
+        self.stdout.write(self.style.SUCCESS(
+            f"Trip '{trip.name}': {groups_before} -> {groups_after} face groups, {renamed} name(s) carried over."
+        ))
+
+    def _delete_thumbnails(self, thumbnails):
+        for thumbnail in thumbnails:
+            delete_renditions(thumbnail)
+            thumbnail.delete(save=False)
+
+    def _cut_thumbnails(self, new_faces):
+        """Thumbnails of the new groups, cut from the full-quality photo (decoded once per photo)."""
+        pil_img = current = None
+        for photo, group, box in new_faces:
+            if photo is not current:
+                pil_img, current = load_full_image(photo.image.path), photo
+            group.thumbnail.save(f"face_{photo.id}.jpg", face_thumbnail(pil_img, box), save=False)
+            FaceGroup.objects.filter(pk=group.pk).update(thumbnail=group.thumbnail.name)
+
+    def _dry_run(self, trip, photos, strict, maybe):
+        import face_recognition
+
+        params = detection_params(face_recognition)
+        cached = {
+            row.content_hash: row
+            for row in FaceDetectionResult.objects.filter(
+                content_hash__in=[p.content_hash for p in photos if p.content_hash], **params
+            )
+        }
+
+        # Same greedy assignment as process_photo_faces, with made-up group ids
+        index = TripFaceIndex(trip.id)
+        faces = suggestions = uncached = 0
+        for photo in photos:
+            result = cached.get(photo.content_hash)
+            if result is None:
+                uncached += 1
+                continue
+            for encoding in decode_matrix(result.encodings):
+                faces += 1
+                strict_ids, maybe_ids = index.match(encoding, strict=strict, maybe=maybe)
+                if strict_ids:
+                    continue
+                suggestions += len(maybe_ids)
+                index.append(len(index) + 1, encoding)
+
+        if uncached:
+            self.stdout.write(self.style.WARNING(
+                f"{uncached} photo(s) have no cached detection result and were left out."
+            ))
+        self.stdout.write(
+            f"{faces} faces -> {len(index)} people, {suggestions} merge suggestion(s) "
+            f"(strict={strict}, maybe={maybe})."
+        )
+        self.stdout.write("Dry run: nothing was changed.")
+
+    def _restore_names(self, trip, names_by_photo):
+        """Each new group takes the name most often seen in its photos before regrouping."""
+        if not names_by_photo:
+            return 0
+
+        votes = defaultdict(Counter)
+        for group_id, photo_id in PhotoFaceRelation.objects.filter(
+            face_group__trip=trip, photo_id__in=list(names_by_photo)
+        ).values_list('face_group_id', 'photo_id'):
+            votes[group_id].update(names_by_photo[photo_id])
+
+        # Strongest evidence first; every name goes to one group only
+        ranked = sorted(
+            ((count, group_id, name) for group_id, counter in votes.items() for name, count in counter.items()),
+            reverse=True
+        )
+        used_names, named_groups = set(), set()
+        renamed = 0
+        for _, group_id, name in ranked:
+            if name in used_names or group_id in named_groups:
+                continue
+            FaceGroup.objects.filter(pk=group_id).update(name=name)
+            used_names.add(name)
+            named_groups.add(group_id)
+            renamed += 1
+        return renamed
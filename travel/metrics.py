@@ -0,0 +1,194 @@
+# travel/metrics.py
+"""
+Per-view request metrics: wall time, number of SQL queries, time spent in SQL and the
+slowest statements, keyed by URL name (travel/urls.py). Exposed as Prometheus text by
+the /metrics view.
+
+Off unless REQUEST_METRICS_ENABLED is set; the middleware then removes itself at
+startup (MiddlewareNotUsed), so a disabled install pays nothing per request.
+Numbers live in the memory of each server process: with several workers, every
+process reports its own (scrape them separately or aggregate with sum()).
+"""
+import heapq
+import logging
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger('travel.metrics')
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Literals are stripped from reported statements, so the same query always looks the same
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def metrics_enabled():
+    return getattr(settings, 'REQUEST_METRICS_ENABLED', False)
+
+
+def normalize_sql(sql):
+    return _LITERALS.sub('?', ' '.join(sql.split()))
+
+
+class Histogram:
+    """Cumulative Prometheus histogram: counts per upper bound, plus sum and count."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class ViewStats:
+    def __init__(self, slow_statements):
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.sql_duration = Histogram(DURATION_BUCKETS)
+        self.over_budget = 0
+        # Min-heap of (seconds, statement): the slowest statements seen for this view
+        self.slowest = []
+        self.slow_statements = slow_statements
+
+    def add_statement(self, seconds, sql):
+        sql = normalize_sql(sql)
+        for n, (_, known) in enumerate(self.slowest):
+            if known == sql:
+                if seconds > self.slowest[n][0]:
+                    self.slowest[n] = (seconds, sql)
+                    heapq.heapify(self.slowest)
+                return
+        if len(self.slowest) < self.slow_statements:
+            heapq.heappush(self.slowest, (seconds, sql))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, sql))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def record(self, view, seconds, queries, over_budget):
+        """queries: [(seconds, sql)] of one request."""
+        slow_statements = getattr(settings, 'REQUEST_METRICS_SLOW_STATEMENTS', 5)
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = ViewStats(slow_statements)
+            stats.duration.observe(seconds)
+            stats.queries.observe(len(queries))
+            stats.sql_duration.observe(sum(duration for duration, _ in queries))
+            stats.over_budget += over_budget
+            # Only the slowest of this request can make it into the view's list
+            for duration, sql in heapq.nlargest(slow_statements, queries, key=lambda query: query[0]):
+                stats.add_statement(duration, sql)
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+    def render(self):
+        """All views as Prometheus text exposition format."""
+        with self._lock:
+            views = sorted(self._views.items())
+            lines = []
+            for name, help_text, kind, attribute in (
+                ('travel_request_duration_seconds', "Wall time per request", 'histogram', 'duration'),
+                ('travel_request_queries', "SQL queries per request", 'histogram', 'queries'),
+                ('travel_request_sql_seconds', "Time spent in SQL per request", 'histogram', 'sql_duration'),
+            ):
+                lines += [f"# HELP {name} {help_text}.", f"# TYPE {name} {kind}"]
+                for view, stats in views:
+                    lines += getattr(stats, attribute).lines(name, f'view="{_escape(view)}"')
+
+            lines += [
+                "# HELP travel_request_query_budget_exceeded_total Requests that ran more queries than the budget.",
+                "# TYPE travel_request_query_budget_exceeded_total counter",
+            ]
+            lines += [
+                f'travel_request_query_budget_exceeded_total{{view="{_escape(view)}"}} {stats.over_budget}'
+                for view, stats in views
+            ]
+
+            lines += [
+                "# HELP travel_slow_query_seconds Slowest SQL statements seen per view.",
+                "# TYPE travel_slow_query_seconds gauge",
+            ]
+            for view, stats in views:
+                for rank, (seconds, sql) in enumerate(sorted(stats.slowest, reverse=True), 1):
+                    lines.append(
+                        f'travel_slow_query_seconds{{view="{_escape(view)}",rank="{rank}",'
+                        f'statement="{_escape(sql[:300])}"}} {seconds:.6f}'
+                    )
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetricsMiddleware:
+    """
+    Times each request and every SQL statement it runs (connection.execute_wrapper).
+    Warns on the 'travel.metrics' logger when a request runs more than
+    REQUEST_METRICS_QUERY_BUDGET queries.
+    """
+
+    def __init__(self, get_response):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.query_budget = getattr(settings, 'REQUEST_METRICS_QUERY_BUDGET', 50)
+
+    def __call__(self, request):
+        queries = []
+
+        def timed_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries.append((time.perf_counter() - started, sql))
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(timed_query):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else '<unresolved>'
+        over_budget = self.query_budget is not None and len(queries) > self.query_budget
+        if over_budget:
+            slowest = max(queries, key=lambda query: query[0])
+            logger.warning(
+                "%s ran %d SQL queries (budget %d) in %.1f ms; slowest %.1f ms: %s",
+                view, len(queries), self.query_budget, duration * 1000, slowest[0] * 1000,
+                normalize_sql(slowest[1])[:300]
+            )
+        registry.record(view, duration, queries, over_budget)
+        return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FaceProcessingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('photo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='face_job', to='travel.tripphoto')),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+import pickle
+
+import numpy as np
+from django.db import migrations
+
+from travel.encodings import decode_encoding, encode_encoding, is_encoded
+
+
+def pickle_to_float32(apps, schema_editor):
+    FaceGroup = apps.get_model('travel', 'FaceGroup')
+    for group in FaceGroup.objects.only('id', 'representative_encoding').iterator(chunk_size=500):
+        raw = bytes(group.representative_encoding or b'')
+        if not raw or is_encoded(raw):
+            continue
+        encoding = pickle.loads(raw)
+        FaceGroup.objects.filter(pk=group.pk).update(representative_encoding=encode_encoding(encoding))
+
+
+def float32_to_pickle(apps, schema_editor):
+    FaceGroup = apps.get_model('travel', 'FaceGroup')
+    for group in FaceGroup.objects.only('id', 'representative_encoding').iterator(chunk_size=500):
+        raw = bytes(group.representative_encoding or b'')
+        if not is_encoded(raw):
+            continue
+        encoding = np.array(decode_encoding(raw), dtype=np.float64)
+        FaceGroup.objects.filter(pk=group.pk).update(representative_encoding=pickle.dumps(encoding))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0002_face_processing_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(pickle_to_float32, float32_to_pickle),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0003_convert_face_encodings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photofacerelation',
+            name='encoding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0004_photofacerelation_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='face_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
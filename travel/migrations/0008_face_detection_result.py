@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0007_content_addressed_photos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FaceDetectionResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('detector', models.CharField(max_length=10)),
+                ('upsample', models.PositiveSmallIntegerField()),
+                ('max_side', models.PositiveIntegerField()),
+                ('min_face_height', models.PositiveIntegerField()),
+                ('library_version', models.CharField(max_length=50)),
+                ('boxes', models.JSONField(default=list)),
+                ('encodings', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('content_hash', 'detector', 'upsample', 'max_side', 'min_face_height', 'library_version')},
+            },
+        ),
+    ]
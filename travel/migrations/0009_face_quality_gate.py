@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0008_face_detection_result'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='facedetectionresult',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='facedetectionresult',
+            name='max_yaw',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='facedetectionresult',
+            name='min_sharpness',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='facedetectionresult',
+            name='skipped',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='tripphoto',
+            name='skipped_faces',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterUniqueTogether(
+            name='facedetectionresult',
+            unique_together={('content_hash', 'detector', 'upsample', 'max_side', 'min_face_height', 'min_sharpness', 'max_yaw', 'library_version')},
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_rollups(apps, schema_editor):
+    Expense = apps.get_model('travel', 'Expense')
+    Settlement = apps.get_model('travel', 'Settlement')
+    TripExpenseRollup = apps.get_model('travel', 'TripExpenseRollup')
+
+    rows = [
+        TripExpenseRollup(
+            trip_id=trip_id, kind='expense', category=category or '', member_id=paid_by, date=day,
+            total=total, count=count
+        )
+        for trip_id, category, paid_by, day, total, count in Expense.objects.order_by().values_list(
+            'trip', 'category', 'paid_by', 'date'
+        ).annotate(total=Sum('amount'), count=Count('id')).iterator()
+    ]
+    rows += [
+        TripExpenseRollup(
+            trip_id=trip_id, kind='settlement', member_id=payer, payee_id=payee, date=day,
+            total=total, count=count
+        )
+        for trip_id, payer, payee, day, total, count in Settlement.objects.order_by().values_list(
+            'trip', 'payer', 'payee', 'date'
+        ).annotate(total=Sum('amount'), count=Count('id')).iterator()
+    ]
+    TripExpenseRollup.objects.bulk_create(rows, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0009_face_quality_gate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripExpenseRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expense', 'Expense'), ('settlement', 'Settlement')], max_length=10)),
+                ('category', models.CharField(blank=True, max_length=20)),
+                ('date', models.DateField()),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('count', models.IntegerField(default=0)),
+                ('member', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='travel.groupmember')),
+                ('payee', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='travel.groupmember')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='expense_rollups', to='travel.trip')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['trip', 'kind'], name='travel_trip_trip_id_9660b4_idx')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0010_trip_expense_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='expense_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
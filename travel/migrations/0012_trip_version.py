@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0011_trip_expense_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
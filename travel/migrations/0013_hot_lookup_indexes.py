@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0012_trip_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='checklistitem',
+            index=models.Index(fields=['trip', 'user', 'is_personal', 'is_done'], name='travel_chec_trip_id_3b9c64_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['trip', 'date'], name='travel_expe_trip_id_ac56f4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='facemergesuggestion',
+            index=models.Index(fields=['trip', 'is_active'], name='travel_face_trip_id_16d937_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmember',
+            index=models.Index(fields=['trip', 'contact'], name='travel_grou_trip_id_23db49_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photofacerelation',
+            index=models.Index(fields=['face_group', 'photo'], name='travel_phot_face_gr_7ffe87_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tripphoto',
+            index=models.Index(fields=['trip', 'uploaded_at'], name='travel_trip_trip_id_d4babc_idx'),
+        ),
+    ]
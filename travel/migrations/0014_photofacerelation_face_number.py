@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:12
+
+from django.db import migrations, models
+
+
+def number_faces(apps, schema_editor):
+    """
+    Drops repeated tags of the same face (a retried job used to tag a photo again) and
+    numbers the remaining tags of each photo in the order they were saved.
+    """
+    PhotoFaceRelation = apps.get_model('travel', 'PhotoFaceRelation')
+    duplicate_ids, numbered = [], []
+    photo_id, seen = None, set()
+    for relation in PhotoFaceRelation.objects.order_by('photo_id', 'id').only(
+        'id', 'photo_id', 'face_group_id', 'encoding'
+    ).iterator(chunk_size=2000):
+        if relation.photo_id != photo_id:
+            photo_id, seen = relation.photo_id, set()
+        key = (relation.face_group_id, bytes(relation.encoding) if relation.encoding is not None else None)
+        if key in seen:
+            duplicate_ids.append(relation.id)
+            continue
+        seen.add(key)
+        relation.face_number = len(seen) - 1
+        numbered.append(relation)
+
+    for start in range(0, len(duplicate_ids), 500):
+        PhotoFaceRelation.objects.filter(id__in=duplicate_ids[start:start + 500]).delete()
+    PhotoFaceRelation.objects.bulk_update(numbered, ['face_number'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('travel', '0013_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photofacerelation',
+            name='face_number',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.RunPython(number_faces, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='photofacerelation',
+            name='face_number',
+            field=models.PositiveSmallIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name='photofacerelation',
+            constraint=models.UniqueConstraint(fields=('photo', 'face_number'), name='unique_face_per_photo'),
+        ),
+    ]
@@ -37,12 +37,31 @@ class Trip(models.Model):
     # બજેટ ફિલ્ડ અહીં જ રાખવું
     budget = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
 
+    # Bumped whenever this trip's FaceGroups change (see travel/face_index.py)
+    face_version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped whenever this trip's expenses or settlements change (see travel/rollups.py)
+    expense_version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped by every change to what the trip's pages show (see travel/trip_cache.py)
+    version = models.PositiveIntegerField(default=0, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Only ever changed with F() updates
+    COUNTERS = ('face_version', 'expense_version', 'version')
+
     def __str__(self):
         return f"{self.name} - {self.destination}"
 
+    def save(self, *args, **kwargs):
+        # Saving a trip loaded earlier (e.g. the edit form) must not write back stale counters
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTERS
+            ]
+        super().save(*args, **kwargs)
+
     @property
     def days_left(self):
         from datetime import date
@@ -107,6 +126,14 @@ class ChecklistItem(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Group/personal lists of a trip (user before is_personal: boolean filters are
+            # bare column tests, which SQLite can't seek on); with is_done the progress
+            # counts never read the table
+            models.Index(fields=['trip', 'user', 'is_personal', 'is_done']),
+        ]
+
     def __str__(self):
         return f"{self.item_name} ({self.priority}) - {'Personal' if self.is_personal else 'Group'}"
 
@@ -125,6 +152,9 @@ class GroupMember(models.Model):
         help_text="Email"
     )
 
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'contact'])]
+
     def __str__(self):
         return self.name
 
@@ -167,10 +197,31 @@ class Expense(models.Model):
     date = models.DateField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'date'])]
+
     def __str__(self):
         return f"{self.title} - {self.amount}"
 
 
+class PhotoBlob(models.Model):
+    """
+    One stored photo file, addressed by the SHA-256 of its content and shared by every
+    TripPhoto with the same bytes (see travel/photo_store.py).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    # Number of TripPhoto rows using this file; the file is deleted when it drops to 0
+    ref_count = models.PositiveIntegerField(default=0)
+    # Uploads of this file into a trip that already had it (not stored or processed again)
+    duplicate_uploads = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
+
 class TripPhoto(models.Model):
     trip = models.ForeignKey(
         Trip,
@@ -178,12 +229,78 @@ class TripPhoto(models.Model):
         related_name='photos'
     )
     image = models.ImageField(upload_to='trip_photos/')
+    # SHA-256 of the file; the image itself lives at the content-addressed name of its PhotoBlob
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # Detected faces the quality gate didn't encode, per reason: {'small': 2, 'profile': 1}
+    skipped_faces = models.JSONField(default=dict, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'uploaded_at'])]
+
     def __str__(self):
         return f"Photo for {self.trip.name}"
 
 
+class ImageRendition(models.Model):
+    """
+    A resized/re-encoded copy of an uploaded image (trip photo or face thumbnail),
+    generated at ingest or on first request by travel/renditions.py.
+    """
+    FORMAT_CHOICES = [
+        ('webp', 'WebP'),
+        ('jpeg', 'JPEG'),
+    ]
+
+    # Storage name of the original file, e.g. "trip_photos/IMG_0001.jpg"
+    source = models.CharField(max_length=255)
+    size = models.CharField(max_length=20)
+    format = models.CharField(max_length=4, choices=FORMAT_CHOICES)
+    file = models.ImageField(upload_to='renditions/')
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('source', 'size', 'format')
+
+    def __str__(self):
+        return f"{self.source} ({self.size}, {self.format})"
+
+
+class FaceDetectionResult(models.Model):
+    """
+    Cached output of face detection + encoding for one image content and one set of
+    detector parameters, so grouping can be re-run without decoding the image again.
+    """
+    content_hash = models.CharField(max_length=64)
+    detector = models.CharField(max_length=10)
+    upsample = models.PositiveSmallIntegerField()
+    # Longest side of the detection frame (0 = native resolution)
+    max_side = models.PositiveIntegerField()
+    min_face_height = models.PositiveIntegerField()
+    # Quality gate (see travel/utils.py); max_yaw None = no pose check
+    min_sharpness = models.FloatField(default=0)
+    max_yaw = models.FloatField(null=True, blank=True)
+    library_version = models.CharField(max_length=50)
+    # [[top, right, bottom, left], ...] in original-image pixels, one per encoded face
+    boxes = models.JSONField(default=list)
+    # All encodings as one matrix (see travel/encodings.py encode_matrix)
+    encodings = models.BinaryField()
+    # Faces dropped before encoding, per reason: {'small': 2, 'blurry': 1}
+    skipped = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (
+            'content_hash', 'detector', 'upsample', 'max_side', 'min_face_height',
+            'min_sharpness', 'max_yaw', 'library_version'
+        )
+
+    def __str__(self):
+        return f"{self.content_hash[:12]}: {len(self.boxes)} face(s) ({self.detector})"
+
+
 class FaceGroup(models.Model):
     trip = models.ForeignKey(
         Trip,
@@ -209,6 +326,21 @@ class PhotoFaceRelation(models.Model):
         on_delete=models.CASCADE,
         related_name='tagged_photos'
     )
+    # Position of the face among the photo's kept detections (FaceDetectionResult.boxes)
+    face_number = models.PositiveSmallIntegerField()
+    # This face's own 128-d encoding (see travel/encodings.py), used for trip-wide re-clustering
+    encoding = models.BinaryField(null=True, blank=True)
+
+    class Meta:
+        # One row per detected face, so a photo showing two faces that match the same person
+        # has two tags of their group; count distinct photos when counting a group's photos
+        constraints = [
+            models.UniqueConstraint(fields=['photo', 'face_number'], name='unique_face_per_photo'),
+        ]
+        indexes = [
+            # Photos of a set of groups (search, merges) without reading the table
+            models.Index(fields=['face_group', 'photo']),
+        ]
 
 
 class FaceMergeSuggestion(models.Model):
@@ -220,9 +352,55 @@ class FaceMergeSuggestion(models.Model):
 
     class Meta:
         unique_together = ('group_a', 'group_b')
+        indexes = [models.Index(fields=['trip', 'is_active'])]
 
     def __str__(self):
         return f"Suggest merge: {self.group_a.name} & {self.group_b.name}"
+
+
+class FaceProcessingJob(models.Model):
+    """Queued face detection/grouping work for one uploaded photo (drained by `manage.py process_face_jobs`)."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    photo = models.OneToOneField(
+        TripPhoto,
+        on_delete=models.CASCADE,
+        related_name='face_job'
+    )
+    status = models.CharField(
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        db_index=True
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"Face job for photo {self.photo_id} ({self.status})"
+
+    @property
+    def duration(self):
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
+
 class Settlement(models.Model):
     trip = models.ForeignKey(
         Trip,
@@ -245,3 +423,51 @@ class Settlement(models.Model):
 
     def __str__(self):
         return f"{self.payer.name} paid {self.payee.name} {self.amount}"
+
+
+class TripExpenseRollup(models.Model):
+    """
+    Running totals of a trip's expenses (per category, payer and day) and settlements
+    (per payer, payee and day). Kept up to date by travel/rollups.py, so the money
+    sections of a trip read a handful of rows instead of every expense.
+    """
+    EXPENSE = 'expense'
+    SETTLEMENT = 'settlement'
+    KIND_CHOICES = [
+        (EXPENSE, 'Expense'),
+        (SETTLEMENT, 'Settlement'),
+    ]
+
+    trip = models.ForeignKey(
+        Trip,
+        on_delete=models.CASCADE,
+        related_name='expense_rollups'
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # Expenses only
+    category = models.CharField(max_length=20, blank=True)
+    # Who paid: Expense.paid_by or Settlement.payer
+    member = models.ForeignKey(
+        GroupMember,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    # Settlements only
+    payee = models.ForeignKey(
+        GroupMember,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    date = models.DateField()
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['trip', 'kind'])]
+
+    def __str__(self):
+        return f"{self.trip_id} {self.kind} {self.category} {self.date}: {self.total}"
@@ -0,0 +1,153 @@
+# travel/photo_store.py
+"""
+Content-addressed storage for trip photos.
+
+Every upload is hashed (SHA-256) while it streams in. Files are stored once under
+photos/<aa>/<bb>/<hash><ext> and shared through a reference-counted PhotoBlob.
+Re-uploading a photo that is already in the trip doesn't store or process it
+again; the existing TripPhoto and its face tags are reused.
+"""
+import hashlib
+import os
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F
+
+from .models import FaceProcessingJob, PhotoBlob, TripPhoto
+from .renditions import delete_renditions
+
+BLOB_PREFIX = 'photos'
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """
+    Computes the SHA-256 of each uploaded file chunk by chunk as it arrives and passes
+    the data on unchanged to the regular handlers. Digests are collected per field name,
+    in upload order.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.digests = {}
+        self._hasher = None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self._hasher = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._hasher.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.digests.setdefault(self.field_name, []).append(self._hasher.hexdigest())
+        return None
+
+
+def hash_file(file_obj):
+    """SHA-256 of an already received file (fallback when the upload handler didn't run)."""
+    hasher = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        hasher.update(chunk)
+    file_obj.seek(0)
+    return hasher.hexdigest()
+
+
+def blob_name(digest, original_name):
+    extension = os.path.splitext(original_name)[1].lower() or '.jpg'
+    return f"{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+
+def store_photo(trip, uploaded_file, digest=None):
+    """
+    Adds an uploaded file to a trip. Returns (photo, created); created is False
+    when the trip already has a photo with exactly these bytes.
+    """
+    digest = digest or hash_file(uploaded_file)
+
+    existing = TripPhoto.objects.filter(trip=trip, content_hash=digest).first()
+    if existing:
+        PhotoBlob.objects.filter(sha256=digest).update(duplicate_uploads=F('duplicate_uploads') + 1)
+        return existing, False
+
+    with transaction.atomic():
+        blob, _ = PhotoBlob.objects.get_or_create(
+            sha256=digest,
+            defaults={'name': blob_name(digest, uploaded_file.name), 'size': uploaded_file.size}
+        )
+        if not default_storage.exists(blob.name):
+            saved_name = default_storage.save(blob.name, uploaded_file)
+            if saved_name != blob.name:
+                # Storage picked another name (concurrent upload of the same file)
+                PhotoBlob.objects.filter(pk=blob.pk).update(name=saved_name)
+                blob.name = saved_name
+        PhotoBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        photo = TripPhoto.objects.create(trip=trip, image=blob.name, content_hash=digest)
+    return photo, True
+
+
+def release_photo(photo):
+    """
+    Drops one reference to the photo's file; the file and its renditions are deleted
+    with the last reference. Call before deleting a TripPhoto.
+    """
+    if not photo.content_hash:
+        # Stored before content addressing - the file belongs to this photo alone
+        delete_renditions(photo.image)
+        photo.image.delete(save=False)
+        return
+
+    with transaction.atomic():
+        PhotoBlob.objects.filter(sha256=photo.content_hash, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        blob = PhotoBlob.objects.filter(sha256=photo.content_hash, ref_count=0).first()
+        if blob:
+            blob.delete()
+    if blob:
+        delete_renditions(photo.image)
+        default_storage.delete(blob.name)
+
+
+def recount_references():
+    """Rebuilds PhotoBlob.ref_count from TripPhoto rows (repairs drift, e.g. after cascading deletes)."""
+    counts = dict(
+        TripPhoto.objects.exclude(content_hash='').values_list('content_hash').annotate(n=Count('id'))
+    )
+    fixed = 0
+    for blob_id, sha256, ref_count in PhotoBlob.objects.values_list('id', 'sha256', 'ref_count'):
+        actual = counts.get(sha256, 0)
+        if actual != ref_count:
+            PhotoBlob.objects.filter(pk=blob_id).update(ref_count=actual)
+            fixed += 1
+    return fixed
+
+
+def storage_report():
+    """
+    Bytes and face-processing CPU seconds saved by content addressing.
+
+    Bytes: every extra reference to a shared file, plus every skipped duplicate upload.
+    CPU: every skipped duplicate upload would have run the face pipeline again; the
+    average duration of the jobs that did run for that file is used as its cost.
+    """
+    durations = dict(
+        FaceProcessingJob.objects.filter(status=FaceProcessingJob.DONE, photo__content_hash__gt='')
+        .values_list('photo__content_hash')
+        .annotate(avg=Avg(ExpressionWrapper(F('finished_at') - F('started_at'), output_field=DurationField())))
+    )
+
+    report = {'blobs': 0, 'stored_bytes': 0, 'shared_bytes_saved': 0, 'duplicate_uploads': 0,
+              'duplicate_bytes_saved': 0, 'cpu_seconds_saved': 0.0}
+    for blob in PhotoBlob.objects.all():
+        report['blobs'] += 1
+        report['stored_bytes'] += blob.size
+        report['shared_bytes_saved'] += blob.size * max(0, blob.ref_count - 1)
+        report['duplicate_uploads'] += blob.duplicate_uploads
+        report['duplicate_bytes_saved'] += blob.size * blob.duplicate_uploads
+        average = durations.get(blob.sha256)
+        if average:
+            report['cpu_seconds_saved'] += average.total_seconds() * blob.duplicate_uploads
+
+    report['bytes_saved'] = report['shared_bytes_saved'] + report['duplicate_bytes_saved']
+    return report
@@ -0,0 +1,88 @@
+# travel/renditions.py
+import io
+import os
+
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from PIL import Image, ImageOps
+
+from .models import ImageRendition
+
+# Longest side in pixels
+RENDITION_SIZES = {
+    'grid': 256,
+    'lightbox': 1024,
+    'face': 200,
+}
+# Generated for every trip photo at ingest; anything else is created on first request
+PHOTO_SIZES = ('grid', 'lightbox')
+FORMATS = ('webp', 'jpeg')
+
+CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+
+def preferred_format(request):
+    """WebP for browsers that advertise it, JPEG otherwise."""
+    return 'webp' if 'image/webp' in request.META.get('HTTP_ACCEPT', '') else 'jpeg'
+
+
+def render_image(path, max_side, fmt):
+    """Returns (bytes, width, height) of the image at `path` scaled to fit `max_side`."""
+    with Image.open(path) as pil_img:
+        # JPEGs are decoded at a reduced DCT scale when the target is much smaller
+        pil_img.draft('RGB', (max_side, max_side))
+        pil_img = ImageOps.exif_transpose(pil_img).convert('RGB')
+
+    pil_img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    if fmt == 'webp':
+        pil_img.save(buffer, format='WEBP', quality=80, method=4)
+    else:
+        pil_img.save(buffer, format='JPEG', quality=85, optimize=True, progressive=True)
+    return buffer.getvalue(), pil_img.width, pil_img.height
+
+
+def get_rendition(field_file, size, fmt):
+    """
+    The rendition of an uploaded image (ImageField file) at `size` in `fmt`,
+    generated and stored on first use.
+    """
+    if size not in RENDITION_SIZES or fmt not in FORMATS:
+        raise ValueError(f"Unknown rendition {size}/{fmt}")
+
+    existing = ImageRendition.objects.filter(source=field_file.name, size=size, format=fmt).first()
+    if existing:
+        return existing
+
+    data, width, height = render_image(field_file.path, RENDITION_SIZES[size], fmt)
+    base_name = os.path.splitext(os.path.basename(field_file.name))[0]
+    extension = 'jpg' if fmt == 'jpeg' else fmt
+
+    rendition = ImageRendition(source=field_file.name, size=size, format=fmt, width=width, height=height)
+    rendition.file.save(f"{base_name}_{size}.{extension}", ContentFile(data), save=False)
+    try:
+        with transaction.atomic():
+            rendition.save()
+    except IntegrityError:
+        # Another request generated it first; keep theirs
+        rendition.file.delete(save=False)
+        return ImageRendition.objects.get(source=field_file.name, size=size, format=fmt)
+    return rendition
+
+
+def create_photo_renditions(photo):
+    """Pre-generates the grid and lightbox renditions of a TripPhoto in every format."""
+    for size in PHOTO_SIZES:
+        for fmt in FORMATS:
+            get_rendition(photo.image, size, fmt)
+
+
+def delete_renditions(field_file):
+    """Removes the rendition rows and files of an original that is being deleted."""
+    for rendition in ImageRendition.objects.filter(source=field_file.name):
+        rendition.file.delete(save=False)
+        rendition.delete()
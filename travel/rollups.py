@@ -0,0 +1,208 @@
+# travel/rollups.py
+"""
+Keeps TripExpenseRollup in step with a trip's expenses and settlements.
+
+Every write goes through this module: save_expense / delete_expense, add_expenses
+(bulk) and record_settlement / delete_settlement change the rows and apply the
+difference to the rollup in the same transaction. Anything that bypasses it (the admin, bulk
+queryset updates, cascading deletes of a member) leaves the rollups stale until
+rebuild_trip_rollups runs - `manage.py rebuild_rollups` does that for every trip.
+
+Rollup rows are keyed on (kind, category, member, payee, date). Writers for one trip
+are serialized on the trip row, so there is never more than one row per key.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from .models import Expense, Settlement, Trip, TripExpenseRollup
+
+CENT = Decimal('0.01')
+
+
+def _lock_trip(trip_id):
+    # Takes the trip's row lock (the database write lock on SQLite) until the surrounding
+    # transaction ends, and invalidates what was cached for the old expenses (forecasts,
+    # rendered trip pages)
+    Trip.objects.filter(pk=trip_id).update(
+        expense_version=F('expense_version') + 1, version=F('version') + 1
+    )
+
+
+def _clean(model, name, value):
+    # Forms give Decimals/dates, the session gives strings
+    return model._meta.get_field(name).to_python(value)
+
+
+def expense_key(expense):
+    return (
+        TripExpenseRollup.EXPENSE,
+        expense.category or '',
+        expense.paid_by_id,
+        None,
+        _clean(Expense, 'date', expense.date),
+    )
+
+
+def settlement_key(settlement):
+    return (
+        TripExpenseRollup.SETTLEMENT,
+        '',
+        settlement.payer_id,
+        settlement.payee_id,
+        _clean(Settlement, 'date', settlement.date),
+    )
+
+
+def apply_deltas(trip_id, deltas):
+    """
+    deltas: {key: [total, count]}. Adds them to the trip's rollup rows, creating and
+    dropping rows as needed. Call inside a transaction, after _lock_trip.
+    """
+    for (kind, category, member_id, payee_id, day), (total, count) in deltas.items():
+        if not total and not count:
+            continue
+        rows = TripExpenseRollup.objects.filter(
+            trip_id=trip_id, kind=kind, category=category, member_id=member_id, payee_id=payee_id, date=day
+        )
+        updated = rows.update(total=F('total') + total, count=F('count') + count)
+        if not updated and count > 0:
+            TripExpenseRollup.objects.create(
+                trip_id=trip_id, kind=kind, category=category, member_id=member_id, payee_id=payee_id,
+                date=day, total=total, count=count
+            )
+    TripExpenseRollup.objects.filter(trip_id=trip_id, count__lte=0).delete()
+
+
+def _stored(model, instance, key_fn):
+    """(key, amount) of the row as it is in the database, or None for a new row."""
+    if instance.pk is None:
+        return None
+    stored = model.objects.filter(pk=instance.pk).first()
+    if stored is None:
+        return None
+    return stored.trip_id, key_fn(stored), stored.amount
+
+
+def _save(model, instance, key_fn):
+    with transaction.atomic():
+        _lock_trip(instance.trip_id)
+        before = _stored(model, instance, key_fn)
+        instance.save()
+
+        if before and before[0] != instance.trip_id:
+            # Moved to another trip
+            _lock_trip(before[0])
+            apply_deltas(before[0], {before[1]: [-before[2], -1]})
+            before = None
+
+        deltas = defaultdict(lambda: [Decimal('0'), 0])
+        if before:
+            deltas[before[1]][0] -= before[2]
+            deltas[before[1]][1] -= 1
+        key = key_fn(instance)
+        deltas[key][0] += _clean(model, 'amount', instance.amount)
+        deltas[key][1] += 1
+        apply_deltas(instance.trip_id, deltas)
+    return instance
+
+
+def _delete(model, instance, key_fn):
+    with transaction.atomic():
+        _lock_trip(instance.trip_id)
+        before = _stored(model, instance, key_fn)
+        instance.delete()
+        if before:
+            apply_deltas(before[0], {before[1]: [-before[2], -1]})
+
+
+def save_expense(expense):
+    """Creates or updates an expense and its trip's rollups."""
+    return _save(Expense, expense, expense_key)
+
+
+def delete_expense(expense):
+    _delete(Expense, expense, expense_key)
+
+
+def add_expenses(trip_id, expenses):
+    """bulk_create for new expenses of one trip, plus one rollup update per key."""
+    deltas = defaultdict(lambda: [Decimal('0'), 0])
+    for expense in expenses:
+        key = expense_key(expense)
+        deltas[key][0] += _clean(Expense, 'amount', expense.amount)
+        deltas[key][1] += 1
+
+    with transaction.atomic():
+        _lock_trip(trip_id)
+        created = Expense.objects.bulk_create(expenses)
+        apply_deltas(trip_id, deltas)
+    return created
+
+
+def record_settlement(**fields):
+    """Settlement.objects.create(**fields), plus the rollup."""
+    return _save(Settlement, Settlement(**fields), settlement_key)
+
+
+def delete_settlement(settlement):
+    _delete(Settlement, settlement, settlement_key)
+
+
+def expected_rollups(trip_id):
+    """{key: (total, count)} computed from the expense and settlement rows themselves."""
+    expected = {}
+    expenses = (
+        Expense.objects.filter(trip_id=trip_id).order_by()
+        .values_list('category', 'paid_by', 'date')
+        .annotate(total=Sum('amount'), count=Count('id'))
+    )
+    for category, paid_by, day, total, count in expenses:
+        key = (TripExpenseRollup.EXPENSE, category or '', paid_by, None, day)
+        previous = expected.get(key, (Decimal('0'), 0))
+        expected[key] = (previous[0] + total.quantize(CENT), previous[1] + count)
+
+    settlements = (
+        Settlement.objects.filter(trip_id=trip_id).order_by()
+        .values_list('payer', 'payee', 'date')
+        .annotate(total=Sum('amount'), count=Count('id'))
+    )
+    for payer, payee, day, total, count in settlements:
+        expected[(TripExpenseRollup.SETTLEMENT, '', payer, payee, day)] = (total.quantize(CENT), count)
+    return expected
+
+
+def current_rollups(trip_id):
+    return {
+        (row.kind, row.category, row.member_id, row.payee_id, row.date): (row.total, row.count)
+        for row in TripExpenseRollup.objects.filter(trip_id=trip_id)
+    }
+
+
+def rollup_drift(trip_id):
+    """Keys whose rollup differs from the expenses/settlements: {key: (rollup, actual)}."""
+    expected = expected_rollups(trip_id)
+    current = current_rollups(trip_id)
+    return {
+        key: (current.get(key), expected.get(key))
+        for key in set(expected) | set(current)
+        if current.get(key) != expected.get(key)
+    }
+
+
+def rebuild_trip_rollups(trip_id):
+    """Replaces the trip's rollups with totals computed from scratch. Returns the row count."""
+    with transaction.atomic():
+        _lock_trip(trip_id)
+        rows = [
+            TripExpenseRollup(
+                trip_id=trip_id, kind=kind, category=category, member_id=member_id, payee_id=payee_id,
+                date=day, total=total, count=count
+            )
+            for (kind, category, member_id, payee_id, day), (total, count) in expected_rollups(trip_id).items()
+        ]
+        TripExpenseRollup.objects.filter(trip_id=trip_id).delete()
+        TripExpenseRollup.objects.bulk_create(rows)
+    return len(rows)
@@ -0,0 +1,135 @@
+# travel/settlement.py
+"""
+Who pays whom to settle a trip.
+
+Balances are integers in minor units (paise/cents): positive = is owed money,
+negative = owes money. Nothing here touches floats or the database.
+
+- greedy_transfers: always repays the largest debt to the largest creditor, using two
+  max-heaps. O(n log n) and never more than n - 1 transfers.
+- exact_transfers: the true minimum for small groups. Every subset of members whose
+  balances add up to zero can be settled among themselves with one transfer fewer than
+  its size, so the minimum is n - (most disjoint zero-sum subsets); that is found with
+  a DP over subsets (O(2^n * n)).
+"""
+import heapq
+from decimal import ROUND_HALF_UP, Decimal
+
+# Largest number of non-zero balances exact_transfers is used for by default
+EXACT_LIMIT = 14
+
+MINOR_UNITS = 100
+
+
+def to_minor_units(amount):
+    """Decimal amount -> int minor units, rounded half up."""
+    return int((Decimal(amount) * MINOR_UNITS).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def from_minor_units(value):
+    return Decimal(value).scaleb(-2)
+
+
+def split_evenly(total, count):
+    """
+    Splits `total` minor units into `count` shares that add up to it exactly:
+    the first total % count shares get one unit more.
+    """
+    if count <= 0:
+        return []
+    base, extra = divmod(total, count)
+    return [base + 1 if n < extra else base for n in range(count)]
+
+
+def greedy_transfers(balances):
+    """
+    balances: {key: minor units}. Returns [(debtor, creditor, amount)], largest first.
+    If the balances don't add up to zero, what can't be matched is left over.
+    """
+    # heapq is a min-heap: store negated amounts; the position keeps ties deterministic
+    creditors = [(-amount, n, key) for n, (key, amount) in enumerate(balances.items()) if amount > 0]
+    debtors = [(amount, n, key) for n, (key, amount) in enumerate(balances.items()) if amount < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, c_pos, creditor = heapq.heappop(creditors)
+        debt, d_pos, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        transfers.append((debtor, creditor, amount))
+
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, c_pos, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, d_pos, debtor))
+    return transfers
+
+
+def _zero_sum_groups(keys, amounts):
+    """Splits members into the largest number of disjoint subsets that each sum to zero."""
+    n = len(amounts)
+    full = (1 << n) - 1
+
+    subset_sum = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = (mask & -mask).bit_length() - 1
+        subset_sum[mask] = subset_sum[mask & (mask - 1)] + amounts[low]
+
+    # best[mask]: most zero-sum groups the members in mask can be cut into, where the
+    # members added after the last completed group are still "open"
+    best = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        value = 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            value = max(value, best[mask ^ bit])
+            rest ^= bit
+        best[mask] = value + (1 if subset_sum[mask] == 0 else 0)
+
+    # Walk back: peel members off until the remaining set closes a group
+    groups = []
+    current = []
+    mask = full
+    while mask:
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            previous = mask ^ bit
+            if best[previous] + (1 if subset_sum[mask] == 0 else 0) == best[mask]:
+                break
+            rest ^= bit
+        current.append(keys[bit.bit_length() - 1])
+        if subset_sum[previous] == 0:
+            groups.append(current)
+            current = []
+        mask = previous
+    return groups
+
+
+def exact_transfers(balances):
+    """
+    Minimum number of transfers (see module docstring). Exponential in the number of
+    non-zero balances; use settle() to fall back to greedy for larger groups.
+    """
+    nonzero = {key: amount for key, amount in balances.items() if amount}
+    if sum(nonzero.values()) != 0:
+        raise ValueError("Balances must add up to zero")
+    if not nonzero:
+        return []
+
+    keys = list(nonzero)
+    transfers = []
+    for group in _zero_sum_groups(keys, [nonzero[key] for key in keys]):
+        transfers.extend(greedy_transfers({key: nonzero[key] for key in group}))
+    transfers.sort(key=lambda transfer: -transfer[2])
+    return transfers
+
+
+def settle(balances, exact_limit=EXACT_LIMIT):
+    """Minimum transfers for small groups, greedy (at most n - 1 transfers) otherwise."""
+    nonzero = sum(1 for amount in balances.values() if amount)
+    if nonzero <= exact_limit and sum(balances.values()) == 0:
+        return exact_transfers(balances)
+    return greedy_transfers(balances)
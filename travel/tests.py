@@ -1,3 +1,1792 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Count, Q, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .clustering import merge_face_groups, pick_merge_target, recluster_trip, suggestion_chain
+from .encodings import (
+    decode_encoding, decode_matrix, encode_encoding, encode_matrix, is_encoded, read_segment, write_segment
+)
+from . import face_index, forecast, jobs
+from .management.commands.benchmark_faces import synthetic_encodings
+from .expense_import import import_expenses, parse_category
+from .face_search import SearchBusy, SearchPool
+from .ledger import TripLedger
+from .metrics import normalize_sql, registry as metrics_registry
+from .photo_store import recount_references, release_photo, store_photo
+from .renditions import get_rendition, render_image
+from .models import (
+    ChecklistItem, CustomUser, Expense, FaceDetectionResult, FaceGroup, FaceMergeSuggestion, FaceProcessingJob,
+    GroupMember, ImageRendition, PhotoBlob, PhotoFaceRelation, Settlement, Trip, TripItinerary, TripPhoto
+)
+from .rollups import (
+    add_expenses, delete_expense, delete_settlement, rebuild_trip_rollups, record_settlement, rollup_drift, save_expense
+)
+from .settlement import settle, split_evenly, to_minor_units
+from .face_index import (
+    STRICT_MATCH_DISTANCE, TripFaceIndex, bump_face_version, get_trip_index, rank_trip_photos
+)
+from .utils import (
+    assign_photo_faces, cached_detect_faces, detect_faces, detection_params, face_sharpness, face_yaw,
+    load_detection_frame, scale_box, write_photo_faces
+)
+from .views import TRIP_TABS
+
+
+def face_library_stub(**functions):
+    """
+    Stand-in face_recognition module (and the dlib it is read with) for tests that
+    must not depend on the real libraries being installed.
+    """
+    face_recognition = types.ModuleType('face_recognition')
+    face_recognition.__version__ = 'test'
+    for name, function in functions.items():
+        setattr(face_recognition, name, function)
+    dlib = types.ModuleType('dlib')
+    dlib.__version__ = 'test'
+    return mock.patch.dict(sys.modules, {'face_recognition': face_recognition, 'dlib': dlib})
+
+
+def jpeg_bytes(color, size=(100, 100), **save_options):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG', **save_options)
+    return buffer.getvalue()
+
+
+class MediaTestMixin:
+    """MEDIA_ROOT and FACE_SEGMENT_ROOT in a throwaway directory."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root.name, FACE_SEGMENT_ROOT=os.path.join(media_root.name, 'segments')
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(media_root.name, 'segments'))
+
+
+def _assign_faces(photo_ids, people, seed):
+    """Worker process: every photo shows all `people`, each with a little noise."""
+    rng = np.random.default_rng(seed)
+    for photo in TripPhoto.objects.filter(pk__in=photo_ids):
+        encodings = people + rng.normal(0, 0.01, people.shape)
+        assign_photo_faces(photo, list(encodings))
+    connections.close_all()
+
+
+@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), "needs fork() to share the test setup")
+class ParallelFaceAssignmentTests(TransactionTestCase):
+    workers = 4
+    photos_per_worker = 5
+    people = 3
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("worker processes can't share an in-memory database")
+        segment_root = tempfile.TemporaryDirectory()
+        self.addCleanup(segment_root.cleanup)
+        settings_override = override_settings(FACE_SEGMENT_ROOT=segment_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_no_duplicate_groups_with_parallel_workers(self):
+        user = CustomUser.objects.create_user(username='traveller', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Stress", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=trip, image=f"stress/{n}.jpg") for n in range(self.workers * self.photos_per_worker)]
+        )
+        # Random points in the unit cube are ~4.6 apart: clearly different people
+        people = np.random.default_rng(0).random((self.people, 128))
+
+        # Children must open their own connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(
+                target=_assign_faces,
+                args=([p.pk for p in photos[n::self.workers]], people, n)
+            )
+            for n in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=120)
+            self.assertEqual(process.exitcode, 0)
+
+        self.assertEqual(FaceGroup.objects.filter(trip=trip).count(), self.people)
+        self.assertEqual(PhotoFaceRelation.objects.filter(photo__trip=trip).count(), len(photos) * self.people)
+        self.assertEqual(
+            PhotoFaceRelation.objects.filter(photo__trip=trip).values('face_group').distinct().count(), self.people
+        )
+
+
+class ChecklistDashboardQueryTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='packer', password='x')
+        self.friends = [CustomUser.objects.create_user(username=f'friend{n}', password='x') for n in range(3)]
+        self.client.force_login(self.user)
+
+    def add_trips(self, count, owned=True):
+        """Trips with 4 items (1 done, 2 urgent), owned or shared with the user; all have other members too."""
+        trips = []
+        for n in range(count):
+            owner = self.user if owned else self.friends[0]
+            trip = Trip.objects.create(
+                user=owner, name=f"Trip {n}", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+            )
+            trip.members.add(*self.friends)
+            if not owned:
+                trip.members.add(self.user)
+            ChecklistItem.objects.bulk_create([
+                ChecklistItem(trip=trip, item_name="Passport", priority='High', is_done=True),
+                ChecklistItem(trip=trip, item_name="Tickets", priority='High'),
+                ChecklistItem(trip=trip, item_name="Charger", priority='High'),
+                ChecklistItem(trip=trip, item_name="Snacks", priority='Low'),
+            ])
+            trips.append(trip)
+        return trips
+
+    def get_dashboard(self):
+        return self.client.get(reverse('checklist_dashboard'))
+
+    def test_query_count_does_not_grow_with_trips(self):
+        self.add_trips(1)
+        self.add_trips(1, owned=False)
+        with self.assertNumQueries(4):
+            # Session, user, trips with their counts, urgent items with trip and stop
+            response = self.get_dashboard()
+        self.assertEqual(len(response.context['trips']), 2)
+
+        self.add_trips(20)
+        self.add_trips(20, owned=False)
+        with self.assertNumQueries(4):
+            response = self.get_dashboard()
+        self.assertEqual(len(response.context['trips']), 42)
+        self.assertEqual(len(response.context['urgent_items']), 84)
+
+    def test_progress_is_not_inflated_by_members(self):
+        self.add_trips(1)
+        self.add_trips(1, owned=False)
+        Trip.objects.create(user=self.user, name="Empty", destination="-", start_date='2024-01-01', end_date='2024-01-02')
+        progress = {trip.name: trip.progress for trip in self.get_dashboard().context['trips']}
+        self.assertEqual(progress, {"Trip 0": 25, "Empty": 0})
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', "reads SQLite's EXPLAIN QUERY PLAN")
+class QueryPlanTests(TestCase):
+    """The lookups behind every trip page must stay index searches: a SCAN of a table fails."""
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='planner', email='planner@example.com', password='x')
+        friend = CustomUser.objects.create_user(username='friend', email='friend@example.com', password='x')
+        self.trip = trip = Trip.objects.create(
+            user=self.user, name="Plans", destination="-", start_date='2024-01-01', end_date='2024-01-05'
+        )
+        trip.members.add(friend)
+        stop = TripItinerary.objects.create(trip=trip, location="Goa", date='2024-01-02')
+        ChecklistItem.objects.create(trip=trip, stop=stop, user=self.user, item_name="Sunscreen", priority='High')
+        ChecklistItem.objects.create(trip=trip, user=self.user, item_name="Diary", is_personal=True)
+        member = GroupMember.objects.create(trip=trip, name="Friend", contact=friend.email)
+        Expense.objects.create(trip=trip, title="Ferry", amount=10, paid_by=member, date='2024-01-02')
+        self.photo = photo = TripPhoto.objects.create(trip=trip, image="plans/1.jpg")
+        groups = FaceGroup.objects.bulk_create([FaceGroup(trip=trip, representative_encoding=b'') for _ in range(2)])
+        PhotoFaceRelation.objects.bulk_create(
+            [PhotoFaceRelation(photo=photo, face_number=n, face_group=group) for n, group in enumerate(groups)]
+        )
+        FaceMergeSuggestion.objects.create(trip=trip, group_a=groups[0], group_b=groups[1])
+        self.client.force_login(self.user)
+
+    def query_plan(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoTableScan(self, plan, sql):
+        scans = [step for step in plan if step.startswith('SCAN') and step != 'SCAN CONSTANT ROW']
+        self.assertFalse(scans, f"Full scan {scans} in:\n{sql}")
+
+    def test_hot_lookups_use_their_indexes(self):
+        trip = self.trip
+        checklist_index = ChecklistItem._meta.indexes[0].name
+        cases = [
+            # (query, text the plan must contain)
+            (trip.checklist.filter(is_personal=True, user=self.user), f'{checklist_index} (trip_id=? AND user_id=?)'),
+            (
+                trip.checklist.filter(is_personal=False).values('trip')
+                .annotate(total=Count('id'), done=Count('id', filter=Q(is_done=True))),
+                f'COVERING INDEX {checklist_index}',
+            ),
+            (trip.expenses.order_by('-date'), Expense._meta.indexes[0].name),
+            (trip.photos.order_by('-uploaded_at'), TripPhoto._meta.indexes[0].name),
+            (GroupMember.objects.filter(trip=trip, contact=self.user.email), '(trip_id=? AND contact=?)'),
+            (trip.merge_suggestions.filter(is_active=True), '(trip_id=?)'),
+            (self.photo.faces.all(), '(photo_id=?)'),
+            (
+                PhotoFaceRelation.objects.filter(face_group__in=trip.face_groups.all()).values_list('photo', 'face_group'),
+                f'COVERING INDEX {PhotoFaceRelation._meta.indexes[0].name}',
+            ),
+        ]
+        for queryset, expected in cases:
+            sql, params = queryset.query.sql_with_params()
+            with self.subTest(sql=sql):
+                plan = self.query_plan(sql, params)
+                self.assertNoTableScan(plan, sql)
+                self.assertIn(expected, '\n'.join(plan))
+                # Ordered lists come straight from the index
+                self.assertFalse([step for step in plan if 'TEMP B-TREE FOR ORDER BY' in step])
+
+    def test_trip_pages_never_scan(self):
+        urls = [reverse('trip_detail', args=[self.trip.pk])]
+        urls += [reverse('trip_tab', args=[self.trip.pk, tab]) for tab in (
+            'itinerary', 'checklist', 'members', 'expenses', 'photos', 'splitter', 'reports'
+        )]
+        urls += [reverse('trip_list'), reverse('dashboard'), reverse('checklist_dashboard')]
+        for url in urls:
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            for query in queries.captured_queries:
+                if query['sql'].startswith('SELECT'):
+                    with self.subTest(url=url, sql=query['sql']):
+                        self.assertNoTableScan(self.query_plan(query['sql']), query['sql'])
+
+
+class ReprocessFacesTests(MediaTestMixin, TestCase):
+    # Photo -> people in it (both detected from the cache)
+    faces = [['alice'], ['alice', 'bob'], ['bob']]
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(username='reprocessor', password='x')
+        self.trip = Trip.objects.create(
+            user=self.user, name="Again", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        rng = np.random.default_rng(1)
+        people = dict(zip(['alice', 'bob'], rng.random((2, 128))))
+
+        stub = face_library_stub()
+        stub.start()
+        self.addCleanup(stub.stop)
+        params = detection_params(sys.modules['face_recognition'])
+
+        self.photos = []
+        for n, names in enumerate(self.faces):
+            content = jpeg_bytes((40 * n, 0, 0))
+            name = default_storage.save(f'trip_photos/{n}.jpg', ContentFile(content))
+            photo = TripPhoto.objects.create(
+                trip=self.trip, image=name, content_hash=hashlib.sha256(content).hexdigest()
+            )
+            encodings = [people[person] for person in names]
+            FaceDetectionResult.objects.create(
+                content_hash=photo.content_hash, boxes=[[10, 60, 60, 10]] * len(names),
+                encodings=encode_matrix(encodings), skipped={}, **params
+            )
+            for group, _ in assign_photo_faces(photo, encodings):
+                group.thumbnail.save(f'face_{photo.id}.jpg', ContentFile(jpeg_bytes('white')))
+            self.photos.append(photo)
+
+        self.alice = FaceGroup.objects.get(tagged_photos__photo=self.photos[0])
+        self.alice.name = "Alice"
+        self.alice.save()
+        self.old_thumbnails = list(FaceGroup.objects.values_list('thumbnail', flat=True))
+
+    def reprocess(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('reprocess_faces', self.trip.pk, stdout=io.StringIO())
+
+    def test_names_survive_reprocessing(self):
+        self.reprocess()
+
+        groups = FaceGroup.objects.filter(trip=self.trip)
+        self.assertEqual(sorted(groups.values_list('name', flat=True)), ["Alice", "Unknown Person"])
+        self.assertFalse(groups.filter(pk=self.alice.pk).exists())
+        alice = groups.get(name="Alice")
+        self.assertEqual(
+            set(alice.tagged_photos.values_list('photo_id', flat=True)), {self.photos[0].pk, self.photos[1].pk}
+        )
+        # Old thumbnails are gone, the new groups have their own
+        for name in self.old_thumbnails:
+            self.assertFalse(default_storage.exists(name))
+        for group in groups:
+            self.assertTrue(group.thumbnail and default_storage.exists(group.thumbnail.name))
+
+    def test_failure_part_way_keeps_the_old_groups(self):
+        before = set(FaceGroup.objects.values_list('pk', 'name'))
+        tags_before = set(PhotoFaceRelation.objects.values_list('photo_id', 'face_group_id'))
+        calls = []
+
+        def failing_assign(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError("worker killed")
+            return assign_photo_faces(*args, **kwargs)
+
+        with mock.patch('travel.management.commands.reprocess_faces.assign_photo_faces', failing_assign):
+            with self.assertRaises(RuntimeError):
+                self.reprocess()
+
+        self.assertEqual(set(FaceGroup.objects.values_list('pk', 'name')), before)
+        self.assertEqual(set(PhotoFaceRelation.objects.values_list('photo_id', 'face_group_id')), tags_before)
+        for name in self.old_thumbnails:
+            self.assertTrue(default_storage.exists(name))
+
+
+class ExpenseImportTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username='importer', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Statement", destination="-", start_date='2024-01-01', end_date='2024-01-09'
+        )
+        self.alice = GroupMember.objects.create(trip=self.trip, name="Alice", contact="alice@example.com")
+        self.bob = GroupMember.objects.create(trip=self.trip, name="Bob", contact="bob@example.com")
+
+    def test_category_from_title(self):
+        cases = {
+            "Business class upgrade": 'Other',
+            "Busy Bee Bakery": 'Other',
+            "Cabin crew tip": 'Other',
+            "Hotelier association fee": 'Other',
+            "City buses": 'Travel',
+            "Cab to airport": 'Travel',
+            "Railway reservation": 'Travel',
+            "Two hotels": 'Stay',
+            "Weekly groceries": 'Food',
+            "Grocery run": 'Food',
+            "Souvenir shops": 'Shopping',
+        }
+        for title, category in cases.items():
+            with self.subTest(title=title):
+                self.assertEqual(parse_category('', title), category)
+        # A category column wins over the title
+        self.assertEqual(parse_category('stay', "Cab to airport"), 'Stay')
+        self.assertEqual(parse_category('Fuel', "Shell"), 'Travel')
+
+    def test_import_report_and_payers(self):
+        lines = [
+            "Date,Description,Debit,Credit,Paid By",
+            "01/01/2024,Dinner at Leela,\"1,200.50\",,alice",
+            "02/01/2024,Salary,,5000,",
+            "03/01/2024,Taxi,abc,,alice",
+            "04/01/2024,Ferry tickets,300,,bob@example.com",
+            "05/01/2024,Museum,150,,Carol",
+            "06/01/2024,,90,,bob",
+            "07/01/2024,Hostel,(800),,",
+        ]
+        report = import_expenses(self.trip, lines, default_payer='Bob')
+
+        self.assertEqual(report['rows'], 7)
+        self.assertEqual(report['created'], 3)
+        self.assertEqual(report['skipped'], 1)
+        self.assertEqual(report['failed'], 3)
+        self.assertEqual([entry['line'] for entry in report['errors']], [4, 6, 7])
+        self.assertIn("Invalid amount", report['errors'][0]['error'])
+        self.assertIn("Unknown member", report['errors'][1]['error'])
+
+        expenses = {e.title: e for e in self.trip.expenses.all()}
+        self.assertEqual(set(expenses), {"Dinner at Leela", "Ferry tickets", "Hostel"})
+        self.assertEqual(expenses["Dinner at Leela"].paid_by, self.alice)
+        self.assertEqual(expenses["Dinner at Leela"].amount, Decimal('1200.50'))
+        self.assertEqual(expenses["Dinner at Leela"].category, 'Food')
+        self.assertEqual(expenses["Ferry tickets"].paid_by, self.bob)
+        self.assertEqual(expenses["Hostel"].paid_by, self.bob)
+        self.assertEqual(expenses["Hostel"].amount, Decimal('800'))
+
+    def test_large_file_is_written_in_chunks(self):
+        lines = ["date,title,amount,paid_by"]
+        lines += [f"2024-01-0{n % 9 + 1},Snack {n},{n + 1},Alice" for n in range(25)]
+        with mock.patch('travel.expense_import.add_expenses', wraps=add_expenses) as bulk_write:
+            report = import_expenses(self.trip, lines, chunk_size=10)
+
+        self.assertEqual(report['created'], 25)
+        self.assertEqual([len(call.args[1]) for call in bulk_write.call_args_list], [10, 10, 5])
+        self.assertEqual(self.trip.expenses.count(), 25)
+        self.assertEqual(self.trip.expenses.aggregate(total=Sum('amount'))['total'], sum(range(1, 26)))
+
+
+class FaceTagTests(MediaTestMixin, TestCase):
+    """Every detected face is stored with its own encoding, even two of one person in one photo."""
+
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='twins', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Mirror", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=self.trip, image=f"mirror/{n}.jpg") for n in range(3)]
+        )
+        self.person = np.random.default_rng(2).random(128)
+
+    def test_two_faces_of_one_person_are_both_kept(self):
+        # A person and their reflection: both within the strict distance of each other
+        faces = [self.person, self.person + 0.01]
+        assign_photo_faces(self.photos[0], faces)
+
+        group = FaceGroup.objects.get(trip=self.trip)
+        stored = [decode_encoding(raw) for raw in group.tagged_photos.order_by('id').values_list('encoding', flat=True)]
+        self.assertEqual(len(stored), 2)
+        for encoding, face in zip(stored, faces):
+            self.assertTrue(np.allclose(encoding, face, atol=1e-6))
+
+        recluster_trip(self.trip)
+        self.assertEqual(group.tagged_photos.filter(encoding__isnull=False).count(), 2)
+
+    def test_each_face_is_tagged_once(self):
+        assign_photo_faces(self.photos[0], [self.person, self.person + 0.01])
+        numbers = self.photos[0].faces.order_by('face_number').values_list('face_number', flat=True)
+        self.assertEqual(list(numbers), [0, 1])
+        # Assigning the photo again (a retried job) replaces its tags
+        assign_photo_faces(self.photos[0], [self.person, self.person + 0.01])
+        self.assertEqual(self.photos[0].faces.count(), 2)
+
+        group = self.photos[0].faces.first().face_group
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            PhotoFaceRelation.objects.create(photo=self.photos[0], face_number=1, face_group=group)
+
+    def test_merge_target_counts_photos_not_faces(self):
+        other = np.random.default_rng(3).random(128)
+        assign_photo_faces(self.photos[0], [self.person, self.person + 0.01, self.person - 0.01])
+        assign_photo_faces(self.photos[1], [other])
+        assign_photo_faces(self.photos[2], [other])
+        crowd = self.photos[0].faces.first().face_group
+        pair = self.photos[1].faces.first().face_group
+
+        self.assertEqual(pick_merge_target([crowd.id, pair.id]), pair)
+
+
+class TripLedgerTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username='accountant', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Split", destination="-", start_date='2024-01-01', end_date='2024-01-05'
+        )
+        self.members = [GroupMember.objects.create(trip=self.trip, name=name) for name in ("Asha", "Ben", "Chen")]
+
+    def add_expenses(self, count):
+        for n in range(count):
+            save_expense(Expense(
+                trip=self.trip, title=f"Expense {n}", amount=Decimal('10.25') * (n % 4 + 1),
+                paid_by=self.members[n % 3], category=['Food', 'Stay', ''][n % 3], date=f'2024-01-0{n % 5 + 1}'
+            ))
+
+    def naive_balances(self):
+        """Balances the way the splitter used to compute them: a loop over every row."""
+        expenses = list(self.trip.expenses.all())
+        settlements = list(self.trip.settlements.all())
+        share = sum((e.amount for e in expenses), Decimal('0')) / len(self.members)
+        balances = {}
+        for member in self.members:
+            paid = sum((e.amount for e in expenses if e.paid_by_id == member.pk), Decimal('0'))
+            made = sum((s.amount for s in settlements if s.payer_id == member.pk), Decimal('0'))
+            received = sum((s.amount for s in settlements if s.payee_id == member.pk), Decimal('0'))
+            balances[member.pk] = paid + made - received - share
+        return balances
+
+    def test_balances_match_the_expense_rows(self):
+        self.add_expenses(12)
+        save_expense(Expense(trip=self.trip, title="Nobody's", amount=Decimal('7.50'), date='2024-01-02'))
+        record_settlement(
+            trip=self.trip, payer=self.members[1], payee=self.members[0], amount=Decimal('20'), date='2024-01-03'
+        )
+
+        ledger = TripLedger(self.trip)
+        self.assertEqual(
+            {row['member'].pk: row['balance'] for row in ledger.member_balances()}, self.naive_balances()
+        )
+        self.assertEqual(ledger.total_expense, sum(e.amount for e in self.trip.expenses.all()))
+        self.assertEqual(ledger.category_totals(), {
+            category: sum(e.amount for e in self.trip.expenses.all() if (e.category or "Other") == category)
+            for category in ("Food", "Stay", "Other")
+        })
+
+    def test_query_count_does_not_grow_with_expenses(self):
+        self.add_expenses(3)
+        with self.assertNumQueries(4):
+            TripLedger(self.trip).member_balances()
+        self.add_expenses(60)
+        with self.assertNumQueries(4):
+            TripLedger(self.trip).member_balances()
+
+
+def fewest_transfers(amounts):
+    """Brute force: settle the first open balance against every counterpart in turn."""
+    amounts = [amount for amount in amounts if amount]
+    if not amounts:
+        return 0
+    first, rest = amounts[0], amounts[1:]
+    return min(
+        1 + fewest_transfers(rest[:n] + [amount + first] + rest[n + 1:])
+        for n, amount in enumerate(rest) if amount * first < 0
+    )
+
+
+class SettlementTests(SimpleTestCase):
+    def assertSettles(self, balances, transfers):
+        left = dict(balances)
+        for debtor, creditor, amount in transfers:
+            self.assertIsInstance(amount, int)
+            self.assertGreater(amount, 0)
+            left[debtor] += amount
+            left[creditor] -= amount
+        self.assertFalse(any(left.values()), left)
+
+    def random_balances(self, rng, size):
+        amounts = [rng.randint(-5000, 5000) for _ in range(size - 1)]
+        return dict(enumerate(amounts + [-sum(amounts)]))
+
+    def test_minimum_number_of_transfers(self):
+        rng = random.Random(7)
+        for _ in range(150):
+            balances = self.random_balances(rng, rng.randint(2, 7))
+            with self.subTest(balances=balances):
+                transfers = settle(balances)
+                self.assertSettles(balances, transfers)
+                self.assertEqual(len(transfers), fewest_transfers(list(balances.values())))
+
+        # a and c settle between themselves; largest-first matching would need 5 transfers
+        balances = {'a': -700, 'b': -800, 'c': 700, 'd': -800, 'e': 600, 'f': 1000}
+        self.assertEqual(len(settle(balances)), 4)
+        self.assertIn(('a', 'c', 700), settle(balances))
+
+    def test_greedy_for_large_groups(self):
+        rng = random.Random(8)
+        balances = self.random_balances(rng, 40)
+        transfers = settle(balances)
+        self.assertSettles(balances, transfers)
+        self.assertLessEqual(len(transfers), 39)
+
+    def test_minor_units(self):
+        self.assertEqual(to_minor_units(Decimal('10.005')), 1001)
+        self.assertEqual(to_minor_units(Decimal('0.1') + Decimal('0.2')), 30)
+        self.assertEqual(split_evenly(10000, 3), [3334, 3333, 3333])
+        self.assertEqual(sum(split_evenly(99, 7)), 99)
+
+
+class SuggestedSettlementTests(TestCase):
+    def test_trip_settles_to_the_cent(self):
+        user = CustomUser.objects.create_user(username='splitter', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Thirds", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        members = [GroupMember.objects.create(trip=trip, name=name) for name in ("Asha", "Ben", "Chen")]
+        save_expense(Expense(trip=trip, title="Boat", amount=Decimal('100.00'), paid_by=members[0], date='2024-01-01'))
+        save_expense(Expense(trip=trip, title="Tea", amount=Decimal('0.10'), paid_by=members[1], date='2024-01-01'))
+
+        ledger = TripLedger(trip)
+        self.assertEqual(sum(ledger.minor_unit_balances().values()), 0)
+        paid_back = sum(t['amount'] for t in ledger.suggested_settlements() if t['to'] == "Asha")
+        # Asha's share is 33.37 of the 100.10
+        self.assertEqual(paid_back, Decimal('66.63'))
+
+
+class ExpenseRollupTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username='roller', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Rollups", destination="-", start_date='2024-01-01', end_date='2024-01-05'
+        )
+        self.asha = GroupMember.objects.create(trip=self.trip, name="Asha")
+        self.ben = GroupMember.objects.create(trip=self.trip, name="Ben")
+
+    def assertNoDrift(self, trip=None):
+        self.assertEqual(rollup_drift((trip or self.trip).pk), {})
+
+    def test_edits_and_deletes(self):
+        lunch = save_expense(Expense(
+            trip=self.trip, title="Lunch", amount=Decimal('12.40'), paid_by=self.asha, category='Food', date='2024-01-01'
+        ))
+        save_expense(Expense(trip=self.trip, title="Bus", amount=Decimal('3.10'), paid_by=self.ben, date='2024-01-01'))
+        self.assertNoDrift()
+
+        # Every part of the key changes, and the amount (form data arrives as strings)
+        lunch.amount, lunch.category, lunch.paid_by, lunch.date = '15.00', 'Stay', self.ben, '2024-01-03'
+        save_expense(lunch)
+        self.assertNoDrift()
+
+        settlement = record_settlement(
+            trip=self.trip, payer=self.asha, payee=self.ben, amount=Decimal('5.55'), date='2024-01-02'
+        )
+        self.assertNoDrift()
+        delete_settlement(settlement)
+        delete_expense(lunch)
+        self.assertNoDrift()
+        self.assertEqual(self.trip.expense_rollups.count(), 1)
+
+    def test_expense_moved_to_another_trip(self):
+        other = Trip.objects.create(
+            user=self.trip.user, name="Other", destination="-", start_date='2024-01-01', end_date='2024-01-05'
+        )
+        expense = save_expense(Expense(trip=self.trip, title="Taxi", amount=Decimal('8'), date='2024-01-02'))
+        expense.trip = other
+        save_expense(expense)
+        self.assertNoDrift()
+        self.assertNoDrift(other)
+        self.assertFalse(self.trip.expense_rollups.exists())
+
+    def test_import(self):
+        lines = ["date,title,amount,paid_by,category"]
+        lines += [f"2024-01-0{n % 5 + 1},Item {n},{n}.{n % 10}5,{'Asha' if n % 2 else 'Ben'},Food" for n in range(1, 40)]
+        report = import_expenses(self.trip, lines, chunk_size=7)
+        self.assertEqual(report['created'], 39)
+        self.assertNoDrift()
+
+    def test_rebuild_repairs_bypassing_writes(self):
+        save_expense(Expense(trip=self.trip, title="Hotel", amount=Decimal('80'), paid_by=self.asha, date='2024-01-01'))
+        # The admin and queryset updates bypass the rollups
+        self.trip.expenses.update(amount=Decimal('90'))
+        self.assertTrue(rollup_drift(self.trip.pk))
+        rebuild_trip_rollups(self.trip.pk)
+        self.assertNoDrift()
+
+
+class ForecastTests(TestCase):
+    def setUp(self):
+        forecast._cache.clear()
+        self.addCleanup(forecast._cache.clear)
+        user = CustomUser.objects.create_user(username='forecaster', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Budget", destination="-", start_date='2024-01-01', end_date='2024-01-04', budget=100
+        )
+        for day, amount in (('2024-01-01', 10), ('2024-01-02', 30)):
+            save_expense(Expense(trip=self.trip, title="Meals", amount=amount, category='Food', date=day))
+        self.trip.refresh_from_db()
+        self.today = date(2024, 1, 2)
+
+    def test_projections(self):
+        result = forecast.compute_forecast(self.trip, self.today)
+        self.assertEqual((result['days_passed'], result['days_remaining']), (2, 2))
+        self.assertAlmostEqual(result['daily_avg'], 20)
+        # EWMA (span 3): (0.5 * 10 + 30) / 1.5 per day for 2 more days
+        self.assertAlmostEqual(result['projected_total'], 40 + 2 * 35 / 1.5)
+        # Trend 10, 30 -> 50, 70
+        self.assertAlmostEqual(result['trend_total'], 160)
+        self.assertAlmostEqual(result['safe_daily_limit'], 30)
+        self.assertEqual(result['budget_status'], "Likely to Exceed Budget")
+        self.assertEqual([c['category'] for c in result['categories']], ['Food'])
+
+    def test_cache_follows_expense_version(self):
+        with mock.patch.object(forecast, 'compute_forecast', wraps=forecast.compute_forecast) as compute:
+            first = forecast.trip_forecast(self.trip, self.today)
+            self.assertIs(forecast.trip_forecast(self.trip, self.today), first)
+            self.assertEqual(compute.call_count, 1)
+
+            save_expense(Expense(trip=self.trip, title="Hostel", amount=20, category='Stay', date='2024-01-02'))
+            self.trip.refresh_from_db()
+            second = forecast.trip_forecast(self.trip, self.today)
+            self.assertEqual(compute.call_count, 2)
+            self.assertAlmostEqual(second['categories'][1]['spent'], 20)
+
+    @override_settings(FORECAST_CACHE_SIZE=1)
+    def test_least_recently_used_trip_is_evicted(self):
+        other = Trip.objects.create(
+            user=self.trip.user, name="Other", destination="-", start_date='2024-01-01', end_date='2024-01-04'
+        )
+        other.refresh_from_db()
+        forecast.trip_forecast(self.trip, self.today)
+        forecast.trip_forecast(other, self.today)
+        self.assertEqual(list(forecast._cache), [other.pk])
+
+
+class TripTabTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = CustomUser.objects.create_user(username='owner', email='owner@example.com', password='x')
+        self.member = CustomUser.objects.create_user(username='member', email='member@example.com', password='x')
+        self.stranger = CustomUser.objects.create_user(username='stranger', email='stranger@example.com', password='x')
+        self.trip = Trip.objects.create(
+            user=self.owner, name="Tabs", destination="-", start_date='2024-01-01', end_date='2024-01-03'
+        )
+        self.trip.members.add(self.member)
+        paid_by = GroupMember.objects.create(trip=self.trip, name="Owner", contact=self.owner.email)
+        save_expense(Expense(trip=self.trip, title="Gondola ride", amount=25, paid_by=paid_by, date='2024-01-02'))
+
+    def get_tab(self, tab):
+        return self.client.get(reverse('trip_tab', args=[self.trip.pk, tab]))
+
+    def test_every_tab_checks_membership(self):
+        for tab in TRIP_TABS:
+            with self.subTest(tab=tab):
+                self.client.logout()
+                response = self.get_tab(tab)
+                self.assertEqual(response.status_code, 302)
+                self.assertIn(reverse('login'), response['Location'])
+
+                for user, status in ((self.owner, 200), (self.member, 200), (self.stranger, 404)):
+                    self.client.force_login(user)
+                    self.assertEqual(self.get_tab(tab).status_code, status, user.username)
+
+    def test_unknown_tab(self):
+        self.client.force_login(self.owner)
+        self.assertEqual(self.get_tab('secrets').status_code, 404)
+
+    def test_shell_leaves_tab_content_to_the_fragments(self):
+        self.client.force_login(self.member)
+        shell = self.client.get(reverse('trip_detail', args=[self.trip.pk]))
+        self.assertEqual(shell.status_code, 200)
+        self.assertNotContains(shell, "Gondola ride")
+        for tab in TRIP_TABS:
+            self.assertContains(shell, reverse('trip_tab', args=[self.trip.pk, tab]))
+        self.assertContains(self.get_tab('expenses'), "Gondola ride")
+
+
+@override_settings(REQUEST_METRICS_ENABLED=True, REQUEST_METRICS_TOKEN='scrape-me', REQUEST_METRICS_QUERY_BUDGET=50)
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics_registry.reset()
+        self.addCleanup(metrics_registry.reset)
+        self.user = CustomUser.objects.create_user(username='measured', password='x')
+
+    def scrape(self, **headers):
+        return self.client.get(reverse('metrics'), headers=headers)
+
+    def test_access(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(Authorization='Bearer wrong').status_code, 403)
+        self.assertEqual(self.scrape(Authorization='Bearer scrape-me').status_code, 200)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.scrape().status_code, 200)
+
+    @override_settings(REQUEST_METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.assertEqual(self.scrape(Authorization='Bearer scrape-me').status_code, 404)
+
+    def test_views_are_reported(self):
+        self.client.force_login(self.user)
+        for _ in range(2):
+            self.assertEqual(self.client.get(reverse('trip_list')).status_code, 200)
+        self.client.logout()
+
+        response = self.scrape(Authorization='Bearer scrape-me')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE travel_request_duration_seconds histogram', text)
+        self.assertIn('travel_request_duration_seconds_count{view="trip_list"} 2', text)
+        self.assertIn('travel_request_queries_bucket{view="trip_list",le="+Inf"} 2', text)
+        self.assertIn('travel_request_query_budget_exceeded_total{view="trip_list"} 0', text)
+        slow = [line for line in text.splitlines() if line.startswith('travel_slow_query_seconds{view="trip_list"')]
+        self.assertTrue(slow)
+
+    def test_statements_are_normalized(self):
+        # Literals are stripped, so the user's id doesn't make every statement unique
+        self.assertEqual(
+            normalize_sql("SELECT *\n  FROM t WHERE id = 42 AND name = 'O''Hara'"),
+            "SELECT * FROM t WHERE id = ? AND name = ?"
+        )
+
+    @override_settings(REQUEST_METRICS_QUERY_BUDGET=1)
+    def test_query_budget(self):
+        self.client.force_login(self.user)
+        with self.assertLogs('travel.metrics', 'WARNING') as logs:
+            self.client.get(reverse('trip_list'))
+        self.assertIn("trip_list ran", logs.output[0])
+        self.assertIn('travel_request_query_budget_exceeded_total{view="trip_list"} 1', metrics_registry.render())
+
+
+class TripPageCacheTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.owner = CustomUser.objects.create_user(username='cached', email='cached@example.com', password='x')
+        self.trip = trip = Trip.objects.create(
+            user=self.owner, name="Cached", destination="-", start_date='2024-01-01', end_date='2024-01-03'
+        )
+        self.member = GroupMember.objects.create(trip=trip, name="Friend", contact='friend@example.com')
+        self.owner_member = GroupMember.objects.create(trip=trip, name="Me", contact=self.owner.email)
+        self.stop = TripItinerary.objects.create(trip=trip, location="Goa", date='2024-01-02')
+        self.item = ChecklistItem.objects.create(trip=trip, user=self.owner, item_name="Hat")
+        self.expense = save_expense(
+            Expense(trip=trip, title="Ferry", amount=10, paid_by=self.member, date='2024-01-02')
+        )
+        self.settlement = record_settlement(
+            trip=trip, payer=self.member, payee=self.owner_member, amount=5, date='2024-01-02'
+        )
+        image = default_storage.save('p.jpg', ContentFile(jpeg_bytes('red')))
+        self.photo = TripPhoto.objects.create(trip=trip, image=image)
+        self.groups = FaceGroup.objects.bulk_create(
+            [FaceGroup(trip=trip, representative_encoding=b'') for _ in range(2)]
+        )
+        PhotoFaceRelation.objects.bulk_create(
+            [PhotoFaceRelation(photo=self.photo, face_number=n, face_group=g) for n, g in enumerate(self.groups)]
+        )
+        self.suggestion = FaceMergeSuggestion.objects.create(trip=trip, group_a=self.groups[0], group_b=self.groups[1])
+        self.client.force_login(self.owner)
+        self.url = reverse('trip_detail', args=[trip.pk])
+
+    def etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_conditional_get(self):
+        first = self.client.get(self.url)
+        self.assertIn('private', first['Cache-Control'])
+        self.assertIn('no-cache', first['Cache-Control'])
+        revalidated = self.client.get(self.url, headers={'If-None-Match': first['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], first['ETag'])
+
+        # Another browser gets the stored copy without the page being rendered again
+        with mock.patch('travel.views.render') as render:
+            self.assertEqual(self.client.get(self.url).content, first.content)
+        render.assert_not_called()
+
+        # Someone else sees their own page
+        other = CustomUser.objects.create_user(username='other', password='x')
+        self.trip.members.add(other)
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': first['ETag']}).status_code, 200)
+
+    def test_every_write_invalidates_the_page(self):
+        pk = self.trip.pk
+        writes = {
+            'expense added': lambda: self.client.post(self.url, {
+                'add_expense': '1', 'title': "Taxi", 'amount': '4', 'paid_by': self.member.pk,
+                'category': 'Travel', 'date': '2024-01-02',
+            }),
+            'expense deleted': lambda: self.client.get(reverse('delete_expense', args=[self.expense.pk])),
+            'stop added': lambda: self.client.post(self.url, {'location': "Pune", 'date': '2024-01-03'}),
+            'stop deleted': lambda: self.client.get(reverse('delete_stop', args=[self.stop.pk])),
+            'checklist item added': lambda: self.client.post(self.url, {
+                'add_checklist_item': '1', 'item_name': "Map", 'priority': 'Low',
+            }),
+            'checklist item toggled': lambda: self.client.get(reverse('checklist_toggle', args=[self.item.pk])),
+            'checklist item deleted': lambda: self.client.get(reverse('checklist_delete', args=[self.item.pk])),
+            'settlement deleted': lambda: self.client.get(reverse('delete_settlement', args=[self.settlement.pk])),
+            'member deleted': lambda: self.client.get(reverse('delete_member', args=[self.member.pk])),
+            'photo uploaded': lambda: self.client.post(reverse('upload_trip_photos', args=[pk]), {
+                'images': SimpleUploadedFile('new.jpg', jpeg_bytes('blue'), content_type='image/jpeg'),
+            }),
+            'face group renamed': lambda: self.client.post(
+                reverse('rename_face_group', args=[self.groups[0].pk]), {'folder_name': "Asha"}
+            ),
+            'suggestion dismissed': lambda: self.client.get(
+                reverse('manage_face_suggestion', args=[self.suggestion.pk, 'dismiss'])
+            ),
+            'face groups merged': lambda: self.client.get(
+                reverse('manage_face_suggestion', args=[self.suggestion.pk, 'merge'])
+            ),
+            'face group deleted': lambda: self.client.get(reverse('delete_face_group', args=[self.groups[0].pk])),
+            'photo deleted': lambda: self.client.get(reverse('delete_trip_photo', args=[self.photo.pk])),
+        }
+        for write, action in writes.items():
+            with self.subTest(write):
+                etag = self.etag()
+                version = Trip.objects.get(pk=pk).version
+                self.assertEqual(action().status_code, 302)
+                self.assertGreater(Trip.objects.get(pk=pk).version, version)
+                # Flash messages (shown by the members tab) keep pages out of the cache until read
+                self.client.get(reverse('trip_tab', args=[pk, 'members']))
+                self.assertNotEqual(self.etag(), etag)
+
+
+class TripFaceIndexTests(MediaTestMixin, TestCase):
+    def test_match_orders_strict_and_maybe_groups(self):
+        rng = np.random.default_rng(4)
+        base = rng.random(128)
+        direction = rng.normal(size=128)
+        direction /= np.linalg.norm(direction)
+        # Groups 10..13 at distances 0.2, 0.5, 0.1 and 1.0 from base
+        index = TripFaceIndex(1)
+        for group_id, distance in ((10, 0.2), (11, 0.5), (12, 0.1), (13, 1.0)):
+            index.append(group_id, base + direction * distance)
+
+        self.assertEqual(index.match(base, strict=0.45, maybe=0.65), ([12, 10], [11]))
+        self.assertEqual(index.match(base, strict=0.05, maybe=0.15), ([], [12]))
+        self.assertEqual(TripFaceIndex(1).match(base), ([], []))
+        self.assertTrue(np.allclose(index.distances(base), [0.2, 0.5, 0.1, 1.0], atol=1e-5))
+
+    def test_append_grows_past_initial_arrays(self):
+        matrix = np.random.default_rng(5).random((3, 128))
+        index = TripFaceIndex(1, matrix, [1, 2, 3])
+        for group_id in range(4, 40):
+            index.append(group_id, matrix[0])
+        self.assertEqual(len(index), 39)
+        self.assertEqual(index.group_ids.tolist(), list(range(1, 40)))
+        self.assertEqual(index.matrix.shape, (39, 128))
+
+    def test_assign_photo_faces(self):
+        user = CustomUser.objects.create_user(username='matcher', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Match", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        photos = TripPhoto.objects.bulk_create([TripPhoto(trip=trip, image=f"match/{n}.jpg") for n in range(3)])
+        rng = np.random.default_rng(6)
+        alice = rng.random(128)
+        direction = rng.normal(size=128)
+        direction /= np.linalg.norm(direction)
+
+        new = assign_photo_faces(photos[0], [alice])
+        self.assertEqual([face for _, face in new], [0])
+        # Same person again: no new group
+        self.assertEqual(assign_photo_faces(photos[1], [alice + direction * 0.1]), [])
+        # Between strict and maybe: a new group with a merge suggestion
+        new = assign_photo_faces(photos[2], [alice + direction * 0.55])
+        self.assertEqual(len(new), 1)
+        self.assertEqual(FaceGroup.objects.filter(trip=trip).count(), 2)
+        suggestion = FaceMergeSuggestion.objects.get(trip=trip)
+        self.assertEqual(
+            {suggestion.group_a_id, suggestion.group_b_id}, set(FaceGroup.objects.values_list('id', flat=True))
+        )
+        self.assertEqual(PhotoFaceRelation.objects.filter(photo__trip=trip).count(), 3)
+
+
+@mock.patch('travel.jobs.create_photo_renditions', lambda photo: None)
+class FaceJobTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(username='queued', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Queue", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.photos = TripPhoto.objects.bulk_create([TripPhoto(trip=trip, image=f"queue/{n}.jpg") for n in range(2)])
+        self.job = jobs.enqueue_photos(self.photos)[0]
+
+    def test_claimed_once(self):
+        self.assertTrue(jobs.claim_job(self.job.pk))
+        self.assertFalse(jobs.claim_job(self.job.pk))
+        self.job.refresh_from_db()
+        self.assertEqual((self.job.status, self.job.attempts), (FaceProcessingJob.RUNNING, 1))
+        self.assertEqual(jobs.pending_job_ids(), [FaceProcessingJob.objects.get(photo=self.photos[1]).pk])
+
+    def test_retries_then_fails(self):
+        with mock.patch('travel.jobs.process_photo_faces', side_effect=OSError("unreadable")) as process:
+            statuses = [jobs.run_job(self.job.pk, max_attempts=3) for _ in range(4)]
+        self.assertEqual(
+            statuses, [FaceProcessingJob.PENDING, FaceProcessingJob.PENDING, FaceProcessingJob.FAILED, None]
+        )
+        self.assertEqual(process.call_count, 3)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.attempts, 3)
+        self.assertIn("unreadable", self.job.last_error)
+
+        # A manual requeue starts over
+        jobs.requeue_photo(self.photos[0])
+        with mock.patch('travel.jobs.process_photo_faces'):
+            self.assertEqual(jobs.run_job(self.job.pk), FaceProcessingJob.DONE)
+        self.job.refresh_from_db()
+        self.assertIsNone(self.job.last_error)
+
+    def test_stale_running_jobs_are_requeued(self):
+        jobs.claim_job(self.job.pk)
+        FaceProcessingJob.objects.filter(pk=self.job.pk).update(started_at='2024-01-01T00:00:00Z')
+        version = self.trip_version()
+        self.assertEqual(jobs.requeue_stale_jobs(600), 1)
+        self.assertIn(self.job.pk, jobs.pending_job_ids())
+        self.assertEqual(self.trip_version(), version + 1)
+
+    def trip_version(self):
+        return Trip.objects.values_list('version', flat=True).get(pk=self.photos[0].trip_id)
+
+    def test_status_changes_invalidate_trip_pages(self):
+        # The photos tab shows "running" as soon as a worker has the job
+        version = self.trip_version()
+        self.assertTrue(jobs.claim_job(self.job.pk))
+        self.assertEqual(self.trip_version(), version + 1)
+        self.assertFalse(jobs.claim_job(self.job.pk))
+        self.assertEqual(self.trip_version(), version + 1)
+
+
+@mock.patch('travel.jobs.create_photo_renditions', lambda photo: None)
+class FaceJobRetryTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='retried', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Retry", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        stub = face_library_stub()
+        stub.start()
+        self.addCleanup(stub.stop)
+
+        content = jpeg_bytes('yellow')
+        self.photo = TripPhoto.objects.create(
+            trip=trip, image=default_storage.save('trip_photos/one.jpg', ContentFile(content)),
+            content_hash=hashlib.sha256(content).hexdigest()
+        )
+        # One face, detected from the cache
+        FaceDetectionResult.objects.create(
+            content_hash=self.photo.content_hash, boxes=[[10, 60, 60, 10]],
+            encodings=encode_matrix([np.random.default_rng(20).random(128)]), skipped={},
+            **detection_params(sys.modules['face_recognition'])
+        )
+        self.job = jobs.enqueue_photos([self.photo])[0]
+
+    def assert_tagged_once(self):
+        self.assertEqual(self.photo.faces.count(), 1)
+        self.assertEqual(FaceGroup.objects.count(), 1)
+
+    def test_retry_after_a_failure_past_the_commit(self):
+        with mock.patch('travel.utils.save_missing_thumbnails', side_effect=RuntimeError("disk full")):
+            self.assertEqual(jobs.run_job(self.job.pk), FaceProcessingJob.PENDING)
+        self.assert_tagged_once()
+
+        self.assertEqual(jobs.run_job(self.job.pk), FaceProcessingJob.DONE)
+        self.assert_tagged_once()
+        self.assertTrue(FaceGroup.objects.get().thumbnail)
+
+    def test_failed_thumbnail_is_cut_on_the_next_run(self):
+        with mock.patch('travel.utils.face_thumbnail', side_effect=OSError("unreadable")):
+            self.assertEqual(jobs.run_job(self.job.pk), FaceProcessingJob.DONE)
+        self.assert_tagged_once()
+        self.assertFalse(FaceGroup.objects.get().thumbnail)
+
+        # e.g. a stale job handed back while its first worker was only slow
+        jobs.requeue_photo(self.photo)
+        self.assertEqual(jobs.run_job(self.job.pk), FaceProcessingJob.DONE)
+        self.assert_tagged_once()
+        self.assertTrue(FaceGroup.objects.get().thumbnail)
+
+
+class EncodingStorageTests(SimpleTestCase):
+    def test_encoding_round_trip(self):
+        encoding = np.random.default_rng(9).random(128)
+        raw = encode_encoding(encoding)
+        self.assertEqual(len(raw), 4 + 128 * 4)
+        self.assertTrue(is_encoded(raw))
+
+        decoded = decode_encoding(memoryview(raw))
+        self.assertEqual(decoded.dtype, np.float32)
+        self.assertTrue(np.allclose(decoded, encoding, atol=1e-6))
+        self.assertFalse(decoded.flags.writeable)
+
+    def test_rejects_other_formats(self):
+        legacy = pickle.dumps(np.zeros(128))
+        self.assertFalse(is_encoded(legacy))
+        for raw in (b'', legacy, encode_encoding(np.zeros(128))[:-1]):
+            with self.subTest(raw=raw[:8]):
+                with self.assertRaises(ValueError):
+                    decode_encoding(raw)
+
+    def test_matrix_round_trip(self):
+        matrix = np.random.default_rng(10).random((5, 128))
+        self.assertTrue(np.allclose(decode_matrix(encode_matrix(matrix)), matrix, atol=1e-6))
+        self.assertEqual(decode_matrix(encode_matrix(np.empty((0, 128)))).shape, (0, 128))
+        with self.assertRaises(ValueError):
+            decode_matrix(encode_matrix(matrix)[:-4])
+
+    def test_segment_files(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'segments', 'trip_1_v3.seg')
+        matrix = np.random.default_rng(11).random((4, 128))
+
+        write_segment(path, [7, 8, 9, 10], matrix)
+        group_ids, mapped = read_segment(path)
+        self.assertIsInstance(mapped, np.memmap)
+        self.assertEqual(group_ids.tolist(), [7, 8, 9, 10])
+        self.assertTrue(np.allclose(mapped, matrix, atol=1e-6))
+        del group_ids, mapped
+
+        write_segment(path, [], np.empty((0, 128)))
+        self.assertEqual([part.shape for part in read_segment(path)], [(0,), (0, 128)])
+
+        self.assertIsNone(read_segment(os.path.join(directory.name, 'missing.seg')))
+        with open(path, 'wb') as fh:
+            fh.write(b'TRIPFACE\x01\x00\x00\x00\x05\x00\x00\x00')
+        # Header promises 5 rows that aren't there
+        self.assertIsNone(read_segment(path))
+
+
+class SegmentBackedIndexTests(MediaTestMixin, TestCase):
+    def test_index_is_loaded_from_its_segment(self):
+        user = CustomUser.objects.create_user(username='segment', password='x')
+        trip = Trip.objects.create(
+            user=user, name="Seg", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        matrix = np.random.default_rng(12).random((3, 128))
+        groups = FaceGroup.objects.bulk_create(
+            [FaceGroup(trip=trip, representative_encoding=encode_encoding(row)) for row in matrix]
+        )
+
+        built = TripFaceIndex.load(trip.pk)
+        self.assertEqual(built.group_ids.tolist(), [group.pk for group in groups])
+        with self.assertNumQueries(1):
+            # Only the version lookup: the encodings come from the segment file
+            loaded = TripFaceIndex.load(trip.pk)
+        self.assertTrue(np.allclose(loaded.matrix, matrix, atol=1e-6))
+
+
+class DetectionFrameTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def image(self, name, size, **save_options):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as fh:
+            fh.write(jpeg_bytes('gray', size, **save_options))
+        return path
+
+    def test_large_photo_is_decoded_at_reduced_scale(self):
+        path = self.image('big.jpg', (2400, 1600))
+        frame, scale_x, scale_y = load_detection_frame(path, max_side=600)
+        self.assertEqual(frame.size, (600, 400))
+        self.assertEqual((scale_x, scale_y), (4, 4))
+
+        frame, scale_x, scale_y = load_detection_frame(path)
+        self.assertEqual((frame.size, scale_x), ((2400, 1600), 1))
+
+    def test_exif_rotation(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        path = self.image('rotated.jpg', (1200, 800), exif=exif.tobytes())
+        frame, scale_x, scale_y = load_detection_frame(path, max_side=300)
+        self.assertEqual(frame.size, (200, 300))
+        self.assertEqual((scale_x, scale_y), (4, 4))
+
+    def test_boxes_are_mapped_back_to_the_original(self):
+        self.assertEqual(scale_box((10, 60, 50, 20), 4, 4, 1000, 1000), (40, 240, 200, 80))
+        # Clipped to the image
+        self.assertEqual(scale_box((-2, 260, 255, 5), 4, 4, 1000, 1000), (0, 1000, 1000, 20))
+
+    def test_detection_runs_on_the_small_frame(self):
+        path = self.image('camera.jpg', (2400, 1600))
+        frames, crops = [], []
+
+        def face_locations(image, number_of_times_to_upsample, model):
+            frames.append(image.shape)
+            return [(100, 300, 300, 100)]
+
+        def face_encodings(crop, boxes):
+            crops.append((crop.shape, boxes))
+            return [np.ones(128)]
+
+        with face_library_stub(face_locations=face_locations, face_encodings=face_encodings):
+            face_recognition = sys.modules['face_recognition']
+            params = dict(detection_params(face_recognition), max_side=600, min_sharpness=0, max_yaw=None)
+            boxes, encodings, skipped, full_image = detect_faces(face_recognition, path, params)
+
+        self.assertEqual(frames, [(400, 600, 3)])
+        # Box and encoding crop in full-resolution pixels
+        self.assertEqual(boxes, [(400, 1200, 1200, 400)])
+        self.assertEqual(crops, [((1600, 1600, 3), [(400, 1200, 1200, 400)])])
+        self.assertEqual(full_image.size, (2400, 1600))
+        self.assertEqual(len(encodings), 1)
+        self.assertFalse(any(skipped.values()))
+
+
+class ReclusterTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='clusterer', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Cluster", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=self.trip, image=f"cluster/{n}.jpg") for n in range(7)]
+        )
+        rng = np.random.default_rng(13)
+        self.alice, self.bob = rng.random((2, 128))
+        self.noise = lambda: rng.normal(0, 0.01, 128)
+
+    def tag(self, group, photo, person):
+        encoding = None if person is None else encode_encoding(person + self.noise())
+        return PhotoFaceRelation.objects.create(photo=photo, face_number=0, face_group=group, encoding=encoding)
+
+    def test_wrong_groups_are_split_and_names_kept(self):
+        alice, bob = encode_encoding(self.alice), encode_encoding(self.bob)
+        named = FaceGroup.objects.create(trip=self.trip, name="Alice", representative_encoding=alice)
+        stray = FaceGroup.objects.create(trip=self.trip, representative_encoding=alice)
+        legacy = FaceGroup.objects.create(trip=self.trip, representative_encoding=bob)
+        # Alice's group also holds two faces of Bob; one face of Alice ended up on her own
+        for photo in self.photos[:3]:
+            self.tag(named, photo, self.alice)
+        for photo in self.photos[3:5]:
+            self.tag(named, photo, self.bob)
+        self.tag(stray, self.photos[5], self.alice)
+        # Saved before per-face encodings: stays where it is
+        self.tag(legacy, self.photos[6], None)
+        version = Trip.objects.get(pk=self.trip.pk).face_version
+
+        stats = recluster_trip(self.trip, block_size=2)
+
+        self.assertEqual((stats['faces'], stats['without_encoding'], stats['clusters']), (6, 1, 2))
+        named.refresh_from_db()
+        self.assertEqual(named.name, "Alice")
+        alice_photos = {p.pk for p in self.photos[:3]} | {self.photos[5].pk}
+        self.assertEqual(set(named.tagged_photos.values_list('photo_id', flat=True)), alice_photos)
+        bobs = PhotoFaceRelation.objects.filter(photo__in=self.photos[3:5]).values_list('face_group_id', flat=True)
+        self.assertEqual(len(set(bobs)), 1)
+        self.assertNotIn(bobs[0], (named.pk, stray.pk))
+        self.assertFalse(FaceGroup.objects.filter(pk=stray.pk).exists())
+        self.assertTrue(legacy.tagged_photos.filter(photo=self.photos[6]).exists())
+        self.assertTrue(np.allclose(decode_encoding(named.representative_encoding), self.alice, atol=0.02))
+        self.assertGreater(Trip.objects.get(pk=self.trip.pk).face_version, version)
+
+    def test_faces_are_read_under_the_trip_lock(self):
+        group = FaceGroup.objects.create(trip=self.trip, representative_encoding=encode_encoding(self.alice))
+        self.tag(group, self.photos[0], self.alice)
+        with CaptureQueriesContext(connection) as captured:
+            recluster_trip(self.trip)
+        sql = [query['sql'] for query in captured if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # The no-op face_version update of trip_face_lock comes before any read
+        self.assertTrue(sql[0].startswith('UPDATE "travel_trip" SET "face_version"'), sql[0])
+
+    def test_dry_run_changes_nothing(self):
+        group = FaceGroup.objects.create(trip=self.trip, representative_encoding=encode_encoding(self.alice))
+        self.tag(group, self.photos[0], self.alice)
+        self.tag(group, self.photos[1], self.bob)
+        before = list(PhotoFaceRelation.objects.values_list('id', 'face_group_id'))
+
+        stats = recluster_trip(self.trip, dry_run=True)
+        self.assertEqual(stats['clusters'], 2)
+        self.assertEqual(list(PhotoFaceRelation.objects.values_list('id', 'face_group_id')), before)
+
+
+class FaceSearchIndexTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        face_index._cache.clear()
+        self.addCleanup(face_index._cache.clear)
+        user = CustomUser.objects.create_user(username='searcher', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Search", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.alice, self.bob, self.carol = np.random.default_rng(14).random((3, 128))
+        self.groups = FaceGroup.objects.bulk_create(
+            [FaceGroup(trip=self.trip, representative_encoding=encode_encoding(e)) for e in (self.alice, self.bob)]
+        )
+        # Alice alone, Bob alone, then both of them
+        self.photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=self.trip, image=f"search/{n}.jpg") for n in range(3)]
+        )
+        alice_group, bob_group = self.groups
+        PhotoFaceRelation.objects.bulk_create([
+            PhotoFaceRelation(photo=self.photos[0], face_number=0, face_group=alice_group),
+            PhotoFaceRelation(photo=self.photos[1], face_number=0, face_group=bob_group),
+            PhotoFaceRelation(photo=self.photos[2], face_number=0, face_group=alice_group),
+            PhotoFaceRelation(photo=self.photos[2], face_number=1, face_group=bob_group),
+        ])
+
+    def face_version(self):
+        return Trip.objects.values_list('face_version', flat=True).get(pk=self.trip.pk)
+
+    def test_index_is_cached_until_face_version_changes(self):
+        version = self.face_version()
+        index = get_trip_index(self.trip.pk, version)
+        with self.assertNumQueries(0):
+            self.assertIs(get_trip_index(self.trip.pk, version), index)
+
+        carol = FaceGroup.objects.create(trip=self.trip, representative_encoding=encode_encoding(self.carol))
+        bump_face_version(self.trip.pk)
+        fresh = get_trip_index(self.trip.pk, self.face_version())
+        self.assertIsNot(fresh, index)
+        self.assertEqual(fresh.group_ids.tolist(), [group.pk for group in self.groups] + [carol.pk])
+
+    @override_settings(FACE_INDEX_CACHE_SIZE=1)
+    def test_least_recently_used_trip_is_evicted(self):
+        other = Trip.objects.create(
+            user=self.trip.user, name="Other", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        get_trip_index(self.trip.pk, self.face_version())
+        get_trip_index(other.pk, other.face_version)
+        self.assertEqual(list(face_index._cache), [other.pk])
+
+    def test_rank_trip_photos(self):
+        index = get_trip_index(self.trip.pk, self.face_version())
+        alice_group, bob_group = (group.pk for group in self.groups)
+
+        ranked = rank_trip_photos(index, [self.alice])
+        self.assertEqual([item['photo_id'] for item in ranked], [self.photos[0].pk, self.photos[2].pk])
+        self.assertEqual(ranked[0]['face_group_ids'], [alice_group])
+
+        both = rank_trip_photos(index, [self.alice, self.bob], require_all=True)
+        self.assertEqual([item['photo_id'] for item in both], [self.photos[2].pk])
+        self.assertEqual(both[0]['face_group_ids'], [alice_group, bob_group])
+
+        any_of = rank_trip_photos(index, [self.alice, self.bob])
+        self.assertEqual(len(any_of), 3)
+        self.assertEqual(rank_trip_photos(index, [self.carol]), [])
+
+
+class RenditionTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(username='viewer', password='x')
+        trip = Trip.objects.create(
+            user=self.user, name="Pics", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        name = default_storage.save('trip_photos/wide.jpg', ContentFile(jpeg_bytes('red', size=(800, 400))))
+        self.photo = TripPhoto.objects.create(trip=trip, image=name)
+
+    def test_rendition_is_generated_once(self):
+        rendition = get_rendition(self.photo.image, 'grid', 'webp')
+        self.assertEqual((rendition.width, rendition.height), (256, 128))
+        with Image.open(rendition.file.path) as stored:
+            self.assertEqual(stored.format, 'WEBP')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_rendition(self.photo.image, 'grid', 'webp').pk, rendition.pk)
+        with self.assertRaises(ValueError):
+            get_rendition(self.photo.image, 'poster', 'webp')
+
+    def test_concurrent_generation_keeps_the_first_row(self):
+        def render_while_another_request_saves(path, max_side, fmt):
+            result = render_image(path, max_side, fmt)
+            theirs = ImageRendition(source=self.photo.image.name, size='grid', format=fmt, width=1, height=1)
+            theirs.file.save('theirs.jpg', ContentFile(result[0]))
+            return result
+
+        with mock.patch('travel.renditions.render_image', render_while_another_request_saves):
+            rendition = get_rendition(self.photo.image, 'grid', 'jpeg')
+
+        self.assertEqual(rendition.file.name, 'renditions/theirs.jpg')
+        self.assertEqual(ImageRendition.objects.count(), 1)
+        # The losing request's file is removed again
+        self.assertEqual(default_storage.listdir('renditions')[1], ['theirs.jpg'])
+
+    def test_view_negotiates_format(self):
+        self.client.force_login(self.user)
+        url = reverse('photo_rendition', args=[self.photo.pk, 'lightbox'])
+
+        webp = self.client.get(url, HTTP_ACCEPT='image/avif,image/webp,*/*')
+        self.assertEqual(webp['Content-Type'], 'image/webp')
+        self.assertIn('Accept', webp['Vary'])
+        self.assertIn('immutable', webp['Cache-Control'])
+        jpeg = self.client.get(url, HTTP_ACCEPT='*/*')
+        self.assertEqual(jpeg['Content-Type'], 'image/jpeg')
+        self.assertEqual(ImageRendition.objects.filter(source=self.photo.image.name).count(), 2)
+        self.assertEqual(self.client.get(reverse('photo_rendition', args=[self.photo.pk, 'poster'])).status_code, 404)
+
+
+class PhotoStoreTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='uploader', password='x')
+        self.trips = [
+            Trip.objects.create(
+                user=user, name=name, destination="-", start_date='2024-01-01', end_date='2024-01-02'
+            )
+            for name in ("First", "Second")
+        ]
+        self.content = jpeg_bytes('blue')
+
+    def upload(self, trip, name='IMG_0001.JPG'):
+        return store_photo(trip, SimpleUploadedFile(name, self.content, content_type='image/jpeg'))
+
+    def test_duplicate_upload_reuses_the_photo(self):
+        photo, created = self.upload(self.trips[0])
+        self.assertTrue(created)
+        again, created = self.upload(self.trips[0], name='copy.jpg')
+        self.assertFalse(created)
+        self.assertEqual(again.pk, photo.pk)
+
+        blob = PhotoBlob.objects.get()
+        digest = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(blob.name, f'photos/{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertEqual((blob.ref_count, blob.duplicate_uploads, blob.size), (1, 1, len(self.content)))
+
+    def test_file_is_deleted_with_the_last_reference(self):
+        first, _ = self.upload(self.trips[0])
+        second, _ = self.upload(self.trips[1])
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(PhotoBlob.objects.get().ref_count, 2)
+        get_rendition(first.image, 'grid', 'jpeg')
+
+        release_photo(first)
+        first.delete()
+        self.assertEqual(PhotoBlob.objects.get().ref_count, 1)
+        self.assertTrue(default_storage.exists(second.image.name))
+        self.assertEqual(ImageRendition.objects.count(), 1)
+
+        release_photo(second)
+        second.delete()
+        self.assertFalse(PhotoBlob.objects.exists())
+        self.assertFalse(default_storage.exists(second.image.name))
+        self.assertFalse(ImageRendition.objects.exists())
+
+    def test_recount_references(self):
+        photo, _ = self.upload(self.trips[0])
+        self.upload(self.trips[1])
+        # A cascading delete skips release_photo
+        photo.trip.delete()
+        self.assertEqual(recount_references(), 1)
+        self.assertEqual(PhotoBlob.objects.get().ref_count, 1)
+        self.assertEqual(recount_references(), 0)
+
+
+class DetectionCacheTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='detector', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Detect", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.content = jpeg_bytes('green')
+        self.encoding = np.random.default_rng(15).random(128)
+        stub = face_library_stub()
+        stub.start()
+        self.addCleanup(stub.stop)
+        self.face_recognition = sys.modules['face_recognition']
+
+    def photo(self, name, content_hash=''):
+        stored = default_storage.save(f'trip_photos/{name}', ContentFile(self.content))
+        return TripPhoto.objects.create(trip=self.trip, image=stored, content_hash=content_hash)
+
+    def test_same_content_is_detected_once(self):
+        detected = ([(10, 60, 60, 10)], [self.encoding], {'small': 1, 'blurry': 0, 'profile': 0}, object())
+        digest = hashlib.sha256(self.content).hexdigest()
+        first = self.photo('first.jpg', content_hash=digest)
+        # Same bytes, uploaded before content addressing
+        second = self.photo('second.jpg')
+
+        with mock.patch('travel.utils.detect_faces', return_value=detected) as detect:
+            self.assertIs(cached_detect_faces(self.face_recognition, first)[3], detected[3])
+            boxes, encodings, skipped, full_image = cached_detect_faces(self.face_recognition, second)
+            self.assertEqual(detect.call_count, 1)
+            cached_detect_faces(self.face_recognition, second, use_cache=False)
+            self.assertEqual(detect.call_count, 2)
+
+        self.assertEqual((boxes, skipped, full_image), ([(10, 60, 60, 10)], detected[2], None))
+        self.assertTrue(np.allclose(encodings[0], self.encoding, atol=1e-3))
+        result = FaceDetectionResult.objects.get()
+        self.assertEqual(result.content_hash, digest)
+        self.assertEqual(result.library_version, 'face_recognition test, dlib test')
+
+    def test_changed_parameters_miss_the_cache(self):
+        photo = self.photo('photo.jpg')
+        detected = ([], [], dict.fromkeys(('small', 'blurry', 'profile'), 0), None)
+        with mock.patch('travel.utils.detect_faces', return_value=detected) as detect:
+            cached_detect_faces(self.face_recognition, photo)
+            with override_settings(FACE_DETECTION_MAX_SIDE=640):
+                cached_detect_faces(self.face_recognition, photo)
+                cached_detect_faces(self.face_recognition, photo)
+        self.assertEqual(detect.call_count, 2)
+        self.assertEqual(sorted(FaceDetectionResult.objects.values_list('max_side', flat=True)), [640, 1600])
+
+
+class FaceWriteTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='writer', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Write", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.photos = TripPhoto.objects.bulk_create(
+            [TripPhoto(trip=self.trip, image=f"write/{n}.jpg") for n in range(3)]
+        )
+        self.encodings = np.random.default_rng(16).random((8, 128))
+        self.known = FaceGroup.objects.create(
+            trip=self.trip, representative_encoding=encode_encoding(self.encodings[0])
+        )
+
+    def new_groups(self, count):
+        return [FaceGroup(trip=self.trip, representative_encoding=encode_encoding(e)) for e in self.encodings[:count]]
+
+    def test_new_groups_are_resolved_from_temporary_ids(self):
+        version = Trip.objects.get(pk=self.trip.pk).face_version
+        new_groups = self.new_groups(2)
+        assignments = [(self.known.pk, self.encodings[0]), (-1, self.encodings[1]), (-2, self.encodings[2])]
+        # The same pair twice, as two faces may both "maybe" match a group
+        write_photo_faces(self.photos[0], new_groups, assignments, [(self.known.pk, -2), (self.known.pk, -2)])
+
+        self.assertEqual(
+            list(self.photos[0].faces.order_by('id').values_list('face_group_id', flat=True)),
+            [self.known.pk, new_groups[0].pk, new_groups[1].pk]
+        )
+        suggestion = FaceMergeSuggestion.objects.get()
+        self.assertEqual((suggestion.group_a_id, suggestion.group_b_id), (self.known.pk, new_groups[1].pk))
+        self.assertEqual(Trip.objects.get(pk=self.trip.pk).face_version, version + 1)
+
+        # Only known faces: the face index stays valid
+        write_photo_faces(self.photos[1], [], [(self.known.pk, self.encodings[0])], [])
+        self.assertEqual(Trip.objects.get(pk=self.trip.pk).face_version, version + 1)
+
+    def test_query_count_does_not_grow_with_faces(self):
+        def queries(photo, count):
+            assignments = [(-n - 1, e) for n, e in enumerate(self.encodings[:count])]
+            with CaptureQueriesContext(connection) as captured:
+                write_photo_faces(photo, self.new_groups(count), assignments, [(self.known.pk, -1)])
+            return len(captured)
+
+        self.assertEqual(queries(self.photos[0], 2), queries(self.photos[1], 8))
+
+    def test_failure_writes_nothing(self):
+        with mock.patch.object(FaceMergeSuggestion.objects, 'bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                write_photo_faces(self.photos[0], self.new_groups(1), [(-1, self.encodings[0])], [(self.known.pk, -1)])
+        self.assertEqual(FaceGroup.objects.count(), 1)
+        self.assertFalse(PhotoFaceRelation.objects.exists())
+
+
+class MergeFaceGroupsTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create_user(username='merger', password='x')
+        self.trip = Trip.objects.create(
+            user=user, name="Merge", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.encodings = np.random.default_rng(17).random((5, 128))
+        self.target, self.bob, self.other, self.x, self.y = FaceGroup.objects.bulk_create(
+            [FaceGroup(trip=self.trip, representative_encoding=encode_encoding(e)) for e in self.encodings]
+        )
+        FaceGroup.objects.filter(pk=self.bob.pk).update(name="Bob", thumbnail='face_thumbnails/bob.jpg')
+        photos = TripPhoto.objects.bulk_create([TripPhoto(trip=self.trip, image=f"merge/{n}.jpg") for n in range(4)])
+        # One tag of the target, three of Bob (two faces in the same photo), none of the other group
+        PhotoFaceRelation.objects.bulk_create(
+            [PhotoFaceRelation(photo=photos[0], face_number=0, face_group=self.target)]
+            + [
+                PhotoFaceRelation(photo=photo, face_number=n, face_group=self.bob)
+                for photo, n in ((photos[1], 0), (photos[2], 0), (photos[2], 1))
+            ]
+        )
+
+    def suggest(self, a, b, is_active=True):
+        return FaceMergeSuggestion.objects.create(trip=self.trip, group_a=a, group_b=b, is_active=is_active)
+
+    def test_merge_moves_tags_and_keeps_name_and_thumbnail(self):
+        version = Trip.objects.get(pk=self.trip.pk).face_version
+        moved = merge_face_groups(self.target, [self.bob.pk, self.other.pk, self.target.pk])
+
+        self.assertEqual(moved, 3)
+        self.target.refresh_from_db()
+        self.assertEqual(self.target.name, "Bob")
+        self.assertEqual(self.target.thumbnail.name, 'face_thumbnails/bob.jpg')
+        self.assertEqual(self.target.tagged_photos.count(), 4)
+        self.assertFalse(FaceGroup.objects.filter(pk__in=[self.bob.pk, self.other.pk]).exists())
+        # Weighted by tags; a group without tags still counts once
+        centroid = np.average(self.encodings[:3], axis=0, weights=[1, 3, 1])
+        self.assertTrue(np.allclose(decode_encoding(self.target.representative_encoding), centroid, atol=1e-3))
+        self.assertEqual(Trip.objects.get(pk=self.trip.pk).face_version, version + 1)
+
+    def test_merge_holds_the_trip_lock(self):
+        with CaptureQueriesContext(connection) as captured:
+            merge_face_groups(self.target, [self.bob.pk])
+        sql = [query['sql'] for query in captured if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertTrue(sql[0].startswith('UPDATE "travel_trip" SET "face_version"'), sql[0])
+
+    def test_suggestions_are_retargeted(self):
+        self.suggest(self.target, self.bob)
+        self.suggest(self.bob, self.x)
+        self.suggest(self.other, self.x, is_active=False)
+        self.suggest(self.target, self.y)
+        self.suggest(self.other, self.y, is_active=False)
+
+        merge_face_groups(self.target, [self.bob.pk, self.other.pk])
+
+        pairs = {
+            (frozenset((a, b)), is_active)
+            for a, b, is_active in FaceMergeSuggestion.objects.values_list('group_a_id', 'group_b_id', 'is_active')
+        }
+        # The pair inside the merge is gone; collapsed pairs stay dismissed if either one was
+        self.assertEqual(
+            pairs, {(frozenset((self.target.pk, self.x.pk)), False), (frozenset((self.target.pk, self.y.pk)), False)}
+        )
+
+    def test_suggestion_chain(self):
+        first = self.suggest(self.target, self.bob)
+        self.suggest(self.bob, self.other)
+        self.suggest(self.other, self.x, is_active=False)
+        self.assertEqual(suggestion_chain(first), {self.target.pk, self.bob.pk, self.other.pk})
+
+
+class FaceQualityTests(SimpleTestCase):
+    frontal = {'left_eye': [(40, 50), (50, 50)], 'right_eye': [(70, 50), (80, 50)], 'nose_tip': [(60, 70)]}
+    # Nose tip level with the right eye
+    profile = {'left_eye': [(40, 50), (50, 50)], 'right_eye': [(70, 50), (80, 50)], 'nose_tip': [(75, 70)]}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.noise = np.random.default_rng(18).integers(0, 256, (300, 300, 3), dtype='uint8')
+
+    def image(self, name, pixels):
+        path = os.path.join(self.directory, name)
+        Image.fromarray(pixels).save(path, 'JPEG', quality=95)
+        return path
+
+    def test_sharpness_and_yaw(self):
+        flat = np.full((300, 300, 3), 128, dtype='uint8')
+        box = (50, 250, 250, 50)
+        self.assertLess(face_sharpness(flat, box), 1)
+        self.assertGreater(face_sharpness(self.noise, box), 1000)
+
+        self.assertEqual(face_yaw(self.frontal), 0)
+        self.assertAlmostEqual(face_yaw(self.profile), 1.0)
+        self.assertIsNone(face_yaw({'left_eye': [(40, 50)], 'right_eye': [(40, 50)], 'nose_tip': [(40, 60)]}))
+        self.assertIsNone(face_yaw({'left_eye': [(40, 50)]}))
+
+    def detect(self, path, landmarks):
+        encoded = []
+
+        def face_locations(image, number_of_times_to_upsample, model):
+            # A background face too small to keep, then two large ones
+            return [(0, 20, 20, 0), (20, 140, 140, 20), (150, 280, 280, 150)]
+
+        def face_landmarks(crop, boxes, model):
+            return [next(landmarks)]
+
+        def face_encodings(crop, boxes):
+            encoded.append(boxes)
+            return [np.zeros(128)]
+
+        stub = face_library_stub(
+            face_locations=face_locations, face_landmarks=face_landmarks, face_encodings=face_encodings
+        )
+        with stub:
+            face_recognition = sys.modules['face_recognition']
+            params = dict(detection_params(face_recognition), max_yaw=0.4)
+            boxes, encodings, skipped, _ = detect_faces(face_recognition, path, params)
+        self.assertEqual(len(encoded), len(encodings))
+        return boxes, skipped
+
+    def test_detect_faces_skips_profiles(self):
+        boxes, skipped = self.detect(self.image('sharp.jpg', self.noise), iter([self.frontal, self.profile]))
+        self.assertEqual(boxes, [(20, 140, 140, 20)])
+        self.assertEqual(skipped, {'small': 1, 'blurry': 0, 'profile': 1})
+
+    def test_detect_faces_skips_blurry_faces_before_landmarks(self):
+        flat = self.image('flat.jpg', np.full((300, 300, 3), 128, dtype='uint8'))
+        boxes, skipped = self.detect(flat, iter([]))
+        self.assertEqual(boxes, [])
+        self.assertEqual(skipped, {'small': 1, 'blurry': 2, 'profile': 0})
+
+
+class SearchPoolTests(SimpleTestCase):
+    def test_searches_past_the_limit_are_refused(self):
+        pool = SearchPool(workers=1, max_pending=2)
+        # Threads stand in for the worker processes
+        pool._executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool._executor.shutdown)
+        release = threading.Event()
+
+        running = [pool.submit(release.wait, 5), pool.submit(release.wait, 5)]
+        with self.assertRaises(SearchBusy):
+            pool.submit(release.wait, 5)
+
+        release.set()
+        for future in running:
+            future.result(timeout=5)
+        # Slots are handed back by done callbacks
+        self.assertTrue(pool.submit(release.wait, 5).result(timeout=5))
+
+    def test_broken_pool_is_replaced(self):
+        pool = SearchPool(workers=1, max_pending=1)
+        broken = mock.Mock(submit=mock.Mock(side_effect=BrokenProcessPool))
+        pool._executor = broken
+        with self.assertRaises(SearchBusy):
+            pool.submit(len, 'x')
+        broken.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        self.assertIsNone(pool._executor)
+        # The slot was given back
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+
+class FaceSearchViewTests(MediaTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        face_index._cache.clear()
+        self.addCleanup(face_index._cache.clear)
+        self.user = CustomUser.objects.create_user(username='selfie', password='x')
+        self.trip = Trip.objects.create(
+            user=self.user, name="Selfie", destination="-", start_date='2024-01-01', end_date='2024-01-02'
+        )
+        self.client.force_login(self.user)
+        self.url = reverse('search_photos_by_face_async', args=[self.trip.pk])
+
+    def search(self):
+        image = SimpleUploadedFile('me.jpg', jpeg_bytes('white'), content_type='image/jpeg')
+        return self.client.post(self.url, {'image': image})
+
+    @override_settings(FACE_SEARCH_RETRY_AFTER=7)
+    def test_saturated_pool_answers_503(self):
+        pool = mock.Mock(submit=mock.Mock(side_effect=SearchBusy))
+        with mock.patch('travel.views.get_search_pool', return_value=pool):
+            response = self.search()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+        self.assertIn('busy', response.json()['error'])
+
+    @override_settings(FACE_SEARCH_TIMEOUT=0.01)
+    def test_slow_search_answers_503(self):
+        pool = mock.Mock(submit=mock.Mock(return_value=Future()))
+        with mock.patch('travel.views.get_search_pool', return_value=pool):
+            response = self.search()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('too long', response.json()['error'])
+
+    def test_results_come_from_the_trip_index(self):
+        encoding = np.random.default_rng(19).random(128)
+        group = FaceGroup.objects.create(trip=self.trip, representative_encoding=encode_encoding(encoding))
+        photo = TripPhoto.objects.create(trip=self.trip, image='selfie/1.jpg')
+        PhotoFaceRelation.objects.create(photo=photo, face_number=0, face_group=group)
+        done = Future()
+        done.set_result([encoding])
+        pool = mock.Mock(submit=mock.Mock(return_value=done))
+        with mock.patch('travel.views.get_search_pool', return_value=pool):
+            response = self.search()
+        self.assertEqual(response.json()['photo_ids'], [photo.pk])
+
+
+class FaceBenchmarkTests(MediaTestMixin, TestCase):
+    def test_synthetic_encodings_form_separate_people(self):
+        centers, faces = synthetic_encodings(4, 3)
+        self.assertEqual(faces.shape, (4, 3, 128))
+        same_person = np.linalg.norm(faces - centers[:, None, :], axis=2)
+        self.assertLess(same_person.max(), STRICT_MATCH_DISTANCE)
+        between = np.linalg.norm(centers[:, None, :] - centers[None, :, :], axis=2)
+        self.assertGreater(between[~np.eye(4, dtype=bool)].min(), 1)
+
+    def test_benchmark_runs_on_small_fixtures(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, 'small.jpg'), 'wb') as fh:
+            fh.write(jpeg_bytes('orange', size=(320, 240)))
+        output = os.path.join(directory.name, 'report.json')
+
+        # Without face_recognition only the decode and quality-gate stages are timed
+        with mock.patch.dict(sys.modules, {'face_recognition': None}):
+            call_command(
+                'benchmark_faces', groups='3,5', repeat=2, photos=2, images=directory.name, output=output,
+                stdout=io.StringIO(), stderr=io.StringIO()
+            )
+        with open(output) as fh:
+            report = json.load(fh)
+
+        self.assertEqual(report['meta']['repeat'], 2)
+        self.assertIsNone(report['meta']['face_recognition'])
+        image = report['images']['small.jpg']
+        self.assertEqual(image['size'], [320, 240])
+        self.assertIn('skipped', image)
+        self.assertEqual(image['decode_full']['runs'], 2)
+        self.assertEqual(sorted(report['trips']), ['3', '5'])
+        self.assertEqual(report['trips']['5']['assign_and_write_photo']['runs'], 2)
+        # The throwaway trips are gone again
+        self.assertFalse(Trip.objects.exists())
+        self.assertFalse(CustomUser.objects.exists())
@@ -0,0 +1,53 @@
+# travel/trip_cache.py
+"""
+Versioned caching of rendered trip pages.
+
+Trip.version is bumped by every write to something a trip's pages show: stops,
+checklist items, members, photos and face groups (bump_trip_version, or
+bump_face_version in travel/face_index.py) and expenses/settlements (travel/rollups.py).
+Together with updated_at (edits of the trip itself) it identifies the trip's content,
+so a page rendered for the same trip state, viewer and day is still valid: the
+browser gets a 304 for its ETag, anyone else a copy from Django's cache.
+
+Writes that bypass these paths (the admin, raw queryset updates) show up once the
+trip changes again; cached copies also expire after TRIP_PAGE_CACHE_TIMEOUT.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from .models import Trip
+
+
+def bump_trip_version(trip_id):
+    """Marks everything rendered for the trip as stale. Call it after any change shown on its pages."""
+    Trip.objects.filter(pk=trip_id).update(version=F('version') + 1)
+
+
+def trip_state(trip):
+    return (trip.pk, trip.version, trip.updated_at)
+
+
+def user_state(user):
+    # updated_at changes with the profile (name shown in the page header)
+    return (user.pk, getattr(user, 'updated_at', None))
+
+
+def page_fingerprint(*parts):
+    """Strong validator for a page that only depends on `parts` (hashable reprs)."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def _cache_key(fingerprint):
+    return f'trip-page:{fingerprint}'
+
+
+def cached_page(fingerprint):
+    """The response stored for `fingerprint`, or None."""
+    return cache.get(_cache_key(fingerprint))
+
+
+def store_page(fingerprint, response):
+    cache.set(_cache_key(fingerprint), response, getattr(settings, 'TRIP_PAGE_CACHE_TIMEOUT', 3600))
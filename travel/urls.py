@@ -35,6 +35,7 @@ urlpatterns = [
     path('trips/edit/<int:pk>/', views.trip_update, name='trip_update'),
     path('trips/delete/<int:pk>/', views.trip_delete, name='trip_delete'),
     path('trips/<int:pk>/', views.trip_detail, name='trip_detail'), # View Trip + Itinerary
+    path('trips/<int:pk>/tab/<slug:tab>/', views.trip_tab, name='trip_tab'),
     path('trips/stop/delete/<int:pk>/', views.delete_stop, name='delete_stop'),
     
     path('checklist/toggle/<int:pk>/', views.checklist_toggle, name='checklist_toggle'),
@@ -42,13 +43,18 @@ urlpatterns = [
     path('checklists/', views.checklist_dashboard, name='checklist_dashboard'),
     path('members/delete/<int:pk>/', views.delete_member, name='delete_member'),
     path('expenses/delete/<int:pk>/', views.delete_expense, name='delete_expense'),
+    path('trips/<int:pk>/import-expenses/', views.import_trip_expenses, name='import_trip_expenses'),
     
     path('trips/<int:pk>/upload-photos/', views.upload_trip_photos, name='upload_trip_photos'),
     path('photos/delete/<int:pk>/', views.delete_trip_photo, name='delete_trip_photo'),
+    path('photos/<int:pk>/<str:size>/', views.photo_rendition, name='photo_rendition'),
+    path('face-group/thumbnail/<int:group_id>/', views.face_thumbnail, name='face_thumbnail'),
     path('photos/suggestions/<int:suggestion_id>/<str:action>/', views.manage_face_suggestion, name='manage_face_suggestion'),
     path('face-group/rename/<int:group_id>/', views.rename_face_group, name='rename_face_group'),
     path('face-group/delete/<int:group_id>/', views.delete_face_group, name='delete_face_group'),
     path('trip/<int:pk>/pdf/', views.export_trip_pdf, name='export_trip_pdf'),
     path('settlements/delete/<int:pk>/', views.delete_settlement, name='delete_settlement'),
     path('trip/<int:pk>/search-face/', views.search_photos_by_face, name='search_photos_by_face'), # Face Match Feature
+    path('trip/<int:pk>/search-face/async/', views.search_photos_by_face_async, name='search_photos_by_face_async'),
+    path('metrics', views.metrics, name='metrics'),
 ]
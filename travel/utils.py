@@ -1,15 +1,368 @@
 # travel/utils.py
 import numpy as np
-import pickle
+import hashlib
+import math
 import os
 from PIL import Image, ImageOps  # ImageOps handles orientation
-from .models import TripPhoto, FaceGroup, PhotoFaceRelation, FaceMergeSuggestion
+from .models import TripPhoto, FaceGroup, PhotoFaceRelation, FaceMergeSuggestion, FaceDetectionResult
+from .face_index import TripFaceIndex, bump_face_version, trip_face_lock, STRICT_MATCH_DISTANCE, MAYBE_MATCH_DISTANCE
+from .encodings import encode_encoding, encode_matrix, decode_matrix
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Q
 import io
 
-def process_photo_faces(photo_id):
+# Quality gate, checked on each detected face before the (expensive) 128-d encoding.
+# Faces smaller than this (in original-image pixels) are background noise
+MIN_FACE_HEIGHT = getattr(settings, 'FACE_MIN_HEIGHT', 40)
+# Variance of the Laplacian of the face, scaled to 128px grayscale; lower is blurrier (0 = off)
+MIN_FACE_SHARPNESS = getattr(settings, 'FACE_MIN_SHARPNESS', 30.0)
+# Nose offset from the middle of the eyes in half eye-distances: 0 is frontal, ~1 is a profile (None = off)
+MAX_FACE_YAW = getattr(settings, 'FACE_MAX_YAW', 0.8)
+
+SKIP_REASONS = ('small', 'blurry', 'profile')
+
+EXIF_ORIENTATION = 0x0112
+
+
+def _oriented_size(pil_img):
+    """Size of the image after EXIF auto-rotation, without decoding any pixels."""
+    width, height = pil_img.size
+    if pil_img.getexif().get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+
+def load_full_image(image_path):
+    """Full-quality decode: EXIF orientation applied, forced to RGB (fixes Alpha/CMYK issues)."""
+    with Image.open(image_path) as pil_img:
+        return ImageOps.exif_transpose(pil_img).convert('RGB')
+
+
+def load_detection_frame(image_path, max_side=None):
+    """
+    Decodes a photo for face detection only. With `max_side`, JPEGs are decoded at a
+    reduced scale (PIL draft mode) and the frame is capped at `max_side` pixels.
+    Returns (frame, scale_x, scale_y); the scales turn frame coordinates back into
+    original-image pixels.
+    """
+    with Image.open(image_path) as pil_img:
+        full_w, full_h = _oriented_size(pil_img)
+        if max_side and max(full_w, full_h) > max_side:
+            ratio = max_side / max(full_w, full_h)
+            # draft() only picks a DCT scale (1/2, 1/4, 1/8) that is still >= the requested size
+            pil_img.draft('RGB', (math.ceil(pil_img.width * ratio), math.ceil(pil_img.height * ratio)))
+        frame = ImageOps.exif_transpose(pil_img).convert('RGB')
+
+    if max_side and max(frame.size) > max_side:
+        frame.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    return frame, full_w / frame.width, full_h / frame.height
+
+
+def scale_box(box, scale_x, scale_y, width, height):
+    """(top, right, bottom, left) in frame pixels -> original-image pixels, clipped to the image."""
+    top, right, bottom, left = box
+    return (
+        max(0, int(round(top * scale_y))),
+        min(width, int(round(right * scale_x))),
+        min(height, int(round(bottom * scale_y))),
+        max(0, int(round(left * scale_x))),
+    )
+
+
+def crop_face(pil_img, box):
+    """
+    Crop around one face, so the full photo never has to be copied into a numpy array.
+    Returns (uint8 array, box within the crop).
+    """
+    top, right, bottom, left = box
+    # Leave room for dlib's aligned face chip around the landmarks
+    margin = max(50, (bottom - top) // 2)
+    x0, y0 = max(0, left - margin), max(0, top - margin)
+    x1, y1 = min(pil_img.width, right + margin), min(pil_img.height, bottom + margin)
+
+    crop = np.ascontiguousarray(np.array(pil_img.crop((x0, y0, x1, y1)), dtype='uint8'))
+    return crop, (top - y0, right - x0, bottom - y0, left - x0)
+
+
+def face_sharpness(crop, box):
+    """Variance of the Laplacian over the face itself, resized to 128x128 grayscale."""
+    top, right, bottom, left = box
+    face = Image.fromarray(crop[top:bottom, left:right]).convert('L').resize((128, 128), Image.Resampling.BILINEAR)
+    gray = np.asarray(face, dtype=np.float32)
+    laplacian = gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def face_yaw(landmarks):
+    """
+    Rough head turn from dlib's 5-point landmarks: how far the nose tip sits from the
+    middle of the eyes, in half eye-distances. None if the landmarks are unusable.
+    """
+    try:
+        left_eye = np.mean(landmarks['left_eye'], axis=0)
+        right_eye = np.mean(landmarks['right_eye'], axis=0)
+        nose = np.mean(landmarks['nose_tip'], axis=0)
+    except (KeyError, ValueError):
+        return None
+    half_eye_distance = np.linalg.norm(right_eye - left_eye) / 2
+    if half_eye_distance < 1:
+        return None
+    # Distance from the eye midpoint along the eye line (ignores the vertical nose offset)
+    axis = (right_eye - left_eye) / (2 * half_eye_distance)
+    return float(abs(np.dot(nose - (left_eye + right_eye) / 2, axis)) / half_eye_distance)
+
+
+def face_quality_issue(face_recognition, crop, box, params):
+    """
+    Cheap checks on a face crop before it is encoded. Returns the skip reason
+    ('blurry' or 'profile'), or None if the face is good enough to encode.
+    """
+    if params['min_sharpness'] and face_sharpness(crop, box) < params['min_sharpness']:
+        return 'blurry'
+
+    if params['max_yaw'] is not None:
+        landmarks = face_recognition.face_landmarks(crop, [box], model='small')
+        yaw = face_yaw(landmarks[0]) if landmarks else None
+        if yaw is None or yaw > params['max_yaw']:
+            return 'profile'
+    return None
+
+
+def _library_version(face_recognition):
+    import dlib
+    return f"face_recognition {getattr(face_recognition, '__version__', '?')}, dlib {getattr(dlib, '__version__', '?')}"
+
+
+def detection_params(face_recognition):
+    """Everything that changes the output of detect_faces; part of the detection cache key."""
+    return {
+        # We use 'hog' for speed, but 'cnn' is more accurate (needs GPU/CPU power)
+        'detector': 'hog',
+        'upsample': 1,
+        'max_side': getattr(settings, 'FACE_DETECTION_MAX_SIDE', None) or 0,
+        'min_face_height': MIN_FACE_HEIGHT,
+        'min_sharpness': MIN_FACE_SHARPNESS or 0,
+        'max_yaw': MAX_FACE_YAW,
+        'library_version': _library_version(face_recognition),
+    }
+
+
+def detect_faces(face_recognition, image_path, params):
+    """
+    Detection, quality gate and encoding for one image file.
+    Returns (boxes, encodings, skipped, full_image): skipped counts the faces dropped per
+    reason in SKIP_REASONS; full_image is None when no face needed the full-quality pixels.
+    """
+    skipped = dict.fromkeys(SKIP_REASONS, 0)
+
+    # --- Detection on a reduced-resolution frame ---
+    # Large camera photos are decoded at 1/2..1/8 scale and capped before running HOG
+    frame, scale_x, scale_y = load_detection_frame(image_path, params['max_side'] or None)
+    frame_array = np.ascontiguousarray(np.array(frame, dtype='uint8'))
+    face_locations = face_recognition.face_locations(
+        frame_array,
+        number_of_times_to_upsample=params['upsample'],
+        model=params['detector']
+    )
+    del frame_array
+
+    full_w, full_h = round(frame.width * scale_x), round(frame.height * scale_y)
+    face_boxes = []
+    for location in face_locations:
+        box = scale_box(location, scale_x, scale_y, full_w, full_h)
+        # Only process faces that are large enough (filter out background noise)
+        if box[2] - box[0] < params['min_face_height']:
+            skipped['small'] += 1
+        else:
+            face_boxes.append(box)
+    if not face_boxes:
+        return [], [], skipped, None
+
+    # Quality checks and encodings work on crops of the full-quality pixels
+    pil_img = frame if (scale_x, scale_y) == (1, 1) else load_full_image(image_path)
+
+    boxes, encodings = [], []
+    for box in face_boxes:
+        crop, crop_box = crop_face(pil_img, box)
+        issue = face_quality_issue(face_recognition, crop, crop_box, params)
+        if issue:
+            skipped[issue] += 1
+            continue
+
+        face_encodings = face_recognition.face_encodings(crop, [crop_box])
+        if face_encodings:
+            boxes.append(box)
+            encodings.append(face_encodings[0])
+    return boxes, encodings, skipped, pil_img
+
+
+def cached_detect_faces(face_recognition, photo, use_cache=True):
+    """
+    detect_faces backed by FaceDetectionResult, keyed by the image's content hash and
+    the detection and quality-gate parameters. On a cache hit no pixels are decoded
+    (full_image is None).
+    """
+    image_path = photo.image.path
+    content_hash = photo.content_hash
+    if not content_hash:
+        # Uploaded before content addressing
+        with open(image_path, 'rb') as fh:
+            content_hash = hashlib.file_digest(fh, 'sha256').hexdigest()
+
+    key = dict(content_hash=content_hash, **detection_params(face_recognition))
+    if use_cache:
+        cached = FaceDetectionResult.objects.filter(**key).first()
+        if cached is not None:
+            boxes = [tuple(box) for box in cached.boxes]
+            return boxes, list(decode_matrix(cached.encodings)), cached.skipped, None
+
+    boxes, encodings, skipped, pil_img = detect_faces(face_recognition, image_path, key)
+    FaceDetectionResult.objects.update_or_create(
+        **key,
+        defaults={
+            'boxes': [list(box) for box in boxes],
+            'encodings': encode_matrix(encodings),
+            'skipped': skipped,
+        }
+    )
+    return boxes, encodings, skipped, pil_img
+
+
+def write_photo_faces(photo, new_groups, assignments, suggestion_pairs):
+    """
+    Saves the face grouping of one photo in a single transaction, replacing any tags
+    the photo already has: a retried or duplicated job doesn't tag its faces twice.
+    new_groups: unsaved FaceGroups; assignments: (group_id, encoding) per face, in face order;
+    suggestion_pairs: (group_a_id, group_b_id). A negative id -n refers to new_groups[n - 1].
+    """
+    with transaction.atomic():
+        PhotoFaceRelation.objects.filter(photo=photo).delete()
+        # Needs a backend that returns primary keys from bulk inserts (SQLite 3.35+, PostgreSQL)
+        FaceGroup.objects.bulk_create(new_groups)
+
+        def real_id(group_id):
+            return new_groups[-group_id - 1].id if group_id < 0 else group_id
+
+        PhotoFaceRelation.objects.bulk_create([
+            PhotoFaceRelation(
+                photo=photo, face_number=face_number, face_group_id=real_id(group_id),
+                encoding=encode_encoding(encoding)
+            )
+            for face_number, (group_id, encoding) in enumerate(assignments)
+        ])
+        FaceMergeSuggestion.objects.bulk_create(
+            [
+                FaceMergeSuggestion(trip_id=photo.trip_id, group_a_id=real_id(a), group_b_id=real_id(b))
+                for a, b in suggestion_pairs
+            ],
+            ignore_conflicts=True
+        )
+        if new_groups:
+            bump_face_version(photo.trip_id)
+
+
+def face_thumbnail(pil_img, box):
+    """Create a thumbnail crop for a new face group (JPEG ContentFile)."""
+    top, right, bottom, left = box
+    padding = 50
+    img_w, img_h = pil_img.size
+
+    crop_top = max(0, top - padding)
+    crop_bottom = min(img_h, bottom + padding)
+    crop_left = max(0, left - padding)
+    crop_right = min(img_w, right + padding)
+
+    face_crop = pil_img.crop((crop_left, crop_top, crop_right, crop_bottom))
+    face_crop.thumbnail((200, 200), Image.Resampling.LANCZOS)
+
+    thumb_io = io.BytesIO()
+    face_crop.save(thumb_io, format='JPEG', quality=95)
+    return ContentFile(thumb_io.getvalue())
+
+
+def assign_photo_faces(photo, face_encodings, strict=STRICT_MATCH_DISTANCE, maybe=MAYBE_MATCH_DISTANCE):
+    """
+    Assigns the encoded faces of one photo to FaceGroups of its trip and saves the result.
+    Runs under the trip's face lock, so two workers can't both miss a person and create
+    a group for them each. Returns [(new FaceGroup, face number)] for faces that started
+    a new group (without thumbnail).
+    """
+    with trip_face_lock(photo.trip_id):
+        # Every representative encoding of the trip, loaded once per photo
+        face_index = TripFaceIndex.load(photo.trip_id)
+
+        # Nothing is written until every face of the photo is assigned. Groups created
+        # for this photo get temporary negative ids so later faces can still match them.
+        new_groups = []
+        new_faces = []
+        assignments = []
+        suggestion_pairs = []
+
+        for face_number, encoding in enumerate(face_encodings):
+            # One vectorized distance computation against all groups of the trip
+            strict_ids, maybe_ids = face_index.match(encoding, strict=strict, maybe=maybe)
+            matched_group_id = strict_ids[0] if strict_ids else None
+
+            if matched_group_id is None:
+                new_groups.append(FaceGroup(
+                    trip_id=photo.trip_id,
+                    representative_encoding=encode_encoding(encoding)
+                ))
+                new_faces.append(face_number)
+                matched_group_id = -len(new_groups)
+
+                # Suggestions for all "maybe" matches
+                suggestion_pairs.extend((maybe_group_id, matched_group_id) for maybe_group_id in maybe_ids)
+
+                # Later faces in this photo must see the new group too
+                face_index.append(matched_group_id, encoding)
+
+            assignments.append((matched_group_id, encoding))
+
+        write_photo_faces(photo, new_groups, assignments, suggestion_pairs)
+    return list(zip(new_groups, new_faces))
+
+
+def save_missing_thumbnails(photo, face_boxes, pil_img=None):
+    """
+    Cuts a thumbnail from the photo for each of its face groups that has none yet: new
+    groups, and groups whose thumbnail failed on an earlier run. Failures are only
+    printed - the face tags are already saved and must not be assigned again.
+    """
+    first_face = {}
+    for face_number, group_id in photo.faces.order_by('face_number').values_list('face_number', 'face_group_id'):
+        first_face.setdefault(group_id, face_number)
+    missing = FaceGroup.objects.filter(Q(thumbnail='') | Q(thumbnail__isnull=True), pk__in=first_face)
+
+    for group in missing:
+        try:
+            if pil_img is None:
+                # Detection came from the cache
+                pil_img = load_full_image(photo.image.path)
+            thumb_file = face_thumbnail(pil_img, face_boxes[first_face[group.pk]])
+            group.thumbnail.save(f"face_{photo.id}.jpg", thumb_file, save=False)
+            FaceGroup.objects.filter(pk=group.pk).update(thumbnail=group.thumbnail.name)
+        except Exception as e:
+            print(f"Could not save a thumbnail for face group {group.pk} from photo {photo.id}: {e}")
+
+
+def process_photo_faces(photo_id, raise_errors=False, strict=None, maybe=None, use_cache=True, thumbnails=True):
+    """
+    Detects faces in one TripPhoto and assigns each of them to a FaceGroup of the trip.
+    With raise_errors=True failures propagate (used by the background job runner so it
+    can record them); otherwise they are only logged.
+
+    Detection results are cached per image content, so re-running this (e.g. with other
+    `strict`/`maybe` thresholds) only decodes the photo again to cut thumbnails for new
+    groups, and not at all with thumbnails=False.
+    """
     # Import inside function to prevent Windows/Python 3.12 startup issues
     import face_recognition 
+
+    strict = STRICT_MATCH_DISTANCE if strict is None else strict
+    maybe = MAYBE_MATCH_DISTANCE if maybe is None else maybe
     
     try:
         photo = TripPhoto.objects.get(id=photo_id)
@@ -17,88 +370,29 @@ def process_photo_faces(photo_id):
         
         if not os.path.exists(image_path):
             print(f"File not found: {image_path}")
+            if raise_errors:
+                raise FileNotFoundError(image_path)
             return
 
-        # --- Aggressive Image Normalization ---
-        with Image.open(image_path) as pil_img:
-            # 1. Handle EXIF orientation (auto-rotate image)
-            pil_img = ImageOps.exif_transpose(pil_img)
-            
-            # 2. Force convert to RGB (Fixes Alpha/Transparency/CMYK issues)
-            pil_img = pil_img.convert('RGB')
-            
-            # 3. Explicitly cast to uint8 array
-            image_array = np.ascontiguousarray(np.array(pil_img, dtype='uint8'))
-
-            # Detect faces - get BOTH locations and encodings
-            # We use 'hog' for speed, but 'cnn' is more accurate (needs GPU/CPU power)
-            face_locations = face_recognition.face_locations(image_array, model="hog")
-            face_encodings = face_recognition.face_encodings(image_array, face_locations)
-
-            existing_groups = FaceGroup.objects.filter(trip=photo.trip)
-            
-            for (top, right, bottom, left), encoding in zip(face_locations, face_encodings):
-                # Only process faces that are large enough (filter out background noise)
-                face_height = bottom - top
-                if face_height < 40:
-                    continue
-
-                matched_group = None
-                maybe_matches = []
-                
-                for group in existing_groups:
-                    group_encoding = pickle.loads(group.representative_encoding)
-                    
-                    # Calculate actual distance to see how close it is
-                    distance = face_recognition.face_distance([group_encoding], encoding)[0]
-
-                    # 0.45 is strict - prevents "Lookalike" glitches
-                    match = distance <= 0.45
-                    
-                    if match:
-                        matched_group = group
-                        break
-                    
-                    # If not a strict match, check if it's a "maybe" (0.65)
-                    if distance <= 0.65:
-                        maybe_matches.append(group)
-                
-                if not matched_group:
-                    # Create a thumbnail crop for the new face group
-                    padding = 50
-                    img_h, img_w, _ = image_array.shape
-                    
-                    crop_top = max(0, top - padding)
-                    crop_bottom = min(img_h, bottom + padding)
-                    crop_left = max(0, left - padding)
-                    crop_right = min(img_w, right + padding)
-                    
-                    face_crop = pil_img.crop((crop_left, crop_top, crop_right, crop_bottom))
-                    face_crop.thumbnail((200, 200), Image.Resampling.LANCZOS)
-                    
-                    thumb_io = io.BytesIO()
-                    face_crop.save(thumb_io, format='JPEG', quality=95)
-                    thumb_file = ContentFile(thumb_io.getvalue(), name=f"face_{photo.id}.jpg")
-
-                    matched_group = FaceGroup.objects.create(
-                        trip=photo.trip,
-                        representative_encoding=pickle.dumps(encoding),
-                        thumbnail=thumb_file
-                    )
-                    
-                    # Create suggestions for all "maybe" matches
-                    for maybe_group in maybe_matches:
-                        FaceMergeSuggestion.objects.get_or_create(
-                            trip=photo.trip,
-                            group_a=maybe_group,
-                            group_b=matched_group
-                        )
-                    
-                    existing_groups = FaceGroup.objects.filter(trip=photo.trip)
-
-                PhotoFaceRelation.objects.create(photo=photo, face_group=matched_group)
-            
+        face_boxes, face_encodings, skipped, pil_img = cached_detect_faces(
+            face_recognition, photo, use_cache=use_cache
+        )
+        # Kept on the photo so it's visible why fewer faces were tagged than detected
+        skipped_faces = {reason: count for reason, count in skipped.items() if count}
+        if skipped_faces != photo.skipped_faces:
+            TripPhoto.objects.filter(pk=photo.pk).update(skipped_faces=skipped_faces)
+        if not face_boxes:
+            return
+
+        # Only the group assignment is serialized per trip; detection above runs in parallel
+        assign_photo_faces(photo, face_encodings, strict=strict, maybe=maybe)
+
+        if thumbnails:
+            save_missing_thumbnails(photo, face_boxes, pil_img)
+        
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error processing faces for photo {photo_id}: {e}")
         import traceback
         traceback.print_exc()
\ No newline at end of file
@@ -3,12 +3,21 @@ from django.contrib.auth import login, logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib import messages
-from django.db.models import Case, When, Value, IntegerField, Q, Sum
+from django.db import transaction
+from django.db.models import Case, Count, When, Value, IntegerField, Q, Sum
 from django.conf import settings
 from django.core.mail import send_mail
 import random
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
 from datetime import date
-from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, FileResponse, Http404
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.template.loader import get_template
 from xhtml2pdf import pisa
 import matplotlib.pyplot as plt
@@ -30,7 +39,66 @@ from .models import (
     Settlement
 )
 
-from .utils import process_photo_faces
+from .jobs import enqueue_photos
+from .renditions import CONTENT_TYPES, RENDITION_SIZES, get_rendition, preferred_format
+from .photo_store import HashingUploadHandler, release_photo, store_photo
+from .face_index import bump_face_version, get_trip_index, rank_trip_photos
+from .clustering import merge_face_groups, pick_merge_target, suggestion_chain
+from .face_search import SearchBusy, encode_query_image, get_search_pool
+from .expense_import import import_expenses, text_stream
+from .forecast import trip_forecast
+from .metrics import metrics_enabled, registry as metrics_registry
+from .trip_cache import bump_trip_version, cached_page, page_fingerprint, store_page, trip_state, user_state
+from .ledger import TripLedger
+from .rollups import (
+    delete_expense as remove_expense, delete_settlement as remove_settlement, rebuild_trip_rollups,
+    record_settlement, save_expense
+)
+
+
+def _has_pending_state(request):
+    # Flash messages and pending verification codes are shown once: such pages are never cached
+    return (
+        len(messages.get_messages(request)) > 0
+        or 'pending_member' in request.session
+        or 'pending_settlement' in request.session
+    )
+
+
+def _page_fingerprint(request, *parts):
+    # Besides `parts`, a page depends on who looks at it, their CSRF secret (forms carry a
+    # token for it) and the day (days left, forecasts)
+    get_token(request)
+    return page_fingerprint(*parts, user_state(request.user), request.META.get('CSRF_COOKIE'), date.today())
+
+
+def _cached_response(request, fingerprint, build):
+    """
+    The page identified by `fingerprint`: a 304 when the browser already has it, else the
+    cached copy, else build() (an HttpResponse), which is cached for the next request.
+    """
+    etag = quote_etag(fingerprint)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = cached_page(fingerprint)
+        if response is None:
+            response = build()
+            if response.status_code == 200:
+                store_page(fingerprint, response)
+    response['ETag'] = etag
+    # Revalidated on every load, so a changed trip shows up straight away
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _user_trips_state(trips):
+    return list(trips.order_by('pk').values_list('pk', 'version', 'updated_at'))
+
+
+def _user_trips(user):
+    # Owned OR in a membership subquery: both sides are index lookups, where an OR across
+    # a join to the members table scans every trip and needs distinct()
+    return Trip.objects.filter(Q(user=user) | Q(pk__in=Trip.objects.filter(members=user).values('pk')))
 
 
 def landing_page(request):
@@ -39,17 +107,17 @@ def landing_page(request):
 
 @login_required
 def dashboard(request):
-    trips = Trip.objects.filter(
-        Q(user=request.user) | Q(members=request.user)
-    ).distinct()
+    trips = _user_trips(request.user)
 
-    recent_trips = trips.order_by('-created_at')[:3]
-    total_trips = trips.count()
+    def build():
+        return render(request, 'dashboard.html', {
+            'recent_trips': trips.order_by('-created_at')[:3],
+            'total_trips': trips.count()
+        })
 
-    return render(request, 'dashboard.html', {
-        'recent_trips': recent_trips,
-        'total_trips': total_trips
-    })
+    if _has_pending_state(request):
+        return build()
+    return _cached_response(request, _page_fingerprint(request, 'dashboard', _user_trips_state(trips)), build)
 
 
 def login_view(request):
@@ -121,11 +189,14 @@ def profile_view(request):
 
 @login_required
 def trip_list(request):
-    trips = Trip.objects.filter(
-        Q(user=request.user) | Q(members=request.user)
-    ).distinct().order_by('-start_date')
+    trips = _user_trips(request.user).order_by('-start_date')
+
+    def build():
+        return render(request, 'trip_list.html', {'trips': trips})
 
-    return render(request, 'trip_list.html', {'trips': trips})
+    if _has_pending_state(request):
+        return build()
+    return _cached_response(request, _page_fingerprint(request, 'trip_list', _user_trips_state(trips)), build)
 
 
 @login_required
@@ -161,47 +232,199 @@ def trip_update(request, pk):
 def trip_delete(request, pk):
     trip = get_object_or_404(Trip, pk=pk, user=request.user)
     if request.method == 'POST':
+        for photo in trip.photos.all():
+            release_photo(photo)
         trip.delete()
         return redirect('trip_list')
     return render(request, 'trip_confirm_delete.html', {'trip': trip})
 
 
 
-@login_required
+def _member_trip(request, pk):
+    """The trip, if the user owns it or is one of its members (404 otherwise)."""
+    return get_object_or_404(_user_trips(request.user), pk=pk)
+
+
+def _form_error(form):
+    field, errors = next(iter(form.errors.items()))
+    label = form.fields[field].label if field in form.fields else None
+    return f"{label}: {errors[0]}" if label else errors[0]
+
+
 @login_required
 def trip_detail(request, pk):
-    # 1. Fetch the trip and related data
-    trip = get_object_or_404(
-        Trip.objects.filter(Q(user=request.user) | Q(members=request.user)).distinct(),
-        pk=pk
-    )
+    # A light shell: each tab loads its own content from trip_tab when it is opened
+    trip = _member_trip(request, pk)
+
+    if request.method == 'POST':
+        return _trip_detail_post(request, trip, pk)
 
-    stops = trip.itinerary.all()
-    
     # Ensure owner is also a member for expense tracking
-    GroupMember.objects.get_or_create(
+    _, created = GroupMember.objects.get_or_create(
         trip=trip, 
         contact=trip.user.email,
         defaults={'name': f"{trip.user.first_name} (Owner)" if trip.user.first_name else f"{trip.user.username} (Owner)"}
     )
-    
-    members = trip.companions.all()
-    # Only show face groups that actually have photos attached
-    face_groups = trip.face_groups.filter(tagged_photos__isnull=False).distinct().prefetch_related('tagged_photos__photo')
-    all_photos = trip.photos.all().order_by('-uploaded_at')
+    if created:
+        bump_trip_version(trip.pk)
+        trip.refresh_from_db(fields=['version'])
+
+    def build():
+        return render(request, 'trip_detail.html', {'trip': trip})
+
+    if _has_pending_state(request):
+        return build()
+    return _cached_response(request, _page_fingerprint(request, 'trip_detail', trip_state(trip)), build)
+
+
+def _trip_detail_post(request, trip, pk):
+    # Every form on the trip page posts here; all of them redirect without computing the page
+    if 'add_member' in request.POST:
+        member_form = GroupMemberForm(request.POST)
+        if member_form.is_valid():
+            name = member_form.cleaned_data['name']
+            contact = member_form.cleaned_data['contact']
+            if GroupMember.objects.filter(trip=trip, contact=contact).exists():
+                messages.error(request, "Member already added.")
+                return redirect('trip_detail', pk=pk)
+            code = str(random.randint(100000, 999999))
+            request.session['pending_member'] = {'name': name, 'contact': contact, 'trip_id': trip.pk, 'code': code}
+            try:
+                send_mail("Trip Verification Code", f"Your verification code is {code}", settings.EMAIL_HOST_USER, [contact])
+                messages.success(request, f"Code sent to {contact}")
+            except Exception:
+                if settings.DEBUG: messages.warning(request, f"DEBUG CODE: {code}")
+        else:
+            messages.error(request, _form_error(member_form))
+        return redirect('trip_detail', pk=pk)
+
+    elif 'verify_code' in request.POST:
+        entered = request.POST.get('code')
+        pending = request.session.get('pending_member')
+        if pending and entered == pending['code']:
+            member = GroupMember.objects.create(trip=trip, name=pending['name'], contact=pending['contact'])
+            try:
+                user = CustomUser.objects.get(email__iexact=pending['contact'])
+                trip.members.add(user)
+            except CustomUser.DoesNotExist: pass
+            bump_trip_version(trip.pk)
+            del request.session['pending_member']
+        else:
+            messages.error(request, "Invalid verification code.")
+        return redirect('trip_detail', pk=pk)
+
+    elif 'cancel_verification' in request.POST:
+        request.session.pop('pending_member', None)
+        return redirect('trip_detail', pk=pk)
+
+    elif 'add_checklist_item' in request.POST:
+        item_id = request.POST.get('checklist_item_id')
+        instance = get_object_or_404(ChecklistItem, pk=item_id, trip=trip) if item_id else None
+        checklist_form = ChecklistForm(request.POST, instance=instance)
+        if checklist_form.is_valid():
+            item = checklist_form.save(commit=False)
+            item.trip = trip
+            if not instance:
+                item.user = request.user
+            item.save()
+            bump_trip_version(trip.pk)
+        else:
+            messages.error(request, _form_error(checklist_form))
+        return redirect('trip_detail', pk=pk)
 
-    # 2. Checklist Progress Logic
-    group_items = trip.checklist.filter(is_personal=False).annotate(
-        priority_val=Case(
-            When(priority='High', then=Value(1)),
-            When(priority='Medium', then=Value(2)),
-            When(priority='Low', then=Value(3)),
-            default=Value(4),
-            output_field=IntegerField(),
-        )
-    ).order_by('priority_val', 'is_done')
+    elif 'stop_id' in request.POST or 'location' in request.POST:
+        # 1. Add stop only Trip Owner
+        if trip.user != request.user:
+            messages.error(request, "Only the trip owner can manage itinerary stops.")
+            return redirect('trip_detail', pk=pk)
+            
+        stop_id = request.POST.get('stop_id')
+        instance = get_object_or_404(TripItinerary, pk=stop_id, trip=trip) if stop_id else None
+        form = ItineraryForm(request.POST, instance=instance)
+        if form.is_valid():
+            stop = form.save(commit=False); stop.trip = trip; stop.save()
+            bump_trip_version(trip.pk)
+        else:
+            messages.error(request, _form_error(form))
+        return redirect('trip_detail', pk=pk)
+
+    elif 'add_expense' in request.POST:
+        expense_id = request.POST.get('expense_id')
+        instance = get_object_or_404(Expense, pk=expense_id, trip=trip) if expense_id else None
+        expense_form = ExpenseForm(request.POST, instance=instance)
+        if expense_form.is_valid():
+            expense = expense_form.save(commit=False); expense.trip = trip; save_expense(expense)
+        else:
+            messages.error(request, _form_error(expense_form))
+        return redirect('trip_detail', pk=pk)
 
-    personal_items = trip.checklist.filter(is_personal=True, user=request.user).annotate(
+    elif 'record_payment' in request.POST:
+        payer_name = request.POST.get('from_name')
+        payee_name = request.POST.get('to_name')
+        amount = request.POST.get('amount')
+        
+        payer = get_object_or_404(GroupMember, trip=trip, name=payer_name)
+        payee = get_object_or_404(GroupMember, trip=trip, name=payee_name)
+        
+        if not payee.contact:
+            messages.error(request, f"Cannot verify payment. {payee_name} has no contact info.")
+            return redirect('trip_detail', pk=pk)
+
+        code = str(random.randint(100000, 999999))
+        request.session['pending_settlement'] = {
+            'from_name': payer_name,
+            'to_name': payee_name,
+            'amount': amount,
+            'code': code,
+            'trip_id': trip.pk
+        }
+        
+        try:
+            send_mail(
+                "Payment Verification Code",
+                f"{payer_name} wants to record a payment of ${amount} to you. Verification code: {code}",
+                settings.EMAIL_HOST_USER,
+                [payee.contact]
+            )
+            messages.success(request, f"Verification code sent to {payee_name} ({payee.contact})")
+        except Exception:
+            if settings.DEBUG: messages.warning(request, f"DEBUG SETTLEMENT CODE: {code}")
+        
+        return redirect('trip_detail', pk=pk)
+
+    elif 'verify_payment' in request.POST:
+        entered = request.POST.get('code')
+        pending = request.session.get('pending_settlement')
+        
+        if pending and pending['trip_id'] == trip.pk and entered == pending['code']:
+            payer = get_object_or_404(GroupMember, trip=trip, name=pending['from_name'])
+            payee = get_object_or_404(GroupMember, trip=trip, name=pending['to_name'])
+            
+            record_settlement(
+                trip=trip,
+                payer=payer,
+                payee=payee,
+                amount=pending['amount'],
+                date=date.today()
+            )
+            messages.success(request, f"Payment of ${pending['amount']} verified and recorded!")
+            del request.session['pending_settlement']
+        else:
+            messages.error(request, "Invalid verification code.")
+        return redirect('trip_detail', pk=pk)
+
+    elif 'cancel_settlement' in request.POST:
+        if 'pending_settlement' in request.session:
+            del request.session['pending_settlement']
+        return redirect('trip_detail', pk=pk)
+
+    return redirect('trip_detail', pk=pk)
+
+
+# --- Tab fragments of trip_detail: each builds only what its tab shows ---
+
+def _by_priority(items):
+    return items.annotate(
         priority_val=Case(
             When(priority='High', then=Value(1)),
             When(priority='Medium', then=Value(2)),
@@ -211,303 +434,189 @@ def trip_detail(request, pk):
         )
     ).order_by('priority_val', 'is_done')
 
+
+def _checklist_progress(trip):
     # For progress, usually we count group items or all visible items. Let's count group items for trip progress.
-    total_items = group_items.count()
-    completed_items = group_items.filter(is_done=True).count()
-    progress = int((completed_items / total_items) * 100) if total_items else 0
-
-    # 3. Basic Expense Data
-    expenses = trip.expenses.order_by('-date')
-    total_expense = sum(e.amount for e in expenses)
-    settlements_list = trip.settlements.order_by('-date')
-
-    current_member = GroupMember.objects.filter(trip=trip, contact=request.user.email).first()
-    pending_settlement = request.session.get('pending_settlement')
-
-    # --- START: MODULE 7 & 8 (REPORTS & FUTURE PREDICTION) ---
-    category_totals = {}
-    for exp in expenses:
-        cat = exp.category if exp.category else "Other"
-        category_totals[cat] = category_totals.get(cat, 0) + exp.amount
-    
-    report_labels = list(category_totals.keys())
-    report_data = [float(amount) for amount in category_totals.values()]
+    counts = trip.checklist.filter(is_personal=False).aggregate(
+        total=Count('id'), done=Count('id', filter=Q(is_done=True))
+    )
+    return int((counts['done'] / counts['total']) * 100) if counts['total'] else 0
 
-    # Future Prediction Calculation
-    today = date.today()
-    total_trip_days = (trip.end_date - trip.start_date).days + 1
-    
-    # કેટલા દિવસો વીતી ગયા અને કેટલા બાકી છે તેની ગણતરી
-    if today < trip.start_date:
-        days_passed = 0
-        days_remaining = total_trip_days
-    elif today > trip.end_date:
-        days_passed = total_trip_days
-        days_remaining = 0
-    else:
-        days_passed = (today - trip.start_date).days + 1
-        days_remaining = total_trip_days - days_passed
-
-    daily_avg = 0
-    projected_total = 0
-    safe_daily_limit = 0
-    budget_status = "No Budget Set"
-
-    # Daily Spending Rate
-    if days_passed > 0:
-        daily_avg = total_expense / days_passed
-        projected_total = daily_avg * total_trip_days
-    
-    # Budget Analysis
-    if trip.budget > 0:
-        remaining_budget = trip.budget - total_expense
-        if days_remaining > 0:
-            safe_daily_limit = remaining_budget / days_remaining
-        
-        if projected_total > trip.budget:
-            budget_status = "Likely to Exceed Budget"
-        else:
-            budget_status = "On Track"
-    # --- END: MODULE 7 & 8 ---
 
-    # --- START: EXPENSE SPLITTER LOGIC (Module 6) ---
-    num_members = members.count()
-    share_per_person = total_expense / num_members if num_members > 0 else 0
-    
-    member_balances = []
-    debtors = []   
-    creditors = [] 
+def _itinerary_tab(request, trip):
+    return {'stops': trip.itinerary.all(), 'form': ItineraryForm()}
 
-    for m in members:
-        amount_paid_by_m = sum(e.amount for e in expenses if e.paid_by == m)
-        
-        # Add payments made by m
-        payments_made = sum(s.amount for s in settlements_list if s.payer == m)
-        # Subtract payments received by m
-        payments_received = sum(s.amount for s in settlements_list if s.payee == m)
-        
-        adjusted_paid = amount_paid_by_m + payments_made - payments_received
-        balance = adjusted_paid - share_per_person
-        
-        member_balances.append({
-            'member': m,
-            'paid': amount_paid_by_m,
-            'adjusted_paid': adjusted_paid,
-            'balance': balance,
-            'abs_balance': abs(balance) 
-        })
 
-        if balance < -0.01: 
-            debtors.append({'name': m.name, 'amount': abs(balance)})
-        elif balance > 0.01: 
-            creditors.append({'name': m.name, 'amount': balance})
-
-    settlements = []
-    d_idx, c_idx = 0, 0
-    temp_debtors = [dict(d) for d in debtors]
-    temp_creditors = [dict(c) for c in creditors]
-
-    while d_idx < len(temp_debtors) and c_idx < len(temp_creditors):
-        d = temp_debtors[d_idx]
-        c = temp_creditors[c_idx]
-        settle_amount = min(d['amount'], c['amount'])
-        if settle_amount > 0.01:
-            settlements.append({
-                'from': d['name'],
-                'to': c['name'],
-                'amount': settle_amount
-            })
-        d['amount'] -= settle_amount
-        c['amount'] -= settle_amount
-        if d['amount'] <= 0: d_idx += 1
-        if c['amount'] <= 0: c_idx += 1
-    # --- END: EXPENSE SPLITTER LOGIC ---
-
-    # 4. Form Initializations
-    form = ItineraryForm()
+def _checklist_tab(request, trip):
     checklist_form = ChecklistForm()
     checklist_form.fields['stop'].queryset = TripItinerary.objects.filter(trip=trip)
-    
-    member_form = GroupMemberForm()
+    return {
+        'group_items': _by_priority(trip.checklist.filter(is_personal=False)),
+        'personal_items': _by_priority(trip.checklist.filter(is_personal=True, user=request.user)),
+        'checklist_form': checklist_form,
+        'progress': _checklist_progress(trip),
+    }
+
+
+def _members_tab(request, trip):
+    return {'members': trip.companions.all(), 'member_form': GroupMemberForm()}
+
+
+def _expenses_tab(request, trip):
+    ledger = TripLedger(trip)
     expense_form = ExpenseForm()
     expense_form.fields['paid_by'].queryset = GroupMember.objects.filter(trip=trip)
+    return {
+        'members': ledger.members,
+        'expenses': trip.expenses.select_related('paid_by', 'stop').order_by('-date'),
+        'expense_form': expense_form,
+        'total_expense': ledger.total_expense,
+    }
 
-    # 5. Handle POST requests
-    if request.method == 'POST':
-        if 'add_member' in request.POST:
-            member_form = GroupMemberForm(request.POST)
-            if member_form.is_valid():
-                name = member_form.cleaned_data['name']
-                contact = member_form.cleaned_data['contact']
-                if GroupMember.objects.filter(trip=trip, contact=contact).exists():
-                    messages.error(request, "Member already added.")
-                    return redirect('trip_detail', pk=pk)
-                code = str(random.randint(100000, 999999))
-                request.session['pending_member'] = {'name': name, 'contact': contact, 'trip_id': trip.pk, 'code': code}
-                try:
-                    send_mail("Trip Verification Code", f"Your verification code is {code}", settings.EMAIL_HOST_USER, [contact])
-                    messages.success(request, f"Code sent to {contact}")
-                except Exception:
-                    if settings.DEBUG: messages.warning(request, f"DEBUG CODE: {code}")
-                return redirect('trip_detail', pk=pk)
-
-        elif 'verify_code' in request.POST:
-            entered = request.POST.get('code')
-            pending = request.session.get('pending_member')
-            if pending and entered == pending['code']:
-                member = GroupMember.objects.create(trip=trip, name=pending['name'], contact=pending['contact'])
-                try:
-                    user = CustomUser.objects.get(email__iexact=pending['contact'])
-                    trip.members.add(user)
-                except CustomUser.DoesNotExist: pass
-                del request.session['pending_member']
-            else:
-                messages.error(request, "Invalid verification code.")
-            return redirect('trip_detail', pk=pk)
 
-        elif 'add_checklist_item' in request.POST:
-            item_id = request.POST.get('checklist_item_id')
-            instance = get_object_or_404(ChecklistItem, pk=item_id, trip=trip) if item_id else None
-            checklist_form = ChecklistForm(request.POST, instance=instance)
-            if checklist_form.is_valid():
-                item = checklist_form.save(commit=False)
-                item.trip = trip
-                if not instance:
-                    item.user = request.user
-                item.save()
-            return redirect('trip_detail', pk=pk)
+def _photos_tab(request, trip):
+    return {
+        # Only show face groups that actually have photos attached
+        'face_groups': trip.face_groups.filter(tagged_photos__isnull=False).distinct().prefetch_related('tagged_photos__photo'),
+        'all_photos': trip.photos.select_related('face_job').order_by('-uploaded_at'),
+        'suggestions': trip.merge_suggestions.filter(is_active=True),
+    }
 
-        elif 'stop_id' in request.POST or 'location' in request.POST:
-            # 1. Add stop only Trip Owner
-            if trip.user != request.user:
-                messages.error(request, "Only the trip owner can manage itinerary stops.")
-                return redirect('trip_detail', pk=pk)
-                
-            stop_id = request.POST.get('stop_id')
-            instance = get_object_or_404(TripItinerary, pk=stop_id, trip=trip) if stop_id else None
-            form = ItineraryForm(request.POST, instance=instance)
-            if form.is_valid():
-                stop = form.save(commit=False); stop.trip = trip; stop.save()
-            return redirect('trip_detail', pk=pk)
 
-        elif 'add_expense' in request.POST:
-            expense_id = request.POST.get('expense_id')
-            instance = get_object_or_404(Expense, pk=expense_id, trip=trip) if expense_id else None
-            expense_form = ExpenseForm(request.POST, instance=instance)
-            if expense_form.is_valid():
-                expense = expense_form.save(commit=False); expense.trip = trip; expense.save()
-            return redirect('trip_detail', pk=pk)
+def _splitter_tab(request, trip):
+    # Per-member totals come from the expense rollups (a fixed number of queries)
+    ledger = TripLedger(trip)
+    return {
+        'total_expense': ledger.total_expense,
+        'share_per_person': ledger.share_per_person,
+        'member_balances': ledger.member_balances(),
+        'settlements': ledger.suggested_settlements(),
+        'settlements_list': trip.settlements.select_related('payer', 'payee').order_by('-date'),
+        'current_member': GroupMember.objects.filter(trip=trip, contact=request.user.email).first(),
+        'pending_settlement': request.session.get('pending_settlement'),
+    }
 
-        elif 'record_payment' in request.POST:
-            payer_name = request.POST.get('from_name')
-            payee_name = request.POST.get('to_name')
-            amount = request.POST.get('amount')
-            
-            payer = get_object_or_404(GroupMember, trip=trip, name=payer_name)
-            payee = get_object_or_404(GroupMember, trip=trip, name=payee_name)
-            
-            if not payee.contact:
-                messages.error(request, f"Cannot verify payment. {payee_name} has no contact info.")
-                return redirect('trip_detail', pk=pk)
 
-            code = str(random.randint(100000, 999999))
-            request.session['pending_settlement'] = {
-                'from_name': payer_name,
-                'to_name': payee_name,
-                'amount': amount,
-                'code': code,
-                'trip_id': trip.pk
-            }
-            
-            try:
-                send_mail(
-                    "Payment Verification Code",
-                    f"{payer_name} wants to record a payment of ${amount} to you. Verification code: {code}",
-                    settings.EMAIL_HOST_USER,
-                    [payee.contact]
-                )
-                messages.success(request, f"Verification code sent to {payee_name} ({payee.contact})")
-            except Exception:
-                if settings.DEBUG: messages.warning(request, f"DEBUG SETTLEMENT CODE: {code}")
-            
-            return redirect('trip_detail', pk=pk)
+def _reports_tab(request, trip):
+    ledger = TripLedger(trip)
+    category_totals = ledger.category_totals()
+    # Trend-aware forecast from the per-day spend series, cached until expenses change
+    forecast = trip_forecast(trip)
+    return {
+        'members': ledger.members,
+        'progress': _checklist_progress(trip),
+        'total_expense': ledger.total_expense,
+        'category_totals': category_totals,
+        'report_labels': list(category_totals.keys()),
+        'report_data': [float(amount) for amount in category_totals.values()],
+        'daily_avg': forecast['daily_avg'],
+        'projected_total': forecast['projected_total'],
+        'safe_daily_limit': forecast['safe_daily_limit'],
+        'budget_status': forecast['budget_status'],
+        'days_remaining': forecast['days_remaining'],
+        'forecast': forecast,
+    }
 
-        elif 'verify_payment' in request.POST:
-            entered = request.POST.get('code')
-            pending = request.session.get('pending_settlement')
-            
-            if pending and pending['trip_id'] == trip.pk and entered == pending['code']:
-                payer = get_object_or_404(GroupMember, trip=trip, name=pending['from_name'])
-                payee = get_object_or_404(GroupMember, trip=trip, name=pending['to_name'])
-                
-                Settlement.objects.create(
-                    trip=trip,
-                    payer=payer,
-                    payee=payee,
-                    amount=pending['amount'],
-                    date=date.today()
-                )
-                messages.success(request, f"Payment of ${pending['amount']} verified and recorded!")
-                del request.session['pending_settlement']
-            else:
-                messages.error(request, "Invalid verification code.")
-            return redirect('trip_detail', pk=pk)
 
-        elif 'cancel_settlement' in request.POST:
-            if 'pending_settlement' in request.session:
-                del request.session['pending_settlement']
-            return redirect('trip_detail', pk=pk)
+TRIP_TABS = {
+    'itinerary': _itinerary_tab,
+    'checklist': _checklist_tab,
+    'members': _members_tab,
+    'expenses': _expenses_tab,
+    'photos': _photos_tab,
+    'splitter': _splitter_tab,
+    'reports': _reports_tab,
+}
 
-    # 6. Fetch active merge suggestions
-    suggestions = trip.merge_suggestions.filter(is_active=True)
 
-    # 7. Final Context Rendering
-    return render(request, 'trip_detail.html', {
-        'trip': trip,
-        'stops': stops,
-        'members': members,
-        'form': form,
-        'group_items': group_items,
-        'personal_items': personal_items,
-        'checklist_form': checklist_form,
-        'member_form': member_form,
-        'progress': progress,
-        'expenses': expenses,
-        'expense_form': expense_form,
-        'total_expense': total_expense,
-        # Reports & Prediction Context:
-        'category_totals': category_totals,
-        'report_labels': report_labels,
-        'report_data': report_data,
-        'daily_avg': daily_avg,
-        'projected_total': projected_total, 
-        'safe_daily_limit': safe_daily_limit,
-        'budget_status': budget_status,
-        'days_remaining': days_remaining,
-        # Splitter Context:
-        'share_per_person': share_per_person,
-        'member_balances': member_balances,
-        'settlements': settlements,
-        # Photos & Suggestions
-        'face_groups': face_groups,
-        'all_photos': all_photos,
-        'suggestions': suggestions,
-        'settlements_list': settlements_list,
-        'current_member': current_member,
-        'pending_settlement': pending_settlement,
-    })
+@login_required
+def trip_tab(request, pk, tab):
+    if tab not in TRIP_TABS:
+        raise Http404
+    trip = _member_trip(request, pk)
+
+    def build():
+        context = TRIP_TABS[tab](request, trip)
+        context['trip'] = trip
+        return render(request, f'trip_tabs/{tab}.html', context)
+
+    if _has_pending_state(request):
+        return build()
+    return _cached_response(request, _page_fingerprint(request, 'trip_tab', tab, trip_state(trip)), build)
     
 @login_required
+@csrf_exempt
 def upload_trip_photos(request, pk):
+    # Hash every file while it streams in; the handler must be installed before the
+    # body is read, which is why CSRF is checked afterwards in _upload_trip_photos
+    hashing_handler = HashingUploadHandler(request)
+    request.upload_handlers.insert(0, hashing_handler)
+    return _upload_trip_photos(request, pk, hashing_handler)
+
+
+@csrf_protect
+def _upload_trip_photos(request, pk, hashing_handler):
     trip = get_object_or_404(
         Trip.objects.filter(Q(user=request.user) | Q(members=request.user)).distinct(),
         pk=pk
     )
     images = request.FILES.getlist('images')
-    for img in images:
-        photo = TripPhoto.objects.create(trip=trip, image=img)
-        process_photo_faces(photo.id)
-    messages.success(request, f"{len(images)} photos uploaded!")
+    digests = hashing_handler.digests.get('images', [])
+    if len(digests) != len(images):
+        digests = [None] * len(images)
+
+    new_photos = []
+    for img, digest in zip(images, digests):
+        photo, created = store_photo(trip, img, digest)
+        if created:
+            new_photos.append(photo)
+
+    # Face grouping runs in the background worker (manage.py process_face_jobs);
+    # exact duplicates keep the faces already found in the first copy
+    enqueue_photos(new_photos)
+    if new_photos:
+        bump_trip_version(trip.pk)
+    duplicates = len(images) - len(new_photos)
+    messages.success(request, f"{len(new_photos)} photos uploaded! Faces will be grouped in the background.")
+    if duplicates:
+        messages.info(request, f"{duplicates} photo(s) were already in this trip and were skipped.")
+    return redirect('trip_detail', pk=pk)
+
+
+@login_required
+def import_trip_expenses(request, pk):
+    trip = get_object_or_404(
+        Trip.objects.filter(Q(user=request.user) | Q(members=request.user)).distinct(),
+        pk=pk
+    )
+    wants_json = 'application/json' in request.headers.get('Accept', '')
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    upload = request.FILES.get('file')
+    if not upload:
+        error = "No CSV file provided."
+    else:
+        try:
+            # Streams the upload (a temp file for large ones) instead of reading it whole
+            report = import_expenses(trip, text_stream(upload.file), default_payer=request.POST.get('paid_by'))
+            error = None
+        except ValueError as e:
+            error = str(e)
+
+    if wants_json:
+        if error:
+            return HttpResponse(json.dumps({'error': error}), content_type="application/json", status=400)
+        return HttpResponse(json.dumps(report), content_type="application/json")
+
+    if error:
+        messages.error(request, error)
+        return redirect('trip_detail', pk=pk)
+    messages.success(request, f"{report['created']} expenses imported.")
+    if report['failed']:
+        lines = ', '.join(str(entry['line']) for entry in report['errors'][:10])
+        more = " ..." if report['failed'] > 10 else ""
+        messages.warning(request, f"{report['failed']} row(s) could not be imported (lines {lines}{more}).")
     return redirect('trip_detail', pk=pk)
 
 
@@ -516,13 +625,49 @@ def delete_trip_photo(request, pk):
     photo = get_object_or_404(TripPhoto, pk=pk)
     trip = photo.trip
     if request.user == trip.user or request.user in trip.members.all():
+        release_photo(photo)
         photo.delete()
         # Automatically clean up any face groups that no longer have any associated photos
-        FaceGroup.objects.filter(trip=trip, tagged_photos__isnull=True).delete()
+        removed, _ = FaceGroup.objects.filter(trip=trip, tagged_photos__isnull=True).delete()
+        if removed:
+            bump_face_version(trip.pk)
+        else:
+            bump_trip_version(trip.pk)
         messages.success(request, "Photo removed.")
     return redirect('trip_detail', pk=trip.pk)
 
 
+def _serve_rendition(request, field_file, size):
+    if not field_file or size not in RENDITION_SIZES:
+        raise Http404
+    fmt = preferred_format(request)
+    rendition = get_rendition(field_file, size, fmt)
+
+    response = FileResponse(rendition.file.open('rb'), content_type=CONTENT_TYPES[fmt])
+    # Originals never change under the same name, so renditions can be cached for good
+    patch_cache_control(response, private=True, max_age=31536000, immutable=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+@login_required
+def photo_rendition(request, pk, size):
+    photo = get_object_or_404(
+        TripPhoto.objects.filter(Q(trip__user=request.user) | Q(trip__members=request.user)).distinct(),
+        pk=pk
+    )
+    return _serve_rendition(request, photo.image, size)
+
+
+@login_required
+def face_thumbnail(request, group_id):
+    group = get_object_or_404(
+        FaceGroup.objects.filter(Q(trip__user=request.user) | Q(trip__members=request.user)).distinct(),
+        id=group_id
+    )
+    return _serve_rendition(request, group.thumbnail, 'face')
+
+
 @login_required
 def rename_face_group(request, group_id):
     group = get_object_or_404(
@@ -534,6 +679,7 @@ def rename_face_group(request, group_id):
         if new_name:
             group.name = new_name
             group.save()
+            bump_trip_version(group.trip_id)
             messages.success(request, "Folder renamed!")
     return redirect('trip_detail', pk=group.trip.pk)
 
@@ -547,6 +693,7 @@ def delete_face_group(request, group_id):
     trip_pk = group.trip.pk
     # Deleting the group also removes all PhotoFaceRelation records due to models.CASCADE
     group.delete()
+    bump_face_version(trip_pk)
     messages.success(request, "Person profile removed.")
     return redirect('trip_detail', pk=trip_pk)
 
@@ -561,7 +708,11 @@ def delete_member(request, pk):
             trip.members.remove(user)
         except CustomUser.DoesNotExist:
             pass
-        member.delete()
+        with transaction.atomic():
+            member.delete()
+            # Their settlements were deleted and their expenses unassigned by the database
+            # (the rebuild also bumps the trip's version)
+            rebuild_trip_rollups(trip.pk)
     return redirect('trip_detail', pk=trip.pk)
 
 
@@ -572,6 +723,7 @@ def checklist_toggle(request, pk):
     if request.user == trip.user or request.user in trip.members.all():
         item.is_done = not item.is_done
         item.save()
+        bump_trip_version(trip.pk)
     return redirect('trip_detail', pk=trip.pk)
 
 
@@ -581,6 +733,7 @@ def checklist_delete(request, pk):
     trip_pk = item.trip.pk
     if item.trip.user == request.user:
         item.delete()
+        bump_trip_version(trip_pk)
     return redirect('trip_detail', pk=trip_pk)
 
 
@@ -590,6 +743,7 @@ def delete_stop(request, pk):
     trip_pk = stop.trip.pk
     if stop.trip.user == request.user:
         stop.delete()
+        bump_trip_version(trip_pk)
     return redirect('trip_detail', pk=trip_pk)
 
 
@@ -598,7 +752,7 @@ def delete_expense(request, pk):
     expense = get_object_or_404(Expense, pk=pk)
     trip_pk = expense.trip.pk
     if expense.trip.user == request.user:
-        expense.delete()
+        remove_expense(expense)
     return redirect('trip_detail', pk=trip_pk)
 
 
@@ -607,27 +761,31 @@ def delete_settlement(request, pk):
     settlement = get_object_or_404(Settlement, pk=pk)
     trip_pk = settlement.trip.pk
     if settlement.trip.user == request.user:
-        settlement.delete()
+        remove_settlement(settlement)
         messages.success(request, "Settlement record removed.")
     return redirect('trip_detail', pk=trip_pk)
 
 
 @login_required
 def checklist_dashboard(request):
-    trips = Trip.objects.filter(
-        Q(user=request.user) | Q(members=request.user)
-    ).distinct().order_by('start_date')
+    # As a subquery, so the queries below need neither an OR-join nor distinct()
+    member_trips = _user_trips(request.user).values('pk')
+
+    # Item counts of every trip in the same query
+    trips = Trip.objects.filter(pk__in=member_trips).annotate(
+        checklist_total=Count('checklist'),
+        checklist_done=Count('checklist', filter=Q(checklist__is_done=True)),
+    ).order_by('start_date')
 
     for trip in trips:
-        total = trip.checklist.count()
-        done = trip.checklist.filter(is_done=True).count()
+        total, done = trip.checklist_total, trip.checklist_done
         trip.progress = int((done / total) * 100) if total else 0
 
     urgent_items = ChecklistItem.objects.filter(
-        Q(trip__user=request.user) | Q(trip__members=request.user),
+        trip__in=member_trips,
         priority='High',
         is_done=False
-    ).distinct()
+    ).select_related('trip', 'stop')
 
     return render(request, 'checklist_dashboard.html', {
         'trips': trips,
@@ -650,26 +808,21 @@ def manage_face_suggestion(request, suggestion_id, action):
         return redirect('trip_detail', pk=trip.pk)
     
     if action == 'merge':
-        group_a = suggestion.group_a # Destination (often the named one)
-        group_b = suggestion.group_b # Source (often the new 'unknown' one)
-        
-        # Move all photos from B to A
-        relations_to_move = PhotoFaceRelation.objects.filter(face_group=group_b)
-        for rel in relations_to_move:
-            # Only move if photo isn't already in A
-            if not PhotoFaceRelation.objects.filter(photo=rel.photo, face_group=group_a).exists():
-                rel.face_group = group_a
-                rel.save()
-            else:
-                rel.delete() # Duplicate link
-        
-        # Delete the redundant group
-        group_b.delete()
+        # group_a is the destination (often the named one), group_b the new 'unknown' one
+        merge_face_groups(suggestion.group_a, [suggestion.group_b_id])
         messages.success(request, f"Profiles merged successfully!")
+
+    elif action == 'merge_all':
+        # Follow chains of suggestions (A~B, B~C) and merge everyone into one profile
+        group_ids = suggestion_chain(suggestion)
+        target = pick_merge_target(group_ids)
+        merge_face_groups(target, group_ids)
+        messages.success(request, f"{len(group_ids)} profiles merged into {target.name}!")
         
     elif action == 'dismiss':
         suggestion.is_active = False
         suggestion.save()
+        bump_trip_version(trip.pk)
         messages.info(request, "Suggestion dismissed.")
         
     return redirect('trip_detail', pk=trip.pk)
@@ -677,23 +830,28 @@ def manage_face_suggestion(request, suggestion_id, action):
 @login_required
 def export_trip_pdf(request, pk):
     trip = get_object_or_404(Trip, pk=pk)
-    
-    expenses = trip.expenses.all()
-    members = trip.companions.all()
+    # The same for every viewer; the footer has the date, so it is also per day
+    fingerprint = page_fingerprint('trip_pdf', trip_state(trip), date.today())
+    return _cached_response(request, fingerprint, lambda: _trip_pdf(trip))
+
+
+def _trip_pdf(trip):
+    ledger = TripLedger(trip)
+    expenses = trip.expenses.select_related('paid_by', 'stop')
+    members = ledger.members
     stops = trip.itinerary.all()
     checklist = trip.checklist.all()
     
-    total_expense = sum(e.amount for e in expenses)
-    num_members = members.count()
-    share = total_expense / num_members if num_members > 0 else 0
+    total_expense = ledger.total_expense
+    share = ledger.share_per_person
+    category_totals = ledger.category_totals()
     
     # --- Visual Analytics Logic Start ---
     chart_url = None
-    if expenses.exists():
+    if category_totals:
         # Expense by Category Data Preparation
-        category_data = trip.expenses.values('category').annotate(total=Sum('amount'))
-        labels = [item['category'] for item in category_data]
-        values = [float(item['total']) for item in category_data]
+        labels = list(category_totals.keys())
+        values = [float(total) for total in category_totals.values()]
 
         # Pie Chart Creation
         plt.figure(figsize=(4, 3))
@@ -715,10 +873,10 @@ def export_trip_pdf(request, pk):
         chart_url = f"data:image/png;base64,{graphic}"
     # --- Visual Analytics Logic End ---
 
-    member_balances = []
-    for m in members:
-        paid = sum(e.amount for e in expenses if e.paid_by == m)
-        member_balances.append({'name': m.name, 'paid': paid, 'diff': paid - share})
+    member_balances = [
+        {'name': entry['member'].name, 'paid': entry['paid'], 'diff': entry['paid'] - share}
+        for entry in ledger.member_balances()
+    ]
 
     context = {
         'trip': trip,
@@ -745,17 +903,19 @@ def export_trip_pdf(request, pk):
     return response
 
 
-from django.views.decorators.csrf import csrf_exempt
 import json
 import numpy as np
-import pickle
 
 @csrf_exempt
 def search_photos_by_face(request, pk):
     """
-    Accepts a POST request with a 'face_image' file (snapshot from webcam).
-    Detects the face in the uploaded image and compares it with existing FaceGroup encodings for this trip.
-    Returns a JSON list of matching photo IDs.
+    Accepts a POST request with an 'image' file (snapshot from webcam).
+    Detects the face(s) in the uploaded image and compares them with the trip's FaceGroup encodings.
+    Returns a JSON list of matching photo IDs ranked by distance (closest first).
+
+    Optional POST fields:
+      all_faces=1  search for every face in the image instead of only the largest one
+      match=all    with all_faces, only return photos that contain every one of those faces
     """
     if request.method != 'POST':
         return HttpResponse(status=405) # Method Not Allowed
@@ -770,67 +930,98 @@ def search_photos_by_face(request, pk):
     if not uploaded_file:
         return HttpResponse(json.dumps({'error': 'No image provided'}), content_type="application/json", status=400)
 
-    import face_recognition # Import here to avoid overhead if not used
-    from PIL import Image
+    use_all_faces = request.POST.get('all_faces') in ('1', 'true', 'on')
+    require_all = use_all_faces and request.POST.get('match') == 'all'
 
     try:
-        # Load the uploaded image
-        # 'uploaded_file' is an InMemoryUploadedFile or TemporaryUploadedFile
-        # face_recognition.load_image_file simply reads it into a numpy array.
-        # Let's use PIL to ensure it's RGB and valid before passing to face_recognition
-        
-        pil_image = Image.open(uploaded_file)
-        pil_image = pil_image.convert('RGB')
-        image = np.array(pil_image)
-        
-        print(f"DEBUG: Processing image for face search. Shape: {image.shape}")
-
-        # Detect faces in the uploaded image
-        # First try 'hog' model
-        face_locations = face_recognition.face_locations(image, model="hog")
-        if not face_locations:
-            print("DEBUG: No faces found with HOG. Trying CNN...")
-            # Fallback to CNN if possible - note: CNN is much slower without GPU
-            # But for a single lookup it might be acceptable if HOG fails
-            # Actually, standard dlib HOG is usually fine for frontal selfies.
-            # If it fails, maybe the image is too small or rotated?
-            # PIL load usually respects orientation if handled, but let's check.
-            pass
-            
-        face_encodings = face_recognition.face_encodings(image, face_locations)
+        face_encodings = encode_query_image(uploaded_file.read(), all_faces=use_all_faces)
 
         if not face_encodings:
-             print("DEBUG: Still no face encodings found.")
              return HttpResponse(json.dumps({'error': 'No face detected. Please ensure your face is clearly visible and well-lit.'}), content_type="application/json")
 
-        # Use the first face found
-        uploaded_face_encoding = face_encodings[0]
-
-        # Get all FaceGroups for this trip that have a valid encoding
-        face_groups = FaceGroup.objects.filter(trip=trip).exclude(representative_encoding=None)
-        
-        matching_photo_ids = set()
-
-        for group in face_groups:
-            if not group.representative_encoding:
-                continue
-                
-            try:
-                group_encoding = pickle.loads(group.representative_encoding)
-                
-                # Calculate distance
-                distance = face_recognition.face_distance([group_encoding], uploaded_face_encoding)[0]
-                
-                if distance <= 0.55:
-                    photos = group.tagged_photos.values_list('photo_id', flat=True)
-                    matching_photo_ids.update(photos)
-            except Exception:
-                continue
-
-        return HttpResponse(json.dumps({'photo_ids': list(matching_photo_ids)}), content_type="application/json")
+        return HttpResponse(json.dumps(_face_search_results(trip, face_encodings, require_all)), content_type="application/json")
 
     except Exception as e:
         print(f"Error in search_photos_by_face: {e}")
         import traceback
         traceback.print_exc()
-        return HttpResponse(json.dumps({'error': f'Server Error: {str(e)}'}), content_type="application/json", status=500)
\ No newline at end of file
+        return HttpResponse(json.dumps({'error': f'Server Error: {str(e)}'}), content_type="application/json", status=500)
+
+
+def _face_search_results(trip, face_encodings, require_all):
+    # Cached per trip and face_version: repeated searches only query the photo ids
+    face_index = get_trip_index(trip.id, trip.face_version)
+    results = rank_trip_photos(face_index, face_encodings, require_all=require_all)
+    return {
+        'photo_ids': [result['photo_id'] for result in results],
+        'results': results,
+        'faces_searched': len(face_encodings),
+    }
+
+
+def _search_busy(message):
+    response = HttpResponse(json.dumps({'error': message}), content_type="application/json", status=503)
+    response['Retry-After'] = str(getattr(settings, 'FACE_SEARCH_RETRY_AFTER', 5))
+    return response
+
+
+@csrf_exempt
+async def search_photos_by_face_async(request, pk):
+    """
+    Async version of search_photos_by_face (same POST fields and response) for ASGI.
+    Detection and encoding run in the face search process pool; when all of its workers
+    and queue slots are taken, or the search takes too long, it answers 503 with Retry-After.
+    """
+    if request.method != 'POST':
+        return HttpResponse(status=405) # Method Not Allowed
+
+    trip = await Trip.objects.filter(pk=pk).afirst()
+    if trip is None:
+        raise Http404
+
+    # Check permissions (basic check)
+    user = await request.auser()
+    is_member = user.is_authenticated and (
+        user.pk == trip.user_id or await trip.members.filter(pk=user.pk).aexists()
+    )
+    if not is_member:
+        return HttpResponse(status=403)
+
+    uploaded_file = request.FILES.get('image')
+    if not uploaded_file:
+        return HttpResponse(json.dumps({'error': 'No image provided'}), content_type="application/json", status=400)
+
+    use_all_faces = request.POST.get('all_faces') in ('1', 'true', 'on')
+    require_all = use_all_faces and request.POST.get('match') == 'all'
+
+    try:
+        future = get_search_pool().submit(encode_query_image, uploaded_file.read(), use_all_faces)
+        face_encodings = await asyncio.wait_for(
+            asyncio.wrap_future(future), timeout=getattr(settings, 'FACE_SEARCH_TIMEOUT', 10)
+        )
+    except SearchBusy:
+        return _search_busy('Face search is busy right now. Please try again in a few seconds.')
+    except asyncio.TimeoutError:
+        return _search_busy('Face search took too long. Please try again in a few seconds.')
+    except BrokenProcessPool:
+        return _search_busy('Face search is restarting. Please try again in a few seconds.')
+    except Exception as e:
+        print(f"Error in search_photos_by_face_async: {e}")
+        return HttpResponse(json.dumps({'error': f'Server Error: {str(e)}'}), content_type="application/json", status=500)
+
+    if not face_encodings:
+        return HttpResponse(json.dumps({'error': 'No face detected. Please ensure your face is clearly visible and well-lit.'}), content_type="application/json")
+
+    results = await sync_to_async(_face_search_results)(trip, face_encodings, require_all)
+    return HttpResponse(json.dumps(results), content_type="application/json")
+
+
+def metrics(request):
+    # Prometheus scrape endpoint; only there with REQUEST_METRICS_ENABLED
+    if not metrics_enabled():
+        raise Http404
+    token = getattr(settings, 'REQUEST_METRICS_TOKEN', None)
+    bearer = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not (request.user.is_staff or (token and constant_time_compare(bearer, token))):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")